@@ -556,6 +556,21 @@ const GamificationProvider = ({ children }) => {
           await AsyncStorage.setItem('gamificationEnabled', 'true');
         }
 
+        // Tell the server the app was opened: it starts the session that
+        // time-based achievements (speed_demon) are measured from
+        if (gamEnabled === null || JSON.parse(gamEnabled)) {
+          fetch(`${GAMIFICATION_SERVER}/api/gamification/points`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+              token,
+              points: 1,
+              action: 'app_open',
+              utc_offset: -new Date().getTimezoneOffset(),
+            }),
+          }).catch(error => console.error('Error reporting app open:', error));
+        }
+
         // Check if first login achievement should be awarded
         const hasLoggedIn = await AsyncStorage.getItem('hasLoggedIn');
         if (!hasLoggedIn && gamificationEnabled !== false) {
@@ -677,6 +692,8 @@ const GamificationProvider = ({ children }) => {
           points: amount,
           action,
           details,
+          // Lets the server judge time-of-day achievements on this clock
+          utc_offset: -new Date().getTimezoneOffset(),
         }),
       });
     } catch (error) {
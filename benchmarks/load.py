@@ -0,0 +1,559 @@
+"""
+Load test for the gamification endpoints
+
+Seeds a synthetic population (users with realistic event histories) into a
+fresh data directory, replays a weighted mix of API calls against it and
+reports throughput, p50/p95/p99 latency, RSS and bytes written per request.
+Results are written as JSON so runs of different revisions can be diffed.
+
+Usage:
+    python benchmarks/load.py --users 1000 100000 --requests 20000
+    python benchmarks/load.py --target server --backend sqlite --concurrency 16
+    python benchmarks/load.py --target http://127.0.0.1:5000 --users 1000
+    python benchmarks/load.py --mix status=50,points=30,leaderboard=20
+    python benchmarks/load.py --compare before.json after.json
+
+Targets:
+    client  - Flask test client in this process (default)
+    server  - the app served by a locally launched server process
+    URL     - an already running server; it must have been started on the
+              data directory this script seeds (--workdir), or be seeded
+              some other way
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+DEFAULT_MIX = "status=35,points=25,achievement=5,sync=10,leaderboard=15,telemetry=10"
+OPERATIONS = ('status', 'points', 'achievement', 'sync', 'leaderboard', 'telemetry')
+
+
+# ============================================
+# SEEDING
+# ============================================
+
+def seed_population(endpoints, users_count, backend, rng, history_mean=8, history_days=90):
+    """Write users_count users and their event histories to the data dir.
+
+    Histories are mostly point events for weighted actions with the odd
+    achievement or task, spread over the last history_days days; each user's
+    record is the fold of its events, exactly as the server would store it.
+    """
+    actions = list(endpoints.POINT_VALUES)
+    action_weights = [8 if action.startswith('photo_upload') or action == 'app_open' else 1
+                      for action in actions]
+    achievements = list(endpoints.DEFAULT_ACHIEVEMENTS)
+    tasks = list(endpoints.DEFAULT_TASKS)
+    now = datetime.now()
+    seq = 0
+
+    storage = endpoints.open_storage(backend)
+    users = {}
+    if backend == 'sqlite':
+        storage.start()
+
+    with open(endpoints.FODY_EVENTS_FILE, 'wb') as log:
+        batch = []
+        for i in range(users_count):
+            token = f"bench{i:010d}"
+            user = endpoints.new_user_record(token)
+            created = now - timedelta(seconds=rng.uniform(0, history_days * 86400))
+            user["created_at"] = created.isoformat()
+            count = min(int(rng.expovariate(1 / history_mean)) + 1, 500)
+            offsets = sorted(rng.uniform(0, (now - created).total_seconds()) for _ in range(count))
+            for offset in offsets:
+                seq += 1
+                roll = rng.random()
+                if roll < 0.05 and len(user["achievements"]) < len(achievements):
+                    achievement_id = rng.choice([a for a in achievements if a not in user["achievements"]])
+                    event = {"type": "achievement", "id": achievement_id,
+                             "amount": endpoints.DEFAULT_ACHIEVEMENTS[achievement_id]["points"]}
+                elif roll < 0.08 and len(user["completed_tasks"]) < len(tasks):
+                    task_id = rng.choice([t for t in tasks if t not in user["completed_tasks"]])
+                    event = {"type": "task", "id": task_id,
+                             "amount": endpoints.DEFAULT_TASKS[task_id]["points"]}
+                else:
+                    action = rng.choices(actions, action_weights)[0]
+                    event = {"type": "points", "action": action,
+                             "amount": endpoints.POINT_VALUES[action], "details": {}}
+                event = {"seq": seq, "ts": (created + timedelta(seconds=offset)).isoformat(),
+                         "token": token, **event}
+                log.write(endpoints.dumps_json(event) + b'\n')
+                user.update(endpoints.apply_event(user, event))
+            user["last_active"] = (created + timedelta(seconds=offsets[-1])).isoformat()
+            user["version"] = count + 1
+            if backend == 'sqlite':
+                batch.append((token, user))
+                if len(batch) >= 10000:
+                    _seed_sqlite(storage, batch)
+                    batch = []
+            else:
+                users[token] = user
+        if batch:
+            _seed_sqlite(storage, batch)
+
+    if backend == 'sqlite':
+        storage.close()
+    else:
+        endpoints.save_json_fody(endpoints.FODY_USERS_FILE, users)
+    return seq
+
+
+def _seed_sqlite(storage, batch):
+    with storage.transaction():
+        for token, user in batch:
+            storage.create_user(token, user)
+
+
+# ============================================
+# TARGETS
+# ============================================
+
+class ClientTarget:
+    """Requests through the Flask test client of an in-process app."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers={'Accept-Encoding': 'gzip'})
+        return response.status_code, len(response.data)
+
+
+class HttpTarget:
+    """Requests over keep-alive HTTP connections, one per thread."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Accept-Encoding': 'gzip'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+        return response.status, len(data)
+
+
+def launch_server(workdir, backend):
+    """Start the app on a free local port; return (process, url)."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ, FODY_STORAGE_BACKEND=backend,
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen(
+        [sys.executable, '-c',
+         f"import endpoints; endpoints.create_app().run(host='127.0.0.1', port={port}, threaded=True)"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/gamification/info')
+            conn.getresponse().read()
+            conn.close()
+            return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def stop_server(process):
+    # SIGINT lets atexit flush the stores like a normal shutdown
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=120)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ============================================
+# MEASUREMENTS
+# ============================================
+
+def process_rss(pid):
+    """Current resident set size of pid in bytes, or None if unknown."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        # Peak rather than current, in KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    return None
+
+
+def process_write_bytes(pid):
+    """Bytes pid has caused to be written to storage, or None if unknown."""
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# ============================================
+# WORKLOAD
+# ============================================
+
+def parse_mix(text):
+    """Parse 'op=weight,...' into {op: weight}."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_request(endpoints, operation, rng, users_count, cursors):
+    """Return (method, path, body) for one call of operation."""
+    token = f"bench{int(rng.paretovariate(1.2)) % users_count:010d}"
+    if operation == 'status':
+        return 'GET', f'/api/gamification/status/{token}', None
+    if operation == 'points':
+        action = rng.choice(list(endpoints.POINT_VALUES))
+        return 'POST', '/api/gamification/points', {
+            "token": token, "points": endpoints.POINT_VALUES[action], "action": action
+        }
+    if operation == 'achievement':
+        return 'POST', '/api/gamification/achievement', {
+            "token": token, "achievement_id": rng.choice(list(endpoints.DEFAULT_ACHIEVEMENTS))
+        }
+    if operation == 'sync':
+        body = {"token": token, "data": {
+            "achievements": rng.sample(list(endpoints.DEFAULT_ACHIEVEMENTS), 2),
+            "settings": {"notifications_enabled": rng.random() < 0.9}
+        }}
+        if token in cursors:
+            body["since"] = cursors[token]
+        return 'POST', '/api/gamification/sync', body
+    if operation == 'leaderboard':
+        return 'GET', f'/api/gamification/leaderboard?offset={rng.choice([0, 0, 0, 100, 200])}', None
+    return 'POST', '/upload_usage_data', {
+        "device": {"platform": rng.choice(["android", "ios"]), "appVersion": "1.1.5"},
+        "timestamp": datetime.now().isoformat(),
+        "events": [{"type": rng.choice(["app_open", "map_view", "photo_upload"])}
+                   for _ in range(rng.randint(1, 5))]
+    }
+
+
+def run_workload(endpoints, target, mix, users_count, requests_count, concurrency, seed):
+    """Replay requests_count calls over concurrency threads; return samples."""
+    operations = list(mix)
+    weights = [mix[name] for name in operations]
+    samples = {name: [] for name in operations}
+    errors = {name: 0 for name in operations}
+    received = {name: 0 for name in operations}
+    lock = threading.Lock()
+    remaining = [requests_count]
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        cursors = {}
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            operation = rng.choices(operations, weights)[0]
+            method, path, body = make_request(endpoints, operation, rng, users_count, cursors)
+            started = time.perf_counter()
+            try:
+                status, size = target.request(method, path, body)
+            except (OSError, http.client.HTTPException):
+                status, size = None, 0
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples[operation].append(elapsed)
+                received[operation] += size
+                if status is None or status >= 500:
+                    errors[operation] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, samples, errors, received
+
+
+def summarize(duration, samples, errors, received):
+    operations = {}
+    for name, values in samples.items():
+        values.sort()
+        operations[name] = {
+            "count": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / duration if duration else None,
+            "mean_ms": sum(values) / len(values) * 1000 if values else None,
+            "p50_ms": percentile(values, 0.50) * 1000 if values else None,
+            "p95_ms": percentile(values, 0.95) * 1000 if values else None,
+            "p99_ms": percentile(values, 0.99) * 1000 if values else None,
+            "bytes_received": received[name],
+        }
+    every = sorted(v for values in samples.values() for v in values)
+    overall = {
+        "count": len(every),
+        "errors": sum(errors.values()),
+        "throughput": len(every) / duration if duration else None,
+        "p50_ms": percentile(every, 0.50) * 1000 if every else None,
+        "p95_ms": percentile(every, 0.95) * 1000 if every else None,
+        "p99_ms": percentile(every, 0.99) * 1000 if every else None,
+    }
+    return overall, operations
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ============================================
+# RUNS
+# ============================================
+
+def run_population(args, users_count):
+    """Seed one population, run the workload against it; return the result."""
+    workdir = args.workdir or tempfile.mkdtemp(prefix=f'fody-load-{users_count}-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ['FODY_STORAGE_BACKEND'] = args.backend
+    if not args.rate_limits:
+        os.environ['FODY_SHED_MAX_IN_FLIGHT'] = str(1 << 30)
+    sys.path.insert(0, REPO_DIR)
+    import endpoints
+    if not args.rate_limits:
+        # The workload comes from one address and a few tokens; lift the
+        # limits here and, through the environment, in a launched server
+        endpoints.rate_limiters.clear()
+        os.environ['FODY_RATE_LIMITS'] = json.dumps({route: {} for route in endpoints.RATE_LIMITS})
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    events = seed_population(endpoints, users_count, args.backend, rng)
+    seed_seconds = time.perf_counter() - started
+    print(f"Seeded {users_count} users, {events} events in {seed_seconds:.1f}s ({workdir})",
+          file=sys.stderr)
+
+    process = None
+    if args.target == 'client':
+        target = ClientTarget(endpoints.create_app())
+        pid = os.getpid()
+    elif args.target == 'server':
+        process, url = launch_server(workdir, args.backend)
+        target = HttpTarget(url)
+        pid = process.pid
+    else:
+        target = HttpTarget(args.target)
+        pid = None
+
+    data_before = directory_size(workdir)
+    written_before = process_write_bytes(pid) if pid else None
+    try:
+        duration, samples, errors, received = run_workload(
+            endpoints, target, parse_mix(args.mix), users_count, args.requests,
+            args.concurrency, args.seed
+        )
+        rss = process_rss(pid) if pid else None
+        written_after = process_write_bytes(pid) if pid else None
+        if args.target == 'client':
+            # Let write-behind stores reach the disk before measuring it
+            endpoints.storage.close()
+            endpoints.event_log.close()
+            endpoints.usage_ingestor.close()
+    finally:
+        if process is not None:
+            stop_server(process)
+    data_growth = directory_size(workdir) - data_before
+
+    overall, operations = summarize(duration, samples, errors, received)
+    disk_written = None if written_before is None or written_after is None \
+        else written_after - written_before
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(),
+        "target": args.target,
+        "backend": args.backend,
+        "users": users_count,
+        "events_seeded": events,
+        "seed_seconds": seed_seconds,
+        "mix": parse_mix(args.mix),
+        "concurrency": args.concurrency,
+        "duration_seconds": duration,
+        "rss_bytes": rss,
+        "disk_write_bytes": disk_written,
+        "disk_write_bytes_per_request": disk_written / overall["count"]
+        if disk_written is not None and overall["count"] else None,
+        "data_dir_growth_bytes": data_growth,
+        "data_dir_growth_per_request": data_growth / overall["count"] if overall["count"] else None,
+        "overall": overall,
+        "operations": operations,
+    }
+
+
+def print_result(result):
+    overall = result["overall"]
+    print(f"\n{result['users']} users, {result['backend']} backend, target {result['target']}: "
+          f"{overall['throughput']:.0f} req/s, p50 {overall['p50_ms']:.2f} ms, "
+          f"p95 {overall['p95_ms']:.2f} ms, p99 {overall['p99_ms']:.2f} ms, "
+          f"{overall['errors']} errors")
+    if result["rss_bytes"] is not None:
+        print(f"RSS {result['rss_bytes'] / 2 ** 20:.1f} MiB", end='')
+    if result["disk_write_bytes_per_request"] is not None:
+        print(f", {result['disk_write_bytes_per_request']:.0f} bytes written/request", end='')
+    print(f", data dir +{result['data_dir_growth_per_request'] or 0:.0f} bytes/request")
+    print(f"{'operation':<12} {'count':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, stats in result["operations"].items():
+        if not stats["count"]:
+            continue
+        print(f"{name:<12} {stats['count']:>7} {stats['throughput']:>9.0f} {stats['p50_ms']:>9.2f} "
+              f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['errors']:>7}")
+
+
+def compare(before_path, after_path):
+    """Print throughput and latency changes between two result files."""
+    with open(before_path) as f:
+        before = {(r["users"], r["backend"], r["target"]): r for r in json.load(f)}
+    with open(after_path) as f:
+        after = {(r["users"], r["backend"], r["target"]): r for r in json.load(f)}
+    print(f"{'run':<28} {'operation':<12} {'req/s':>16} {'p95 ms':>18}")
+    for key in sorted(set(before) & set(after)):
+        label = f"{key[0]} users/{key[1]}/{key[2]}"
+        rows = [("overall", before[key]["overall"], after[key]["overall"])] + [
+            (name, before[key]["operations"][name], after[key]["operations"][name])
+            for name in after[key]["operations"] if name in before[key]["operations"]
+        ]
+        for name, old, new in rows:
+            if not old["count"] or not new["count"]:
+                continue
+            print(f"{label:<28} {name:<12} "
+                  f"{old['throughput']:>7.0f}->{new['throughput']:<7.0f}{_change(old['throughput'], new['throughput']):>2} "
+                  f"{old['p95_ms']:>7.2f}->{new['p95_ms']:<7.2f}{_change(old['p95_ms'], new['p95_ms']):>2}")
+
+
+def _change(old, new):
+    return f"{(new - old) / old * 100:+.0f}%" if old else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000],
+                        help='population sizes to seed, e.g. 1000 100000 1000000')
+    parser.add_argument('--requests', type=int, default=5000, help='calls per population')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'operation weights (default {DEFAULT_MIX})')
+    parser.add_argument('--target', default='client', help='client, server or a base URL')
+    parser.add_argument('--backend', default='json', choices=['json', 'sqlite'])
+    parser.add_argument('--seed', type=int, default=42, help='random seed for data and workload')
+    parser.add_argument('--workdir', help='data directory to seed (default: a new temp dir)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the server rate limits and load shedding (lifted by default)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if len(args.users) == 1:
+        results = [run_population(args, args.users[0])]
+    else:
+        # The app keeps module-level state, so every population gets its
+        # own process
+        results = []
+        for users_count in args.users:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                output = f.name
+            argv = [sys.executable, os.path.abspath(__file__), '--users', str(users_count),
+                    '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                    '--mix', args.mix, '--target', args.target, '--backend', args.backend,
+                    '--seed', str(args.seed), '--output', output]
+            if args.rate_limits:
+                argv.append('--rate-limits')
+            subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                results.extend(json.load(f))
+            os.remove(output)
+
+    for result in results:
+        print_result(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Per-user memory of the resident user store, parsed dicts vs UserRecord
+
+Usage:
+    python benchmarks/memory.py [--users 1000000]
+
+Each representation is measured in its own process: users are built as
+users.json would parse them (no shared strings), kept in a token-keyed dict
+like JsonStorage.users, and the RSS growth is divided by the user count.
+Conversion and membership-test costs are timed on a sample.
+"""
+
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+# endpoints creates its data directories relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix='fody-bench-'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import endpoints  # noqa: E402
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("no VmRSS in /proc/self/status")
+
+
+def sample_user(i, achievements, tasks):
+    """A user record as the server stores it, with a realistic spread of unlocks."""
+    token = f"token{i:08d}"
+    user = endpoints.new_user_record(token)
+    start = datetime(2026, 1, 1) + timedelta(seconds=i * 37 % 86400, microseconds=i % 999983 + 1)
+    unlocked = achievements[:i % (len(achievements) + 1)]
+    done = tasks[:i % (len(tasks) + 1)]
+    user.update({
+        "created_at": start.isoformat(),
+        "last_active": (start + timedelta(days=i % 90, microseconds=i % 7 + 1)).isoformat(),
+        "points": i * 7 % 5000,
+        "level": 1 + i % 8,
+        "achievements": unlocked,
+        "achievement_unlocks": {
+            ach_id: (start + timedelta(hours=n, microseconds=n + 1)).isoformat() for n, ach_id in enumerate(unlocked)
+        },
+        "completed_tasks": done,
+        "task_completions": {
+            task_id: (start + timedelta(hours=n, microseconds=n + 1)).isoformat() for n, task_id in enumerate(done)
+        },
+        "total_uploads": i % 300,
+        "event_seq": i * 11,
+        "version": i % 50 + 2,
+    })
+    return token, user
+
+
+def measure(representation, users_count):
+    """Build the store in this process and return per-user bytes and timings."""
+    achievements = list(endpoints.DEFAULT_ACHIEVEMENTS)
+    tasks = list(endpoints.DEFAULT_TASKS)
+    endpoints.achievement_ids.extend(achievements)
+    endpoints.task_ids.extend(tasks)
+    gc.collect()
+    before = current_rss()
+    store = {}
+    for i in range(users_count):
+        token, user = sample_user(i, achievements, tasks)
+        # Round-trip through JSON so nothing is shared, as after load_json_fody
+        user = endpoints.loads_json(endpoints.dumps_json(user))
+        if representation == 'record':
+            # JsonStorage interns the token, shared by the key and the record
+            store[sys.intern(token)] = endpoints.UserRecord.from_dict(user)
+        else:
+            store[token] = user
+    gc.collect()
+    per_user = (current_rss() - before) / users_count
+
+    token, user = sample_user(users_count - 1, achievements, tasks)
+    record = endpoints.UserRecord.from_dict(user)
+    assert list(record.to_dict().items()) == list(user.items())
+    missing = achievements[-1] if user["achievements"] != achievements else "no_such_achievement"
+    number = 100000
+    return {
+        "representation": representation,
+        "users": users_count,
+        "bytes_per_user": round(per_user),
+        "from_dict_us": min(timeit.repeat(lambda: endpoints.UserRecord.from_dict(user), number=number // 10,
+                                          repeat=3)) / (number // 10) * 1e6,
+        "to_dict_us": min(timeit.repeat(record.to_dict, number=number // 10, repeat=3)) / (number // 10) * 1e6,
+        "list_membership_ns": min(timeit.repeat(lambda: missing in user["achievements"], number=number,
+                                                repeat=3)) / number * 1e9,
+        "bitset_membership_ns": min(timeit.repeat(lambda: record.has_achievement(missing), number=number,
+                                                  repeat=3)) / number * 1e9,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000, help='users in the store')
+    parser.add_argument('--representation', choices=['dict', 'record'],
+                        help='measure one representation in this process and print JSON')
+    args = parser.parse_args()
+
+    if args.representation:
+        print(json.dumps(measure(args.representation, args.users)))
+        return
+
+    results = []
+    for representation in ('dict', 'record'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--users', str(args.users),
+             '--representation', representation],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output))
+    print(f"{'representation':<15} {'users':>9} {'bytes/user':>11} {'store MiB':>10}")
+    for result in results:
+        print(f"{result['representation']:<15} {result['users']:>9} {result['bytes_per_user']:>11} "
+              f"{result['bytes_per_user'] * result['users'] / 2 ** 20:>10.0f}")
+    record = results[1]
+    print(f"from_dict {record['from_dict_us']:.1f} us, to_dict {record['to_dict_us']:.1f} us; "
+          f"membership: list scan {record['list_membership_ns']:.0f} ns, "
+          f"bitset {record['bitset_membership_ns']:.0f} ns")
+
+
+if __name__ == '__main__':
+    main()
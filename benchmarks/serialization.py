@@ -0,0 +1,138 @@
+"""
+Encode/decode cost and size of gamification payloads per format
+
+Usage:
+    python benchmarks/serialization.py [--users 10000] [--repeat 200]
+
+Formats that need an optional package (orjson, msgpack) are skipped when it
+is not installed. Nothing is written outside a temporary directory.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+# endpoints creates its data directories relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix='fody-bench-'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import endpoints  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def build_formats():
+    """Return {name: (encode, decode)} for every available format."""
+    formats = {
+        "json-indent": (
+            lambda data: json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8'),
+            json.loads
+        ),
+        "json-compact": (
+            lambda data: json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            json.loads
+        ),
+    }
+    if orjson is not None:
+        formats["orjson"] = (lambda data: orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), orjson.loads)
+    if msgpack is not None:
+        formats["msgpack"] = (
+            lambda data: msgpack.packb(data, use_bin_type=True),
+            lambda raw: msgpack.unpackb(raw, strict_map_key=False)
+        )
+    return formats
+
+
+def sample_user(i, achievements, tasks):
+    """A user record with a realistic spread of unlocks."""
+    user = endpoints.new_user_record(f"token{i:08d}")
+    ts = datetime(2026, 1, 1).isoformat()
+    unlocked = list(achievements)[:i % len(achievements) + 1]
+    done = list(tasks)[:i % len(tasks)]
+    user.update({
+        "points": i * 7 % 5000,
+        "achievements": unlocked,
+        "achievement_unlocks": {ach_id: ts for ach_id in unlocked},
+        "completed_tasks": done,
+        "task_completions": {task_id: ts for task_id in done},
+        "total_uploads": i % 300,
+        "event_seq": i,
+    })
+    return user
+
+
+def build_payloads(users_count):
+    """Return {name: payload} covering the main responses and stored files."""
+    achievements = endpoints.DEFAULT_ACHIEVEMENTS
+    tasks = endpoints.DEFAULT_TASKS
+    users = {f"token{i:08d}": sample_user(i, achievements, tasks) for i in range(users_count)}
+    token, user = next(iter(users.items()))
+    start = datetime(2026, 1, 1)
+    events = [
+        {"seq": i, "ts": (start + timedelta(minutes=i)).isoformat(), "token": token,
+         "type": "points", "action": "photo_upload", "amount": 10, "details": {}}
+        for i in range(100)
+    ]
+    return {
+        "GET /info": {
+            "achievements": achievements,
+            "tasks": tasks,
+            "point_values": endpoints.POINT_VALUES,
+            "level_formula": {"description": "Level = floor(sqrt(points / 100)) + 1",
+                              "example": {0: 1, 100: 2, 400: 3, 900: 4, 1600: 5}},
+        },
+        "GET /status": endpoints.build_user_status(token, user, achievements, tasks),
+        "GET /leaderboard": {
+            "leaderboard": [
+                endpoints.leaderboard_entry(rank, f"token{rank:08d}", 5000 - rank, rank % 12)
+                for rank in range(1, 101)
+            ],
+            "offset": 0, "limit": 100, "total_users": users_count,
+        },
+        "GET /history": {"token": token, "events": events, "next_since": 99},
+        "POST /sync (delta)": {
+            "success": True, "new_achievements": [], "new_tasks": [], "points_earned": 0,
+            "cursor": 99, "full": False, "changes": endpoints.summarize_events(events),
+            "points": 1000, "level": 4,
+        },
+        f"users.json ({users_count} users)": users,
+    }
+
+
+def measure(func, arg, repeat):
+    """Return the best per-call time in microseconds."""
+    number = max(1, repeat)
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='users in the users.json payload')
+    parser.add_argument('--repeat', type=int, default=200, help='calls per timing run')
+    args = parser.parse_args()
+
+    formats = build_formats()
+    print(f"{'payload':<26} {'format':<13} {'bytes':>10} {'encode us':>11} {'decode us':>11}")
+    for name, payload in build_payloads(args.users).items():
+        # Large payloads get proportionally fewer calls
+        repeat = args.repeat if not name.startswith('users.json') else max(1, args.repeat // 100)
+        for format_name, (encode, decode) in formats.items():
+            raw = encode(payload)
+            print(f"{name:<26} {format_name:<13} {len(raw):>10} "
+                  f"{measure(encode, payload, repeat):>11.1f} {measure(decode, raw, repeat):>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
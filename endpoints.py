@@ -4,27 +4,96 @@ Provides API for points, achievements, tasks, and syncing gamification data
 
 Usage:
     python endpoints.py
+    FODY_STORAGE_BACKEND=sqlite python endpoints.py
+    FODY_STORAGE_BACKEND=sqlite gunicorn -w 4 -b 0.0.0.0:5000 'endpoints:create_app()'
+
+POST endpoints accept an Idempotency-Key header: a retry with the same key
+(and token) gets the first response back instead of being applied again;
+one sent while the first is still running gets 409.
+
+Behind a reverse proxy, set FODY_TRUSTED_PROXIES to the number of proxies
+so per-IP rate limits see the client's address rather than the proxy's.
+
+Optional packages: orjson (faster JSON encoding), msgpack (responses for
+clients sending Accept: application/msgpack), brotli (br compression),
+numpy (vectorised level recomputation).
 
 Endpoints:
     GET  /api/gamification/status/<token>     - Get user status (points, achievements)
     POST /api/gamification/points              - Add points
     POST /api/gamification/achievement         - Unlock achievement
     POST /api/gamification/task               - Complete task
+    POST /api/gamification/events             - Apply a batch of queued events
     POST /api/gamification/sync               - Full sync (POST)
-    GET  /api/gamification/leaderboard        - Get leaderboard
+    GET  /api/gamification/leaderboard        - Get leaderboard (?window=week|month|period)
+    GET  /api/gamification/rank/<token>       - Get user's rank and neighbours
+    GET  /api/gamification/history/<token>    - Get user's event history
+    GET  /api/gamification/stream/<token>     - Server-Sent Events notifications
+    GET  /api/gamification/analytics          - Unlock rates, level histogram, daily actives
     POST /api/gamification/settings           - Update settings
     GET  /api/gamification/info               - Get gamification info
+    GET  /metrics                             - Prometheus metrics
+    GET  /admin/profiler                      - Request profiler state (admin)
+    POST /admin/profiler                      - Configure the request profiler (admin)
+    POST /admin/achievements/backfill         - Unlock rule-based achievements for existing users (admin)
+    POST /admin/levels                        - Preview or apply a new level curve (admin)
 """
 
-from flask import Flask, request, jsonify
+from flask import (Blueprint, Flask, Response, current_app, g, has_request_context, request, jsonify,
+                   make_response, send_from_directory, stream_with_context)
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+import atexit
+import base64
+import cProfile
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
 import json
+import math
 import os
-from datetime import datetime
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import uuid
 
-app = Flask(__name__)
-CORS(app)
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process file locking
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # MessagePack responses are unavailable
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # Only gzip compression is offered
+    brotli = None
+
+try:
+    import numpy
+except ImportError:  # Bulk level recomputation falls back to bisect per user
+    numpy = None
+
+bp = Blueprint('fody', __name__)
 
 # Base directory for data files
 DATA_DIR = 'gamification_data'
@@ -32,13 +101,68 @@ DATA_DIR = 'gamification_data'
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Usage data ingestion: uploads are queued in memory and a writer thread
+# appends them in batches to newline-delimited segment files in USAGE_DIR,
+# starting a new segment once the current one exceeds the size or age limit
+USAGE_STATS_FILE = os.path.join(DATA_DIR, 'usage_stats.json')
+USAGE_DIR = os.path.join(DATA_DIR, 'usage')
+USAGE_QUEUE_SIZE = int(os.environ.get('FODY_USAGE_QUEUE_SIZE', '10000'))
+USAGE_BATCH_SIZE = int(os.environ.get('FODY_USAGE_BATCH_SIZE', '500'))
+USAGE_SEGMENT_MAX_BYTES = int(os.environ.get('FODY_USAGE_SEGMENT_MAX_BYTES', str(64 * 1024 * 1024)))
+USAGE_SEGMENT_MAX_AGE = float(os.environ.get('FODY_USAGE_SEGMENT_MAX_AGE', '3600'))
+
+# Hourly/daily usage rollups, kept up to date by the writer and saved every
+# USAGE_ROLLUPS_SAVE_INTERVAL seconds
+USAGE_ROLLUPS_FILE = os.path.join(DATA_DIR, 'usage_rollups.json')
+USAGE_ROLLUPS_SAVE_INTERVAL = float(os.environ.get('FODY_USAGE_ROLLUPS_SAVE_INTERVAL', '60'))
+
+# What to do with an upload when the queue is full: 'reject' answers 503
+# straight away, 'block' waits up to USAGE_QUEUE_BLOCK_TIMEOUT seconds for
+# room first, 'drop_oldest' discards the oldest queued record
+USAGE_QUEUE_POLICY = os.environ.get('FODY_USAGE_QUEUE_POLICY', 'reject')
+USAGE_QUEUE_BLOCK_TIMEOUT = float(os.environ.get('FODY_USAGE_QUEUE_BLOCK_TIMEOUT', '1'))
+
 # File paths - using fody-specific directory to avoid conflicts
 FODY_DATA_DIR = 'fody_gamification_data'
 FODY_POINTS_FILE = os.path.join(FODY_DATA_DIR, 'points.json')
 FODY_ACHIEVEMENTS_FILE = os.path.join(FODY_DATA_DIR, 'achievements.json')
 FODY_TASKS_FILE = os.path.join(FODY_DATA_DIR, 'tasks.json')
+FODY_ACHIEVEMENT_RULES_FILE = os.path.join(FODY_DATA_DIR, 'achievement_rules.json')
+FODY_LEVELS_FILE = os.path.join(FODY_DATA_DIR, 'levels.json')
 FODY_USERS_FILE = os.path.join(FODY_DATA_DIR, 'users.json')
 FODY_SETTINGS_FILE = os.path.join(FODY_DATA_DIR, 'settings.json')
+FODY_DB_FILE = os.path.join(FODY_DATA_DIR, 'fody.db')
+FODY_IDEMPOTENCY_FILE = os.path.join(FODY_DATA_DIR, 'idempotency.json')
+
+# Responses to POSTs carrying an Idempotency-Key are kept for
+# IDEMPOTENCY_TTL seconds (at most IDEMPOTENCY_MAX_KEYS of them) and
+# replayed to retries instead of applying them again
+IDEMPOTENCY_TTL = float(os.environ.get('FODY_IDEMPOTENCY_TTL', str(24 * 3600)))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('FODY_IDEMPOTENCY_MAX_KEYS', '100000'))
+# A key is reserved while its first request runs; the reservation lapses
+# after IDEMPOTENCY_PENDING_TTL seconds should that request never finish
+IDEMPOTENCY_PENDING_TTL = float(os.environ.get('FODY_IDEMPOTENCY_PENDING_TTL', '60'))
+# Status stored for a reserved key (never a real HTTP status)
+IDEMPOTENCY_PENDING = 0
+
+# Storage backend for users: 'json' keeps everything in users.json (fine for
+# small installs), 'sqlite' uses an embedded database in WAL mode
+STORAGE_BACKEND = os.environ.get('FODY_STORAGE_BACKEND', 'json')
+
+# Write-behind tuning for the resident user store: dirty users are flushed
+# every USERS_FLUSH_INTERVAL seconds, or sooner once USERS_FLUSH_MAX_DIRTY
+# users are waiting to be written
+USERS_FLUSH_INTERVAL = float(os.environ.get('FODY_USERS_FLUSH_INTERVAL', '5'))
+USERS_FLUSH_MAX_DIRTY = int(os.environ.get('FODY_USERS_FLUSH_MAX_DIRTY', '1000'))
+
+# Append-only log of points/achievement/task/settings events. Appends are
+# fsynced every EVENTS_FSYNC_BATCH events or EVENTS_FSYNC_INTERVAL seconds;
+# compaction drops snapshotted events older than EVENTS_RETENTION_DAYS
+FODY_EVENTS_FILE = os.path.join(FODY_DATA_DIR, 'events.log')
+EVENTS_FSYNC_BATCH = int(os.environ.get('FODY_EVENTS_FSYNC_BATCH', '100'))
+EVENTS_FSYNC_INTERVAL = float(os.environ.get('FODY_EVENTS_FSYNC_INTERVAL', '1'))
+EVENTS_RETENTION_DAYS = int(os.environ.get('FODY_EVENTS_RETENTION_DAYS', '365'))
+EVENTS_COMPACT_INTERVAL = float(os.environ.get('FODY_EVENTS_COMPACT_INTERVAL', str(24 * 3600)))
 
 # Ensure fody data directory exists
 os.makedirs(FODY_DATA_DIR, exist_ok=True)
@@ -159,6 +283,39 @@ DEFAULT_ACHIEVEMENTS = {
     }
 }
 
+# Server-side unlock rules, keyed by achievement id. A rule is evaluated
+# after each points event whose action is listed in "actions" ("*" matches
+# any action) and unlocks the achievement when every condition holds:
+#   "counter" / "at_least"     user counter (e.g. total_uploads) reaches a value
+#   "hours": [from, to]        event hour is in [from, to), may wrap midnight
+#   "weekdays": [...]          event weekday, 0 = Monday
+#   "within_session_seconds"   at most N seconds since the last app_open
+#   "details": {key: value}    the event's details carry these values
+# Hours and weekdays are read on the client's clock when the points event
+# carries utc_offset (minutes east of UTC), else on the server's. The
+# server is the source of truth for night_owl, early_bird and
+# weekend_warrior: App.js only sends its offset and never unlocks them.
+# App.js posts an app_open points event at startup, which starts the
+# session speed_demon measures, and reports uploads as photo_upload with
+# hasNote/hasReference details (the bonuses folded into the amount).
+# Achievements without a rule can still be unlocked by the client.
+PHOTO_UPLOAD_ACTIONS = ["photo_upload", "photo_upload_with_note", "photo_upload_with_reference"]
+
+DEFAULT_ACHIEVEMENT_RULES = {
+    "first_login": {"actions": ["app_open"]},
+    "first_photo": {"actions": PHOTO_UPLOAD_ACTIONS},
+    "map_navigation": {"actions": ["map_view"]},
+    "note_creator": {"actions": ["osm_note_create"]},
+    "photo_collector_10": {"actions": ["photo_upload"], "counter": "total_uploads", "at_least": 10},
+    "photo_collector_50": {"actions": ["photo_upload"], "counter": "total_uploads", "at_least": 50},
+    "night_owl": {"actions": ["*"], "hours": [22, 24]},
+    "early_bird": {"actions": ["*"], "hours": [0, 6]},
+    "weekend_warrior": {"actions": ["*"], "weekdays": [5, 6]},
+    "speed_demon": {"actions": PHOTO_UPLOAD_ACTIONS, "within_session_seconds": 30},
+    "quality_contributor": {"actions": ["photo_upload"], "details": {"hasNote": True}},
+    "settings_guru": {"actions": ["settings_view"]}
+}
+
 # Default tasks for exploration
 DEFAULT_TASKS = {
     "task_first_upload": {
@@ -211,6 +368,95 @@ DEFAULT_TASKS = {
     }
 }
 
+# Number of rendered /status bodies kept in memory
+STATUS_CACHE_SIZE = int(os.environ.get('FODY_STATUS_CACHE_SIZE', '10000'))
+
+# Maximum number of events accepted by one /api/gamification/events batch
+MAX_BATCH_EVENTS = int(os.environ.get('FODY_MAX_BATCH_EVENTS', '500'))
+
+# Server-Sent Events notification streams: each user's last
+# STREAM_BACKLOG_SIZE notifications are kept (for up to STREAM_BACKLOG_TOKENS
+# users) so reconnecting clients can resume; idle streams get a heartbeat
+# every STREAM_HEARTBEAT_INTERVAL seconds and ranks are re-checked every
+# STREAM_RANK_INTERVAL seconds
+STREAM_BACKLOG_SIZE = int(os.environ.get('FODY_STREAM_BACKLOG_SIZE', '20'))
+STREAM_BACKLOG_TOKENS = int(os.environ.get('FODY_STREAM_BACKLOG_TOKENS', '10000'))
+STREAM_SUBSCRIBER_BUFFER = int(os.environ.get('FODY_STREAM_SUBSCRIBER_BUFFER', '100'))
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get('FODY_STREAM_MAX_SUBSCRIBERS', '5000'))
+STREAM_HEARTBEAT_INTERVAL = float(os.environ.get('FODY_STREAM_HEARTBEAT_INTERVAL', '15'))
+STREAM_RANK_INTERVAL = float(os.environ.get('FODY_STREAM_RANK_INTERVAL', '5'))
+
+# Response bodies of at least COMPRESS_MIN_SIZE bytes are sent gzip or
+# brotli compressed to clients that accept it
+COMPRESS_MIN_SIZE = int(os.environ.get('FODY_COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('FODY_COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('FODY_COMPRESS_BROTLI_QUALITY', '5'))
+
+# Token required (X-Admin-Token header) by /admin endpoints; unset disables them
+ADMIN_TOKEN = os.environ.get('FODY_ADMIN_TOKEN')
+
+# On-demand request profiling: captured profiles go to PROFILE_DIR, at most
+# PROFILE_MAX_FILES of at most PROFILE_MAX_BYTES each; the stack sampler
+# takes a sample every PROFILE_SAMPLE_INTERVAL seconds and the collapsed
+# aggregate keeps at most PROFILE_MAX_STACKS distinct stacks
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+PROFILE_MAX_FILES = int(os.environ.get('FODY_PROFILE_MAX_FILES', '100'))
+PROFILE_MAX_BYTES = int(os.environ.get('FODY_PROFILE_MAX_BYTES', str(1024 * 1024)))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('FODY_PROFILE_SAMPLE_INTERVAL', '0.001'))
+PROFILE_MAX_STACKS = int(os.environ.get('FODY_PROFILE_MAX_STACKS', '10000'))
+
+# Largest points value one /points call may award
+MAX_POINTS_PER_AWARD = int(os.environ.get('FODY_MAX_POINTS_PER_AWARD', '100'))
+# Largest client UTC offset accepted, in minutes (UTC+14 is the extreme)
+MAX_UTC_OFFSET = 14 * 60
+
+# Token-bucket limits per route, by client token and by IP, as
+# [requests, seconds]; FODY_RATE_LIMITS (JSON, same shape) replaces the
+# limits of the routes it names. Each limiter tracks at most
+# RATE_LIMIT_MAX_KEYS clients
+DEFAULT_RATE_LIMITS = {
+    "/api/gamification/points": {"token": [60, 60], "ip": [600, 60]},
+    "/api/gamification/events": {"token": [600, 60], "ip": [3000, 60]},
+    "/api/gamification/sync": {"token": [10, 60], "ip": [100, 60]},
+    "/api/gamification/achievement": {"token": [30, 60], "ip": [300, 60]},
+    "/api/gamification/task": {"token": [30, 60], "ip": [300, 60]},
+    "/api/gamification/settings": {"token": [10, 60], "ip": [100, 60]},
+    "/api/gamification/initialize": {"ip": [30, 60]},
+    "/upload_usage_data": {"ip": [120, 60]},
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.environ.get('FODY_RATE_LIMITS', '{}'))}
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('FODY_RATE_LIMIT_MAX_KEYS', '100000'))
+# Reverse proxies in front of the server (1 behind the fluffini.cz nginx).
+# The client IP is taken that many hops back in X-Forwarded-For; with 0
+# the header is ignored, since clients could forge it
+TRUSTED_PROXIES = int(os.environ.get('FODY_TRUSTED_PROXIES', '0'))
+
+# Load shedding: requests are answered 429 while SHED_MAX_IN_FLIGHT are
+# already being served, and writes too while the usage queue holds
+# SHED_MAX_QUEUE_DEPTH records
+SHED_MAX_IN_FLIGHT = int(os.environ.get('FODY_SHED_MAX_IN_FLIGHT', '64'))
+SHED_MAX_QUEUE_DEPTH = int(os.environ.get('FODY_SHED_MAX_QUEUE_DEPTH', str(USAGE_QUEUE_SIZE * 3 // 4)))
+SHED_RETRY_AFTER = int(os.environ.get('FODY_SHED_RETRY_AFTER', '1'))
+
+# Number of rendered leaderboard pages kept (per page, limit and format)
+LEADERBOARD_CACHE_SIZE = int(os.environ.get('FODY_LEADERBOARD_CACHE_SIZE', '256'))
+
+# Time-windowed leaderboards (week, month and project period of
+# PROJECT_PERIOD_MONTHS months); the last LEADERBOARD_WINDOW_RETENTION
+# closed windows of each kind are kept as frozen snapshots. Periods tile
+# the calendar year, so PROJECT_PERIOD_MONTHS must divide 12
+LEADERBOARD_WINDOW_DIR = os.path.join(FODY_DATA_DIR, 'leaderboards')
+LEADERBOARD_WINDOW_RETENTION = int(os.environ.get('FODY_LEADERBOARD_WINDOW_RETENTION', '12'))
+PROJECT_PERIOD_MONTHS = int(os.environ.get('FODY_PROJECT_PERIOD_MONTHS', '3'))
+if PROJECT_PERIOD_MONTHS < 1 or 12 % PROJECT_PERIOD_MONTHS:
+    raise ValueError(f"FODY_PROJECT_PERIOD_MONTHS must divide 12, got {PROJECT_PERIOD_MONTHS}")
+
+# Population analytics: distinct active users are counted for the last
+# ANALYTICS_ACTIVE_DAYS days; the incremental counters are verified against
+# a full rebuild from storage every ANALYTICS_REBUILD_INTERVAL seconds
+ANALYTICS_ACTIVE_DAYS = int(os.environ.get('FODY_ANALYTICS_ACTIVE_DAYS', '30'))
+ANALYTICS_REBUILD_INTERVAL = float(os.environ.get('FODY_ANALYTICS_REBUILD_INTERVAL', '3600'))
+
 # Point values for actions
 POINT_VALUES = {
     "photo_upload": 10,
@@ -223,442 +469,3362 @@ POINT_VALUES = {
     "settings_view": 1
 }
 
+# Level curve: thresholds[n] is the points needed for level n + 1, so the
+# list starts at 0 and strictly increases; the last entry is the top level.
+# The default follows level = floor(sqrt(points / 100)) + 1
+DEFAULT_LEVEL_THRESHOLDS = [100 * level * level for level in range(100)]
+
+
+# ============================================
+# METRICS
+# ============================================
+
+class Metrics:
+    """Counters and histograms for the /metrics endpoint.
+
+    Values are spread over lock stripes picked by thread id, so concurrent
+    requests rarely contend and recording stays cheap enough to leave on in
+    production. A scrape sums the stripes. Each worker process keeps its
+    own metrics.
+    """
+
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, stripes=16):
+        self.descriptions = {}
+        self._stripes = [(threading.Lock(), {}, {}) for _ in range(stripes)]
+
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+
+    def _stripe(self):
+        return self._stripes[threading.get_ident() % len(self._stripes)]
+
+    def inc(self, name, labels=(), amount=1):
+        """Add amount to a counter; labels is a tuple of (name, value) pairs."""
+        lock, counters, _ = self._stripe()
+        key = (name, labels)
+        with lock:
+            counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Record value in a histogram with LATENCY_BUCKETS."""
+        lock, _, histograms = self._stripe()
+        key = (name, labels)
+        with lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts, +Inf count, then the sum
+                histogram = histograms[key] = [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(self.LATENCY_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Return ({(name, labels): total}, {(name, labels): histogram})."""
+        counters = {}
+        histograms = {}
+        for lock, stripe_counters, stripe_histograms in self._stripes:
+            with lock:
+                for key, value in stripe_counters.items():
+                    counters[key] = counters.get(key, 0) + value
+                for key, histogram in stripe_histograms.items():
+                    total = histograms.setdefault(key, [0] * len(histogram))
+                    for i, value in enumerate(histogram):
+                        total[i] += value
+        return counters, histograms
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_prometheus(metrics, gauges):
+    """Render metrics plus [(name, help, [(labels, value)])] gauges as text."""
+    counters, histograms = metrics.snapshot()
+    lines = []
+    families = {}
+    for (name, labels), value in counters.items():
+        families.setdefault(name, []).append((labels, value))
+    for (name, labels), histogram in histograms.items():
+        families.setdefault(name, []).append((labels, histogram))
+    for name in sorted(families):
+        kind, help_text = metrics.descriptions.get(name, ('untyped', ''))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(families[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metrics.LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    for name, help_text, samples in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('fody_http_requests_total', 'counter', 'HTTP requests by route, method and status')
+metrics.describe('fody_http_request_seconds', 'histogram', 'Time to produce a response, by route')
+metrics.describe('fody_storage_seconds', 'histogram', 'Time spent loading or saving a JSON file')
+metrics.describe('fody_storage_bytes_total', 'counter', 'Bytes read or written by JSON file loads and saves')
+metrics.describe('fody_storage_operations_total', 'counter', 'JSON file loads and saves')
+metrics.describe('fody_event_log_fsync_seconds', 'histogram', 'Time spent fsyncing the event log')
+metrics.describe('fody_event_log_bytes_total', 'counter', 'Bytes appended to the event log by this process')
+metrics.describe('fody_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit/miss)')
+metrics.describe('fody_render_seconds', 'histogram', 'Time to build and serialise a cached body on a miss')
+metrics.describe('fody_analytics_drift_total', 'counter', 'Analytics counters found wrong by a full rebuild')
+metrics.describe('fody_rate_limited_total', 'counter', 'Requests answered 429, by route and reason')
+
+
+# ============================================
+# SERIALISATION
+# ============================================
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def dumps_json(data, pretty=False):
+    """Encode data as compact UTF-8 JSON bytes (indented if pretty)."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(data, option=option)
+    if pretty:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads_json(raw):
+    """Decode JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def response_mimetype():
+    """Return the response format negotiated from the Accept header."""
+    if msgpack is None or not has_request_context():
+        return JSON_MIMETYPE
+    best = request.accept_mimetypes.best_match(
+        [JSON_MIMETYPE, MSGPACK_MIMETYPE, 'application/x-msgpack'], default=JSON_MIMETYPE
+    )
+    return JSON_MIMETYPE if best == JSON_MIMETYPE else MSGPACK_MIMETYPE
+
+
+def serialize(data, mimetype=JSON_MIMETYPE):
+    """Encode a response body in the given format."""
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(data, use_bin_type=True)
+    return dumps_json(data) + b'\n'
+
+
+COMPRESSIBLE_MIMETYPES = {JSON_MIMETYPE, MSGPACK_MIMETYPE, 'application/x-ndjson'}
+
+
+def response_encoding():
+    """Return the Content-Encoding negotiated from Accept-Encoding, or None."""
+    if not has_request_context():
+        return None
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+
+def compress(body, encoding):
+    """Compress a body with 'br' or 'gzip'."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding, flush_size=64 * 1024):
+    """Compress a streamed body, flushing output every flush_size input bytes."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # gzip container
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    pending = 0
+    for chunk in chunks:
+        data = process(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += flush()
+            pending = 0
+        if data:
+            yield data
+    yield finish()
+
+
+class EncodedBody:
+    """A rendered response body plus compressed copies made on first use.
+
+    Cached bodies keep their compressed forms, so compression runs once per
+    change of the content rather than once per request.
+    """
+
+    def __init__(self, body, mimetype=JSON_MIMETYPE):
+        self.body = body
+        self.mimetype = mimetype
+        self._encoded = {}
+
+    def response(self, etag=None):
+        """Build a response in the request's negotiated encoding."""
+        response = Response(mimetype=self.mimetype)
+        response.vary.add('Accept')
+        encoding = None
+        if len(self.body) >= COMPRESS_MIN_SIZE:
+            response.vary.add('Accept-Encoding')
+            encoding = response_encoding()
+        if encoding is None:
+            response.set_data(self.body)
+        else:
+            data = self._encoded.get(encoding)
+            if data is None:
+                data = self._encoded[encoding] = compress(self.body, encoding)
+            response.set_data(data)
+            response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            # Each encoding is a different representation with its own tag
+            response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+        return response
+
+
+class FodyJSONProvider(DefaultJSONProvider):
+    """Routes jsonify and request parsing through the shared encoder.
+
+    jsonify answers with MessagePack when the client asks for it.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return dumps_json(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads_json(s)
+
+    def response(self, *args, **kwargs):
+        mimetype = response_mimetype()
+        response = self._app.response_class(
+            serialize(self._prepare_response_obj(args, kwargs), mimetype), mimetype=mimetype
+        )
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+
 
 def ensure_file(filepath, default=None):
     """Ensure file exists, create with default if not."""
     if not os.path.exists(filepath):
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(default if default is not None else {}, f, ensure_ascii=False, indent=2)
+        # Catalogs and settings are edited by hand, so keep them readable
+        save_json_fody(filepath, default if default is not None else {}, pretty=True)
 
 
 def load_json_fody(filepath):
     """Load JSON from fody-specific file."""
     ensure_file(filepath)
+    labels = (("op", "load"), ("file", os.path.basename(filepath)))
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
+        with metrics.timer('fody_storage_seconds', labels):
+            with open(filepath, 'rb') as f:
+                raw = f.read()
+            metrics.inc('fody_storage_operations_total', labels)
+            metrics.inc('fody_storage_bytes_total', labels, len(raw))
+            return loads_json(raw)
+    except (ValueError, IOError):
         return {}
 
 
-def save_json_fody(filepath, data):
-    """Save data to fody-specific JSON file."""
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def save_json_fody(filepath, data, pretty=False):
+    """Save data to fody-specific JSON file.
 
+    The data is written and fsynced to a temporary file that is then renamed
+    over the target, so a crash mid-write never leaves a truncated file and
+    readers only ever see the old or the new content.
+    """
+    _save_chunks(filepath, lambda: [dumps_json(data, pretty)])
 
-def get_user_data(token):
-    """Get user data by token from fody-specific storage."""
-    users = load_json_fody(FODY_USERS_FILE)
-    if token not in users:
-        # Create new user
-        users[token] = {
-            "token": token,
-            "created_at": datetime.now().isoformat(),
-            "points": 0,
-            "level": 1,
-            "achievements": [],
-            "completed_tasks": [],
-            "total_uploads": 0,
-            "total_notes": 0,
-            "last_active": datetime.now().isoformat(),
-            "settings": {
-                "gamification_enabled": True,
-                "notifications_enabled": True
-            }
+
+def save_json_members(filepath, items, chunk_size=1 << 20):
+    """Save (key, value) pairs as one JSON object, encoding a member at a time.
+
+    Written atomically like save_json_fody, but the document never exists
+    in memory as a whole - only about chunk_size bytes of it at once.
+    """
+    def chunks():
+        chunk = bytearray(b'{')
+        for i, (key, value) in enumerate(items):
+            if i:
+                chunk += b','
+            chunk += dumps_json(key) + b':' + dumps_json(value)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = bytearray()
+        yield chunk + b'}'
+    _save_chunks(filepath, chunks)
+
+
+def _save_chunks(filepath, chunks):
+    tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    labels = (("op", "save"), ("file", os.path.basename(filepath)))
+    size = 0
+    try:
+        with metrics.timer('fody_storage_seconds', labels):
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks():
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, filepath)
+        metrics.inc('fody_storage_operations_total', labels)
+        metrics.inc('fody_storage_bytes_total', labels, size)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def new_user_record(token):
+    """Build the record stored for a token seen for the first time."""
+    now = datetime.now().isoformat()
+    return {
+        "token": token,
+        "created_at": now,
+        "points": 0,
+        "level": 1,
+        "achievements": [],
+        "completed_tasks": [],
+        "total_uploads": 0,
+        "total_notes": 0,
+        "last_active": now,
+        "version": 1,
+        "settings": {
+            "gamification_enabled": True,
+            "notifications_enabled": True
         }
-        save_json_fody(FODY_USERS_FILE, users)
-    return users[token]
+    }
 
 
-def update_user_data(token, data):
-    """Update user data in fody-specific storage."""
-    users = load_json_fody(FODY_USERS_FILE)
-    if token in users:
-        users[token].update(data)
-        users[token]["last_active"] = datetime.now().isoformat()
-        save_json_fody(FODY_USERS_FILE, users)
-    return users.get(token, {})
+def merge_user_changes(user, changes):
+    """Return user with changes applied, last_active refreshed and version bumped."""
+    return {
+        **user,
+        **changes,
+        "last_active": datetime.now().isoformat(),
+        "version": user.get("version", 0) + 1
+    }
 
 
-def calculate_level(points):
-    """Calculate level from points."""
-    # Level formula: level = floor(sqrt(points / 100))
-    if points < 100:
-        return 1
-    return int((points ** 0.5) // 10) + 1
+def _copy_user(user):
+    """Copy a user record deep enough that callers can mutate it freely."""
+    return {
+        key: value.copy() if isinstance(value, (dict, list)) else value
+        for key, value in user.items()
+    }
 
 
-def calculate_level_progress(points):
-    """Calculate progress to next level (0-100)."""
-    current_level = calculate_level(points)
-    points_for_current = (current_level - 1) * 100
-    points_for_next = current_level * 100
-    if points >= points_for_next:
-        return 100
-    progress = ((points - points_for_current) / (points_for_next - points_for_current)) * 100
-    return min(100, max(0, progress))
+class IdTable:
+    """Append-only mapping of achievement or task ids to bit positions.
 
+    Seeded in catalog order; ids seen later (added to the catalog, or
+    dropped from it but still held by users) are appended, so a position
+    never changes while records in memory use it.
+    """
 
-# ============================================
-# API ENDPOINTS
-# ============================================
+    def __init__(self):
+        self.positions = {}
+        self.ids = []
+        self._lock = threading.Lock()
 
-@app.route('/api/gamification/info', methods=['GET'])
-def get_gamification_info():
-    """Get gamification information - achievements, tasks, point values."""
-    ensure_file(FODY_ACHIEVEMENTS_FILE, DEFAULT_ACHIEVEMENTS)
-    ensure_file(FODY_TASKS_FILE, DEFAULT_TASKS)
-    
-    return jsonify({
-        "achievements": load_json_fody(FODY_ACHIEVEMENTS_FILE),
-        "tasks": load_json_fody(FODY_TASKS_FILE),
-        "point_values": POINT_VALUES,
-        "level_formula": {
-            "description": "Level = floor(sqrt(points / 100)) + 1",
-            "example": {
-                0: 1,
-                100: 2,
-                400: 3,
-                900: 4,
-                1600: 5
-            }
-        }
-    }), 200
+    def position(self, item_id):
+        position = self.positions.get(item_id)
+        if position is None:
+            with self._lock:
+                position = self.positions.get(item_id)
+                if position is None:
+                    position = self.positions[item_id] = len(self.ids)
+                    self.ids.append(sys.intern(item_id))
+        return position
 
+    def extend(self, item_ids):
+        for item_id in item_ids:
+            self.position(item_id)
 
-@app.route('/api/gamification/status/<token>', methods=['GET'])
-def get_user_status(token):
-    """Get user's gamification status."""
-    if not token or len(token) < 8:
-        return jsonify({"error": "Invalid token"}), 400
-    
-    user = get_user_data(token)
-    
-    # Calculate level
-    points = user.get("points", 0)
-    level = calculate_level(points)
-    level_progress = calculate_level_progress(points)
-    
-    # Get next level info
-    points_for_next_level = level * 100
-    points_needed = max(0, points_for_next_level - points)
-    
-    # Get unlocked achievements
-    achievement_ids = user.get("achievements", [])
-    all_achievements = load_json_fody(FODY_ACHIEVEMENTS_FILE)
-    unlocked_achievements = [
-        {**ach, "unlocked_at": user.get("achievement_unlocks", {}).get(ach_id, None)}
-        for ach_id, ach in all_achievements.items()
-        if ach_id in achievement_ids
-    ]
-    
-    # Get completed tasks
-    completed_task_ids = user.get("completed_tasks", [])
-    all_tasks = load_json_fody(FODY_TASKS_FILE)
-    completed_tasks = [
-        {**task, "completed_at": user.get("task_completions", {}).get(task_id, None)}
-        for task_id, task in all_tasks.items()
-        if task_id in completed_task_ids
-    ]
-    
-    return jsonify({
-        "token": token,
-        "points": points,
-        "level": level,
-        "level_progress": round(level_progress, 1),
-        "points_to_next_level": points_needed,
-        "next_level_points": points_for_next_level,
-        "achievements": {
-            "unlocked": len(unlocked_achievements),
-            "total": len(all_achievements),
-            "list": unlocked_achievements
-        },
-        "tasks": {
-            "completed": len(completed_tasks),
-            "total": len(all_tasks),
-            "list": completed_tasks
-        },
-        "stats": {
-            "total_uploads": user.get("total_uploads", 0),
-            "total_notes": user.get("total_notes", 0)
-        },
-        "settings": user.get("settings", {"gamification_enabled": True}),
-        "created_at": user.get("created_at"),
-        "last_active": user.get("last_active")
-    }), 200
+    def contains(self, mask, item_id):
+        position = self.positions.get(item_id)
+        return position is not None and mask >> position & 1 == 1
 
 
-@app.route('/api/gamification/points', methods=['POST'])
-def add_points():
-    """Add points to user."""
-    data = request.json
-    token = data.get('token')
-    points = data.get('points', 0)
-    action = data.get('action', 'general')
-    details = data.get('details', {})
-    
-    if not token or len(token) < 8:
-        return jsonify({"error": "Invalid token"}), 400
-    
-    if points <= 0:
-        return jsonify({"error": "Points must be positive"}), 400
-    
-    user = get_user_data(token)
-    old_points = user.get("points", 0)
-    new_points = old_points + points
-    
-    update_data = {
-        "points": new_points,
-        f"points_history_{datetime.now().isoformat()}": {
-            "action": action,
-            "amount": points,
-            "details": details
-        }
-    }
-    
-    # Update upload/note counts if applicable
-    if action == "photo_upload":
-        update_data["total_uploads"] = user.get("total_uploads", 0) + 1
-    elif action == "osm_note_create":
-        update_data["total_notes"] = user.get("total_notes", 0) + 1
-    
-    # Check for level up
-    old_level = calculate_level(old_points)
-    new_level = calculate_level(new_points)
-    level_up = new_level > old_level
-    
-    update_user_data(token, update_data)
-    
-    return jsonify({
-        "success": True,
-        "points_added": points,
-        "total_points": new_points,
-        "level": new_level,
-        "level_up": level_up,
-        "message": f"+{points} bodů" + (f" 🎉 LEVEL {new_level}!" if level_up else "")
-    }), 200
+achievement_ids = IdTable()
+task_ids = IdTable()
+# Key orders seen so far, so records of the same shape share one tuple
+_key_orders = {}
 
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
 
-@app.route('/api/gamification/achievement', methods=['POST'])
-def unlock_achievement():
-    """Unlock an achievement for user."""
-    data = request.json
-    token = data.get('token')
-    achievement_id = data.get('achievement_id')
-    
-    if not token or len(token) < 8:
-        return jsonify({"error": "Invalid token"}), 400
-    
-    if not achievement_id:
-        return jsonify({"error": "Achievement ID required"}), 400
-    
-    user = get_user_data(token)
-    achievements = user.get("achievements", [])
-    
-    if achievement_id in achievements:
-        return jsonify({
-            "success": False,
-            "message": "Achievement already unlocked"
-        }), 200
-    
-    # Get achievement info
-    all_achievements = load_json_fody(FODY_ACHIEVEMENTS_FILE)
-    if achievement_id not in all_achievements:
-        return jsonify({"error": "Achievement not found"}), 404
-    
-    achievement = all_achievements[achievement_id]
-    points_reward = achievement.get("points", 0)
-    
-    # Unlock achievement
-    achievements.append(achievement_id)
-    
-    update_data = {
-        "achievements": achievements,
-        f"achievement_unlocks_{achievement_id}": datetime.now().isoformat(),
-        "points": user.get("points", 0) + points_reward
-    }
-    
-    update_user_data(token, update_data)
-    
-    return jsonify({
-        "success": True,
-        "achievement": achievement,
-        "points_earned": points_reward,
-        "message": f"🏆 {achievement['icon']} {achievement['name']} - +{points_reward} bodů!"
-    }), 200
 
+def _pack_time(value):
+    """Return an ISO timestamp as epoch microseconds, or None if that would not round-trip."""
+    if not isinstance(value, str):
+        return None
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if when.tzinfo is not None:
+        return None
+    packed = (when - _EPOCH) // _MICROSECOND
+    return packed if _format_time(packed) == value else None
 
-@app.route('/api/gamification/task', methods=['POST'])
-def complete_task():
-    """Mark a task as completed."""
-    data = request.json
-    token = data.get('token')
-    task_id = data.get('task_id')
-    
-    if not token or len(token) < 8:
-        return jsonify({"error": "Invalid token"}), 400
-    
-    if not task_id:
-        return jsonify({"error": "Task ID required"}), 400
-    
-    user = get_user_data(token)
-    completed_tasks = user.get("completed_tasks", [])
-    
-    if task_id in completed_tasks:
-        return jsonify({
-            "success": False,
-            "message": "Task already completed"
-        }), 200
-    
-    # Get task info
-    all_tasks = load_json_fody(FODY_TASKS_FILE)
-    if task_id not in all_tasks:
-        return jsonify({"error": "Task not found"}), 404
-    
-    task = all_tasks[task_id]
-    points_reward = task.get("points", 0)
-    
-    # Complete task
-    completed_tasks.append(task_id)
-    
-    update_data = {
-        "completed_tasks": completed_tasks,
-        f"task_completions_{task_id}": datetime.now().isoformat(),
-        "points": user.get("points", 0) + points_reward
-    }
-    
-    update_user_data(token, update_data)
-    
-    return jsonify({
-        "success": True,
-        "task": task,
-        "points_earned": points_reward,
-        "message": f"✅ {task['icon']} {task['name']} - +{points_reward} bodů!"
-    }), 200
 
+def _format_time(packed):
+    return (_EPOCH + timedelta(microseconds=packed)).isoformat()
 
-@app.route('/api/gamification/sync', methods=['POST'])
-def full_sync():
-    """Full synchronization endpoint."""
-    data = request.json
-    token = data.get('token')
+
+class UserRecord:
+    """Compact form of a user record, as kept by the resident store.
+
+    Achievements and completed tasks are bitsets over IdTable positions, so
+    membership is a shift; their unlock times are an array of (position,
+    epoch microseconds) pairs in unlock order. Other timestamps are epoch
+    microseconds, settings are flag bits and the token is interned. A value
+    that would not convert back exactly is kept verbatim in extra, and the
+    original key order is kept as a tuple shared by records of the same
+    shape, so from_dict(user).to_dict() reproduces user key for key and in
+    order. Records are never mutated; updates build a new one.
+    """
+
+    TIME_FIELDS = ("created_at", "last_active", "session_started_at")
+    INT_FIELDS = ("points", "level", "total_uploads", "total_notes", "version", "event_seq")
+    # Two bits per flag: set, and its value
+    SETTINGS_FLAGS = ("gamification_enabled", "notifications_enabled")
+
+    __slots__ = ("token",) + TIME_FIELDS + INT_FIELDS + (
+        "achievements", "unlocks", "completed_tasks", "completions", "settings", "extra", "keys"
+    )
+    # Keys of the JSON schema held in the slots above
+    KEYS = frozenset(("token",) + TIME_FIELDS + INT_FIELDS + (
+        "achievements", "achievement_unlocks", "completed_tasks", "task_completions", "settings"
+    ))
+
+    @classmethod
+    def from_dict(cls, user):
+        record = cls.__new__(cls)
+        extra = {}
+        token = user.get("token")
+        record.token = sys.intern(token) if isinstance(token, str) else None
+        if token is not None and record.token is None:
+            extra["token"] = token
+        for name in cls.TIME_FIELDS:
+            value = user.get(name)
+            packed = _pack_time(value)
+            setattr(record, name, packed)
+            if packed is None and name in user:
+                extra[name] = value
+        for name in cls.INT_FIELDS:
+            value = user.get(name)
+            ok = type(value) is int
+            setattr(record, name, value if ok else None)
+            if not ok and name in user:
+                extra[name] = value
+        record.achievements, record.unlocks = cls._pack_ids(
+            achievement_ids, user, "achievements", "achievement_unlocks", extra
+        )
+        record.completed_tasks, record.completions = cls._pack_ids(
+            task_ids, user, "completed_tasks", "task_completions", extra
+        )
+        record.settings = cls._pack_settings(user.get("settings"))
+        if record.settings is None and "settings" in user:
+            extra["settings"] = user["settings"]
+        for key, value in user.items():
+            if key not in cls.KEYS:
+                extra[key] = value
+        record.extra = _copy_user(extra) if extra else None
+        keys = tuple(user)
+        record.keys = _key_orders.setdefault(keys, keys)
+        return record
+
+    @staticmethod
+    def _pack_ids(table, user, list_key, times_key, extra):
+        """Return (mask, times) for an id list and its {id: time} map.
+
+        times is None when the list is rebuilt from the mask alone, in
+        position order; whatever cannot be rebuilt exactly goes to extra.
+        """
+        ids = user.get(list_key)
+        times = user.get(times_key)
+        if not isinstance(ids, list) or not all(isinstance(item_id, str) for item_id in ids):
+            if list_key in user:
+                extra[list_key] = ids
+            if times_key in user:
+                extra[times_key] = times
+            return None, None
+        mask = 0
+        positions = []
+        for item_id in ids:
+            position = table.position(item_id)
+            mask |= 1 << position
+            positions.append(position)
+        if times_key not in user:
+            if positions != sorted(set(positions)):
+                extra[list_key] = ids
+            return mask, None
+        if isinstance(times, dict) and list(times) == ids:
+            packed = []
+            for position, value in zip(positions, times.values()):
+                when = _pack_time(value)
+                if when is None:
+                    break
+                packed += (position, when)
+            else:
+                return mask, array('q', packed)
+        extra[list_key] = ids
+        extra[times_key] = times
+        return mask, None
+
+    @classmethod
+    def _pack_settings(cls, settings):
+        if not isinstance(settings, dict):
+            return None
+        flags = 0
+        for name, value in settings.items():
+            if name not in cls.SETTINGS_FLAGS or not isinstance(value, bool):
+                return None
+            bit = 2 * cls.SETTINGS_FLAGS.index(name)
+            flags |= (1 | value << 1) << bit
+        return flags
+
+    def to_dict(self):
+        """Return the record in the stored JSON schema (a fresh dict)."""
+        user = {}
+        if self.token is not None:
+            user["token"] = self.token
+        for name in self.TIME_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                user[name] = _format_time(value)
+        for name in self.INT_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                user[name] = value
+        for table, mask, times, list_key, times_key in (
+            (achievement_ids, self.achievements, self.unlocks, "achievements", "achievement_unlocks"),
+            (task_ids, self.completed_tasks, self.completions, "completed_tasks", "task_completions"),
+        ):
+            if times is not None:
+                user[list_key] = [table.ids[times[i]] for i in range(0, len(times), 2)]
+                user[times_key] = {
+                    table.ids[times[i]]: _format_time(times[i + 1]) for i in range(0, len(times), 2)
+                }
+            elif mask is not None:
+                user[list_key] = [table.ids[bit] for bit in range(mask.bit_length()) if mask >> bit & 1]
+        if self.settings is not None:
+            user["settings"] = {
+                name: bool(self.settings >> (2 * i + 1) & 1)
+                for i, name in enumerate(self.SETTINGS_FLAGS) if self.settings >> (2 * i) & 1
+            }
+        if self.extra:
+            user.update(_copy_user(self.extra))
+        return {key: user[key] for key in self.keys}
+
+    def has_achievement(self, achievement_id):
+        return self.achievements is not None and achievement_ids.contains(self.achievements, achievement_id)
+
+    def has_completed(self, task_id):
+        return self.completed_tasks is not None and task_ids.contains(self.completed_tasks, task_id)
+
+
+class CatalogCache:
+    """Parsed achievement/task catalogs, reloaded only when a file changes.
+
+    Each lookup costs one stat(); the file is re-read only when its mtime
+    or size moved, and re-parsed only when the content hash differs.
+    version changes whenever any catalog's content does, so responses
+    derived from the catalog can be cached against it.
+    """
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.version = None
+
+    def get(self, kind):
+        """Return the catalog by kind. The result must not be mutated."""
+        filepath, default = self.catalogs[kind]
+        ensure_file(filepath, default)
+        st = os.stat(filepath)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self._entries.get(kind)
+        if entry is not None and entry[0] == stamp:
+            metrics.inc('fody_cache_requests_total', (("cache", "catalog"), ("result", "hit")))
+            return entry[2]
+        metrics.inc('fody_cache_requests_total', (("cache", "catalog"), ("result", "miss")))
+        with self._lock:
+            with open(filepath, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha256(raw).hexdigest()
+            if entry is not None and entry[1] == digest:
+                data = entry[2]
+            else:
+                try:
+                    data = loads_json(raw)
+                except ValueError:
+                    data = entry[2] if entry is not None else {}
+            self._entries[kind] = (stamp, digest, data)
+            self.version = hashlib.sha256(
+                ''.join(self._entries[k][1] for k in sorted(self._entries)).encode()
+            ).hexdigest()[:16]
+        return data
+
+    def check(self, kinds):
+        """Revalidate the given catalogs and return the combined version."""
+        for kind in kinds:
+            self.get(kind)
+        return self.version
+
+
+class Storage:
+    """Persistence interface behind users and the achievement/task catalog.
+
+    Backends implement the user methods; the catalog is shared and read from
+    the catalog JSON files so it stays hand-editable whatever the backend.
+    """
+
+    CATALOGS = {
+        "achievements": (FODY_ACHIEVEMENTS_FILE, DEFAULT_ACHIEVEMENTS),
+        "tasks": (FODY_TASKS_FILE, DEFAULT_TASKS),
+        "achievement_rules": (FODY_ACHIEVEMENT_RULES_FILE, DEFAULT_ACHIEVEMENT_RULES),
+        "levels": (FODY_LEVELS_FILE, {"thresholds": DEFAULT_LEVEL_THRESHOLDS}),
+    }
+
+    def __init__(self):
+        # Callables invoked as listener(token, before, after) whenever a user
+        # record is written; before is None for new users
+        self.listeners = []
+        self.catalog = CatalogCache(self.CATALOGS)
+
+    def _notify(self, token, before, after):
+        for listener in self.listeners:
+            listener(token, before, after)
+
+    def start(self):
+        """Open the backend. Called once before serving requests."""
+
+    def close(self):
+        """Persist pending changes and release resources."""
+
+    @contextmanager
+    def transaction(self):
+        """Group several user mutations into one atomic unit."""
+        yield
+
+    def get_user(self, token):
+        """Return a copy of the user record, or None if unknown."""
+        raise NotImplementedError
+
+    def get_version(self, token):
+        """Return the user's record version without loading it, or None."""
+        raise NotImplementedError
+
+    def create_user(self, token, user):
+        """Store user unless token already exists; return the stored record."""
+        raise NotImplementedError
+
+    def mutate_user(self, token, fn):
+        """Atomically read-modify-write a single user.
+
+        fn receives a mutable copy of the record (a new one is created for
+        unknown tokens) and returns (changes, result). Non-empty changes are
+        merged into the record and last_active is refreshed. Returns the
+        resulting record and result.
+        """
+        raise NotImplementedError
+
+    def has_achievement(self, token, achievement_id):
+        """Return whether the user has unlocked achievement_id."""
+        user = self.get_user(token)
+        return user is not None and achievement_id in user.get("achievements", [])
+
+    def has_completed(self, token, task_id):
+        """Return whether the user has completed task_id."""
+        user = self.get_user(token)
+        return user is not None and task_id in user.get("completed_tasks", [])
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def iter_users(self):
+        """Yield (token, user) for every stored user."""
+        raise NotImplementedError
+
+    def durable_seq(self):
+        """Return the highest event seq already persisted in a snapshot."""
+        raise NotImplementedError
+
+    def get_idempotent(self, token, key):
+        """Return the stored (fingerprint, status, mimetype, body) for a request key, or None."""
+        raise NotImplementedError
+
+    def put_idempotent(self, token, key, fingerprint, status, mimetype, body, ttl=IDEMPOTENCY_TTL):
+        """Keep the response to a request key, and the fingerprint of its request, for ttl seconds."""
+        raise NotImplementedError
+
+    def delete_idempotent(self, token, key):
+        """Forget a request key, so its request may run again."""
+        raise NotImplementedError
+
+    def load_catalog(self, kind):
+        """Return the achievement or task catalog by kind (read-only)."""
+        return self.catalog.get(kind)
+
+
+class JsonStorage(Storage):
+    """Resident copy of users.json with write-behind persistence.
+
+    The file is parsed once at startup. Reads are served from memory and
+    mutations only mark the token dirty; a background thread rewrites the
+    file when the flush interval elapses or the dirty set grows past the
+    threshold, and a final flush runs on shutdown.
+
+    Users are held as UserRecord objects, a fraction of the size of the
+    parsed dicts. Records are never mutated in place - updates replace the
+    whole record - so the flusher can serialise a shallow snapshot without
+    holding the lock.
+    """
+
+    def __init__(self, filepath, flush_interval=USERS_FLUSH_INTERVAL,
+                 max_dirty=USERS_FLUSH_MAX_DIRTY, idempotency_path=FODY_IDEMPOTENCY_FILE):
+        super().__init__()
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.idempotency_path = idempotency_path
+        self.users = {}
+        self.dirty = set()
+        # (token, key) -> (expires, status, mimetype, body) in expiry order,
+        # since every entry lives for the same TTL
+        self.idempotency = OrderedDict()
+        self.idempotency_dirty = False
+        self.applied_seq = 0
+        self.snapshot_seq = 0
+        # Records replaced and changes to announce in the open transaction
+        self._undo = None
+        self._changes = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._process_lock = None
+
+    def start(self):
+        """Load the users file and start the background flusher."""
+        # The resident copy is only correct if no other process writes the
+        # file, so refuse to start next to another server instance
+        self._process_lock = open(self.filepath + '.lock', 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._process_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise RuntimeError(
+                    f"{self.filepath} is already served by another process; "
+                    "use FODY_STORAGE_BACKEND=sqlite to run several workers"
+                )
+        # Bit positions follow the catalog order where possible
+        achievement_ids.extend(self.load_catalog("achievements"))
+        task_ids.extend(self.load_catalog("tasks"))
+        self.users = {
+            sys.intern(token): UserRecord.from_dict(user)
+            for token, user in load_json_fody(self.filepath).items()
+        }
+        now = time.time()
+        for row in load_json_fody(self.idempotency_path) or []:
+            token, key, expires, status, mimetype, body = row[:6]
+            # Rows saved before fingerprints were kept have none
+            fingerprint = row[6] if len(row) > 6 else ''
+            # A reservation outlives no restart: its request is gone
+            if expires > now and status != IDEMPOTENCY_PENDING:
+                self.idempotency[(token, key)] = (expires, fingerprint, status, mimetype, base64.b64decode(body))
+        self.applied_seq = self.snapshot_seq = max(
+            (user.event_seq or 0 for user in self.users.values()), default=0
+        )
+        self._thread = threading.Thread(target=self._run, name='fody-user-flusher', daemon=True)
+        self._thread.start()
+
+    def _put(self, token, user, before):
+        # Only called inside transaction()
+        self._undo.setdefault(token, self.users.get(token))
+        self.users[sys.intern(token)] = UserRecord.from_dict(user)
+        self.applied_seq = max(self.applied_seq, user.get("event_seq", 0))
+        self.dirty.add(token)
+        if len(self.dirty) >= self.max_dirty:
+            self._wakeup.set()
+        self._changes.append((token, before, user))
+
+    @contextmanager
+    def transaction(self):
+        # Mutations only touch memory; holding the lock keeps the batch
+        # atomic for other requests and the flusher writes it out once.
+        # Records replaced in the block are kept so that an exception can
+        # put them back, and listeners hear about the changes at the end
+        with self._lock:
+            if self._undo is not None:
+                yield
+                return
+            self._undo = {}
+            self._changes = []
+            applied_seq = self.applied_seq
+            try:
+                with event_log.transaction():
+                    yield
+            except BaseException:
+                for token, record in self._undo.items():
+                    if record is None:
+                        del self.users[token]
+                    else:
+                        self.users[token] = record
+                self.applied_seq = applied_seq
+                raise
+            finally:
+                pending, self._changes, self._undo = self._changes, None, None
+            for change in pending:
+                self._notify(*change)
+
+    def get_user(self, token):
+        user = self.users.get(token)
+        return user.to_dict() if user is not None else None
+
+    def get_version(self, token):
+        user = self.users.get(token)
+        return (user.version or 0) if user is not None else None
+
+    def create_user(self, token, user):
+        with self.transaction():
+            if token not in self.users:
+                self._put(token, user, None)
+            return self.users[token].to_dict()
+
+    def mutate_user(self, token, fn):
+        with self.transaction():
+            stored = self.users.get(token)
+            # to_dict() builds a fresh dict, so fn may mutate it freely
+            user = stored.to_dict() if stored is not None else new_user_record(token)
+            changes, result = fn(user)
+            if changes:
+                user = merge_user_changes(user, changes)
+            if changes or stored is None:
+                # Records are immutable, so stored still holds the state fn
+                # saw; the listeners' before is only built when there is a diff
+                self._put(token, user, stored.to_dict() if stored is not None else None)
+            # The stored record was rebuilt from user, so nothing aliases it
+            return user, result
+
+    def has_achievement(self, token, achievement_id):
+        # Answered from the record's bitset, without building a dict
+        user = self.users.get(token)
+        return user is not None and user.has_achievement(achievement_id)
+
+    def has_completed(self, token, task_id):
+        user = self.users.get(token)
+        return user is not None and user.has_completed(task_id)
+
+    def count_users(self):
+        return len(self.users)
+
+    def iter_users(self):
+        return ((token, user.to_dict()) for token, user in list(self.users.items()))
+
+    def durable_seq(self):
+        return self.snapshot_seq
+
+    def get_idempotent(self, token, key):
+        entry = self.idempotency.get((token, key))
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1:]
+
+    def put_idempotent(self, token, key, fingerprint, status, mimetype, body, ttl=IDEMPOTENCY_TTL):
+        now = time.time()
+        with self._lock:
+            self.idempotency.pop((token, key), None)
+            self.idempotency[(token, key)] = (now + ttl, fingerprint, status, mimetype, body)
+            while self.idempotency and (
+                len(self.idempotency) > IDEMPOTENCY_MAX_KEYS or next(iter(self.idempotency.values()))[0] <= now
+            ):
+                self.idempotency.popitem(last=False)
+            self.idempotency_dirty = True
+
+    def delete_idempotent(self, token, key):
+        with self._lock:
+            if self.idempotency.pop((token, key), None) is not None:
+                self.idempotency_dirty = True
+
+    def flush(self):
+        """Write the store to disk if any user or idempotency key changed since the last flush."""
+        with self._flush_lock:
+            with self._lock:
+                if not self.dirty and not self.idempotency_dirty:
+                    return False
+                snapshot = dict(self.users) if self.dirty else None
+                keys = list(self.idempotency.items()) if self.idempotency_dirty else None
+                seq = self.applied_seq
+                self.dirty.clear()
+                self.idempotency_dirty = False
+            if snapshot is not None:
+                save_json_members(self.filepath, ((token, user.to_dict()) for token, user in snapshot.items()))
+                self.snapshot_seq = seq
+            if keys is not None:
+                save_json_fody(self.idempotency_path, [
+                    [token, key, expires, status, mimetype, base64.b64encode(body).decode('ascii'), fingerprint]
+                    for (token, key), (expires, fingerprint, status, mimetype, body) in keys
+                ])
+            return True
+
+    def close(self):
+        """Stop the flusher and persist any pending changes."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        if self._process_lock is not None:
+            self._process_lock.close()
+            self._process_lock = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, OSError) as e:
+                print(f"Failed to flush users: {e}")
+
+
+class SqliteStorage(Storage):
+    """Users in an embedded SQLite database running in WAL mode.
+
+    token, points and last_active are real indexed columns so lookups and
+    leaderboard queries do not have to decode records; the full record is
+    kept as JSON in the data column. Every mutation is a single-row
+    transaction, so nothing is ever rewritten wholesale.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            token TEXT PRIMARY KEY,
+            points INTEGER NOT NULL DEFAULT 0,
+            last_active TEXT,
+            event_seq INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_points ON users (points DESC);
+        CREATE INDEX IF NOT EXISTS users_last_active ON users (last_active);
+        CREATE TABLE IF NOT EXISTS idempotency (
+            token TEXT NOT NULL,
+            key TEXT NOT NULL,
+            expires REAL NOT NULL,
+            status INTEGER NOT NULL,
+            mimetype TEXT NOT NULL,
+            body BLOB NOT NULL,
+            fingerprint TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (token, key)
+        );
+        CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires);
+    """
+
+    # Expired and surplus idempotency keys are pruned every this many puts
+    IDEMPOTENCY_PRUNE_EVERY = 1000
+
+    def __init__(self, filepath):
+        super().__init__()
+        self.filepath = filepath
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._idempotency_puts = itertools.count(1)
+
+    def _conn(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filepath, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def start(self):
+        conn = self._conn()
+        # Databases created by older versions lack the later columns
+        for column in ('event_seq', 'version'):
+            try:
+                conn.execute(f'ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError:
+                pass
+        try:
+            conn.execute("ALTER TABLE idempotency ADD COLUMN fingerprint TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError:
+            pass
+        conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, 'pending', None) is not None:
+            # Already inside a transaction on this thread
+            yield
+            return
+        conn = self._conn()
+        self._local.pending = []
+        try:
+            # Events reach the log only once the users they changed commit
+            with event_log.transaction():
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            pending, self._local.pending = self._local.pending, None
+        for change in pending:
+            super()._notify(*change)
+
+    def _notify(self, token, before, after):
+        # Listeners only hear about changes once they are committed
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            super()._notify(token, before, after)
+        else:
+            pending.append((token, before, after))
+
+    def _write(self, conn, token, user):
+        conn.execute(
+            'INSERT OR REPLACE INTO users (token, points, last_active, event_seq, version, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (token, user.get("points", 0), user.get("last_active"), user.get("event_seq", 0),
+             user.get("version", 0), dumps_json(user).decode('utf-8'))
+        )
+
+    def _read(self, conn, token):
+        row = conn.execute('SELECT data FROM users WHERE token = ?', (token,)).fetchone()
+        return loads_json(row[0]) if row else None
+
+    def get_user(self, token):
+        return self._read(self._conn(), token)
+
+    def get_version(self, token):
+        row = self._conn().execute('SELECT version FROM users WHERE token = ?', (token,)).fetchone()
+        return row[0] if row else None
+
+    def create_user(self, token, user):
+        conn = self._conn()
+        inserted = conn.execute(
+            'INSERT OR IGNORE INTO users (token, points, last_active, event_seq, version, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (token, user.get("points", 0), user.get("last_active"), user.get("event_seq", 0),
+             user.get("version", 0), dumps_json(user).decode('utf-8'))
+        ).rowcount
+        if inserted:
+            self._notify(token, None, user)
+        return self._read(conn, token)
+
+    def mutate_user(self, token, fn):
+        with self.transaction():
+            conn = self._conn()
+            stored = self._read(conn, token)
+            user = stored if stored is not None else new_user_record(token)
+            changes, result = fn(user)
+            if changes:
+                user = merge_user_changes(user, changes)
+            if changes or stored is None:
+                self._write(conn, token, user)
+                self._notify(token, stored, user)
+        return user, result
+
+    def count_users(self):
+        return self._conn().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def iter_users(self):
+        for token, data in self._conn().execute('SELECT token, data FROM users'):
+            yield token, loads_json(data)
+
+    def durable_seq(self):
+        # Every mutation commits before returning, so state is always a snapshot
+        return self._conn().execute('SELECT MAX(event_seq) FROM users').fetchone()[0] or 0
+
+    def get_idempotent(self, token, key):
+        return self._conn().execute(
+            'SELECT fingerprint, status, mimetype, body FROM idempotency '
+            'WHERE token = ? AND key = ? AND expires > ?',
+            (token, key, time.time())
+        ).fetchone()
+
+    def put_idempotent(self, token, key, fingerprint, status, mimetype, body, ttl=IDEMPOTENCY_TTL):
+        now = time.time()
+        with self.transaction():
+            conn = self._conn()
+            conn.execute(
+                'INSERT OR REPLACE INTO idempotency (token, key, expires, status, mimetype, body, fingerprint) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (token, key, now + ttl, status, mimetype, body, fingerprint)
+            )
+            if next(self._idempotency_puts) % self.IDEMPOTENCY_PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM idempotency WHERE expires <= ?', (now,))
+                conn.execute(
+                    'DELETE FROM idempotency WHERE rowid IN (SELECT rowid FROM idempotency '
+                    'ORDER BY expires LIMIT MAX(0, (SELECT COUNT(*) FROM idempotency) - ?))',
+                    (IDEMPOTENCY_MAX_KEYS,)
+                )
+
+    def delete_idempotent(self, token, key):
+        self._conn().execute('DELETE FROM idempotency WHERE token = ? AND key = ?', (token, key))
+
+
+def open_storage(backend=STORAGE_BACKEND):
+    """Create the storage backend selected by name."""
+    if backend == 'json':
+        return JsonStorage(FODY_USERS_FILE)
+    if backend == 'sqlite':
+        return SqliteStorage(FODY_DB_FILE)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class EventLog:
+    """Append-only NDJSON log of gamification events.
+
+    Each line is one event carrying a global, monotonically increasing seq.
+    User records only keep current state plus the seq of the last event
+    folded into them, so history no longer bloats users. State is recovered
+    from the latest storage snapshot plus the events after it.
+
+    Appends are fsynced in batches. An in-memory index of byte offsets per
+    token lets a history query read only that user's lines.
+
+    Worker processes may share the log: every append holds an exclusive
+    flock, first reads whatever other processes appended meanwhile (keeping
+    seq and the index current) and writes its line straight through. Events
+    picked up that way are passed to foreign_listeners so per-process views
+    can follow the other workers.
+
+    Inside transaction() appends are only buffered, under a lock held to
+    the end of the block, and written when it completes; storage
+    transactions wrap themselves in one so a rolled back mutation leaves
+    no events behind.
+    """
+
+    def __init__(self, filepath, fsync_batch=EVENTS_FSYNC_BATCH,
+                 fsync_interval=EVENTS_FSYNC_INTERVAL,
+                 retention_days=EVENTS_RETENTION_DAYS,
+                 compact_interval=EVENTS_COMPACT_INTERVAL):
+        self.filepath = filepath
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.retention_days = retention_days
+        self.compact_interval = compact_interval
+        self.seq = 0
+        # Highest seq whose event may have been dropped by compaction;
+        # history is only complete for queries starting at or after it
+        self.horizon = 0
+        self.index = {}
+        self.foreign_listeners = []
+        self._size = 0
+        self._pending = 0
+        self._file = None
+        self._inode = None
+        self._lock = threading.RLock()
+        # Nesting depth of _locked() on the thread owning _lock; the flock
+        # is only taken and released by the outermost level
+        self._depth = 0
+        self._local = threading.local()
+        self._compact_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, replay_after=0):
+        """Index the existing log and return events with seq > replay_after."""
+        self._file = open(self.filepath, 'ab')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        with self._lock:
+            self._flock(fcntl.LOCK_EX if fcntl else None)
+            try:
+                tail = self._read_tail(notify=False, keep_after=replay_after)
+                # Drop a torn write left at the end of the log by a crash
+                self._file.truncate(self._size)
+            finally:
+                self._flock(fcntl.LOCK_UN if fcntl else None)
+        with open(self.filepath, 'rb') as f:
+            first_line = f.readline()
+        self.horizon = loads_json(first_line)["seq"] - 1 if first_line else replay_after
+        self.seq = max(self.seq, replay_after)
+        self._thread = threading.Thread(target=self._run, name='fody-event-log', daemon=True)
+        self._thread.start()
+        return tail
+
+    def _flock(self, operation):
+        if operation is not None:
+            fcntl.flock(self._file.fileno(), operation)
+
+    def _read_tail(self, notify=True, keep_after=None):
+        """Index lines appended past self._size by anyone.
+
+        Returns the events with seq > keep_after when keep_after is given.
+        """
+        kept = []
+        if os.fstat(self._file.fileno()).st_size <= self._size:
+            return kept
+        with open(self.filepath, 'rb') as f:
+            f.seek(self._size)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    event = loads_json(line)
+                except ValueError:
+                    break
+                self.index.setdefault(event["token"], array('q')).append(self._size)
+                self._size += len(line)
+                if event["seq"] > self.seq:
+                    self.seq = event["seq"]
+                    if notify:
+                        for listener in self.foreign_listeners:
+                            listener(event)
+                if keep_after is not None and event["seq"] > keep_after:
+                    kept.append(event)
+        return kept
+
+    def _acquire(self):
+        """Lock the current log file across processes and catch up with it."""
+        followed = False
+        while True:
+            self._flock(fcntl.LOCK_EX if fcntl else None)
+            if os.stat(self.filepath).st_ino == self._inode:
+                break
+            # Another process compacted the log; follow it to the new file
+            # and rebuild the offset index from its start
+            self._flock(fcntl.LOCK_UN if fcntl else None)
+            self._file.close()
+            self._file = open(self.filepath, 'ab')
+            self._inode = os.fstat(self._file.fileno()).st_ino
+            self._size = 0
+            self._pending = 0
+            self.index = {}
+            followed = True
+        self._read_tail()
+        if followed:
+            # Whatever precedes the compacted file's first event is gone
+            with open(self.filepath, 'rb') as f:
+                first_line = f.readline()
+            first_seq = loads_json(first_line)["seq"] if first_line.endswith(b'\n') else self.seq + 1
+            self.horizon = max(self.horizon, first_seq - 1)
+
+    def _enter(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._acquire()
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def _exit(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._flock(fcntl.LOCK_UN if fcntl else None)
+        self._lock.release()
+
+    @contextmanager
+    def _locked(self):
+        self._enter()
+        try:
+            yield
+        finally:
+            self._exit()
+
+    @contextmanager
+    def transaction(self):
+        """Buffer the appends made in the block; write them only if it completes.
+
+        The lock is taken at the first append and held until the end, so
+        seq stays contiguous and nobody else sees the buffered events.
+        """
+        if getattr(self._local, 'buffer', None) is not None:
+            yield
+            return
+        buffer = self._local.buffer = []
+        try:
+            yield
+        except BaseException:
+            if buffer:
+                self.seq = buffer[0][0]["seq"] - 1
+            raise
+        else:
+            if buffer:
+                self._write(buffer)
+        finally:
+            self._local.buffer = None
+            if buffer:
+                self._exit()
+
+    def append(self, token, event):
+        """Assign seq and timestamp to event and append it to the log."""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            with self._locked():
+                event = self._stamp(token, event)
+                self._write([(event, dumps_json(event) + b'\n')])
+            return event
+        if not buffer:
+            self._enter()
+        event = self._stamp(token, event)
+        buffer.append((event, dumps_json(event) + b'\n'))
+        return event
+
+    def _stamp(self, token, event):
+        self.seq += 1
+        return {"seq": self.seq, "ts": datetime.now().isoformat(), "token": token, **event}
+
+    def _write(self, lines):
+        """Write (event, line) pairs; the caller holds the lock."""
+        self._file.write(b''.join(line for _, line in lines))
+        self._file.flush()
+        for event, line in lines:
+            self.index.setdefault(event["token"], array('q')).append(self._size)
+            self._size += len(line)
+            metrics.inc('fody_event_log_bytes_total', (), len(line))
+        self._pending += len(lines)
+        if self._pending >= self.fsync_batch:
+            self.sync()
+
+    def sync(self):
+        """fsync appended events to disk."""
+        with self._lock:
+            if self._file is None or not self._pending:
+                return
+            with metrics.timer('fody_event_log_fsync_seconds'):
+                os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def history(self, token, since_seq=0, limit=None):
+        """Return token's events with seq > since_seq, oldest first."""
+        with self._locked():
+            offsets = list(self.index.get(token, ()))
+            # Opened under the lock so the offsets match even if a compaction
+            # swaps the file right after
+            f = open(self.filepath, 'rb')
+        events = []
+        with f:
+            for offset in offsets:
+                f.seek(offset)
+                event = loads_json(f.readline())
+                if event["seq"] <= since_seq:
+                    continue
+                events.append(event)
+                if limit is not None and len(events) >= limit:
+                    break
+        return events
+
+    def iter_since(self, since):
+        """Yield events logged at or after the ISO timestamp since, oldest first.
+
+        Lines are appended in time order, so the first one is found by a
+        binary search over byte offsets instead of a scan from the start.
+        """
+        with self._locked():
+            end = self._size
+            f = open(self.filepath, 'rb')
+        with f:
+            def line_at(offset):
+                # First complete line starting at or after offset
+                if offset:
+                    f.seek(offset - 1)
+                    f.readline()
+                else:
+                    f.seek(0)
+                return f.tell(), f.readline()
+            
+            low, high = 0, end
+            while low < high:
+                mid = (low + high) // 2
+                start, line = line_at(mid)
+                if start < end and loads_json(line)["ts"] < since:
+                    low = mid + 1
+                else:
+                    high = mid
+            
+            start, _ = line_at(low)
+            f.seek(start)
+            while f.tell() < end:
+                yield loads_json(f.readline())
+
+    def compact(self, durable_seq):
+        """Rewrite the log without old events that are already snapshotted.
+
+        The bulk of the file is copied without holding the append lock; only
+        the tail appended meanwhile is copied under it before the swap. Only
+        one process compacts at a time; returns None if another one is.
+        """
+        cutoff = datetime.fromtimestamp(time.time() - self.retention_days * 86400).isoformat()
+        tmp_path = self.filepath + '.compact'
+        with self._compact_lock, open(self.filepath + '.compact.lock', 'w') as compact_lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(compact_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            with self._locked():
+                end = self._size
+            index = {}
+            written = 0
+            dropped = 0
+            with open(self.filepath, 'rb') as src, open(tmp_path, 'wb') as dst:
+                def copy(limit):
+                    nonlocal written, dropped
+                    while src.tell() < limit:
+                        line = src.readline()
+                        event = loads_json(line)
+                        if event["seq"] <= durable_seq and event["ts"] < cutoff:
+                            dropped = max(dropped, event["seq"])
+                            continue
+                        index.setdefault(event["token"], array('q')).append(written)
+                        dst.write(line)
+                        written += len(line)
+
+                copy(end)
+                with self._lock:
+                    self._acquire()
+                    copy(self._size)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    os.replace(tmp_path, self.filepath)
+                    old_file = self._file
+                    self._file = open(self.filepath, 'ab')
+                    self._inode = os.fstat(self._file.fileno()).st_ino
+                    self._size = written
+                    self._pending = 0
+                    self.index = index
+                    self.horizon = max(self.horizon, dropped)
+                    # Closing releases the old file's flock; waiting processes
+                    # then notice the swap and reopen
+                    old_file.close()
+        return written
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        last_compact = time.monotonic()
+        while not self._stopped.wait(self.fsync_interval):
+            try:
+                # Pick up other workers' events even when this one is idle
+                with self._locked():
+                    pass
+                self.sync()
+                if time.monotonic() - last_compact >= self.compact_interval:
+                    last_compact = time.monotonic()
+                    self.compact(storage.durable_seq())
+            except (IOError, OSError) as e:
+                print(f"Event log maintenance failed: {e}")
+
+
+def apply_event(user, event):
+    """Fold a single logged event into a user record; return the changes."""
+    kind = event["type"]
+    points = user.get("points", 0)
+    changes = {"event_seq": event["seq"]}
+    if kind == "points":
+        changes["points"] = points + event["amount"]
+        # Update upload/note counts if applicable
+        if event.get("action") == "photo_upload":
+            changes["total_uploads"] = user.get("total_uploads", 0) + 1
+        elif event.get("action") == "osm_note_create":
+            changes["total_notes"] = user.get("total_notes", 0) + 1
+        elif event.get("action") == "app_open":
+            changes["session_started_at"] = event["ts"]
+    elif kind == "achievement":
+        changes["points"] = points + event["amount"]
+        changes["achievements"] = user.get("achievements", []) + [event["id"]]
+        changes["achievement_unlocks"] = {**user.get("achievement_unlocks", {}), event["id"]: event["ts"]}
+    elif kind == "task":
+        changes["points"] = points + event["amount"]
+        changes["completed_tasks"] = user.get("completed_tasks", []) + [event["id"]]
+        changes["task_completions"] = {**user.get("task_completions", {}), event["id"]: event["ts"]}
+    elif kind == "settings":
+        changes["settings"] = event["settings"]
+    return changes
+
+
+def record_events(token, user, events):
+    """Log events for token and fold them into user.
+
+    Must be called from inside a Storage.mutate_user callback so the log
+    order matches the order changes are applied. Returns the combined
+    changes and the logged events.
+    """
+    changes = {}
+    logged = []
+    for event in events:
+        event = event_log.append(token, event)
+        changes.update(apply_event({**user, **changes}, event))
+        logged.append(event)
+    return changes, logged
+
+
+def replay_events(events):
+    """Re-apply logged events missing from the storage snapshot."""
+    for event in events:
+        def apply(user, event=event):
+            if user.get("event_seq", 0) >= event["seq"]:
+                return None, None
+            return apply_event(user, event), None
+        storage.mutate_user(event["token"], apply)
+
+
+class LeaderboardIndex:
+    """All users ordered by points, maintained incrementally.
+
+    A sorted array of (-points, token) keys searched with bisect: a score
+    change is one removal and one insertion, a page of k entries is a slice
+    and a rank lookup is a single binary search.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._entries = {}
+        # Bumped on every change, for caches of rendered pages
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def rebuild(self, users):
+        """Replace the index with entries built from (token, user) pairs."""
+        self.load(
+            (token, user.get("points", 0), len(user.get("achievements", [])))
+            for token, user in users
+        )
+
+    def load(self, entries):
+        """Replace the index with (token, points, achievements) entries."""
+        entries = {token: (points, achievements) for token, points, achievements in entries}
+        keys = sorted((-points, token) for token, (points, _) in entries.items())
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self.version += 1
+
+    def update(self, token, points, achievements):
+        """Record token's current points and achievement count."""
+        with self._lock:
+            self._set(token, points, achievements)
+
+    def _set(self, token, points, achievements):
+        old = self._entries.get(token)
+        if old == (points, achievements):
+            return
+        if old is not None and old[0] != points:
+            del self._keys[bisect_left(self._keys, (-old[0], token))]
+        if old is None or old[0] != points:
+            insort(self._keys, (-points, token))
+        self._entries[token] = (points, achievements)
+        self.version += 1
+
+    def add(self, token, points, achievements=0):
+        """Add to token's points and achievement count."""
+        with self._lock:
+            old_points, old_achievements = self._entries.get(token, (0, 0))
+            self._set(token, old_points + points, old_achievements + achievements)
+
+    def on_user_change(self, token, before, after):
+        """Storage listener keeping the index in step with user writes."""
+        self.update(token, after.get("points", 0), len(after.get("achievements", [])))
+
+    def on_foreign_event(self, event):
+        """Event log listener applying score changes made by other workers."""
+        if event["type"] not in ("points", "achievement", "task"):
+            return
+        self.add(event["token"], event["amount"], 1 if event["type"] == "achievement" else 0)
+
+    def entries(self):
+        """Return [(token, points, achievements)], best first."""
+        with self._lock:
+            return [(token, -neg_points, self._entries[token][1]) for neg_points, token in self._keys]
+
+    def page(self, offset=0, limit=100):
+        """Return [(rank, token, points, achievements)] for one page."""
+        with self._lock:
+            keys = self._keys[offset:offset + limit]
+            return [
+                (offset + i + 1, token, -neg_points, self._entries[token][1])
+                for i, (neg_points, token) in enumerate(keys)
+            ]
+
+    def points(self, token):
+        """Return token's indexed points (0 if unknown)."""
+        with self._lock:
+            return self._entries.get(token, (0, 0))[0]
+
+    def rank(self, token):
+        """Return token's 1-based rank, or None if unknown."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            return bisect_left(self._keys, (-entry[0], token)) + 1
+
+
+class PopulationStats:
+    """Population-wide aggregates maintained incrementally.
+
+    Keeps a compact summary per user (points, achievement and task
+    bitmasks, last event seq) and, from it, unlock and completion counts,
+    the level histogram and the distinct active users per day, so reads
+    cost O(catalog) however many users there are. Storage writes and
+    events from other workers update it; a periodic rebuild from storage
+    verifies the counters and reports any drift.
+    """
+
+    KINDS = ("achievements", "completed_tasks")
+    # Masks use the bit positions UserRecord uses, which never change
+    TABLES = {"achievements": achievement_ids, "completed_tasks": task_ids}
+
+    def __init__(self, active_days=ANALYTICS_ACTIVE_DAYS, rebuild_interval=ANALYTICS_REBUILD_INTERVAL):
+        self.active_days = active_days
+        self.rebuild_interval = rebuild_interval
+        # token -> (points, achievement mask, task mask, event seq)
+        self._summaries = {}
+        self._counts = {kind: Counter() for kind in self.KINDS}
+        self._levels = Counter()
+        self._thresholds = None
+        # day (YYYY-MM-DD) -> tokens active that day
+        self._active = {}
+        # Changes seen while a rebuild runs, replayed over its result
+        self._journal = None
+        self.last_rebuild = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='fody-analytics', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+
+    def _mask(self, kind, ids):
+        table = self.TABLES[kind]
+        mask = 0
+        for item_id in ids:
+            if isinstance(item_id, str):
+                mask |= 1 << table.position(item_id)
+        return mask
+
+    def _count_bits(self, kind, old, new):
+        ids = self.TABLES[kind].ids
+        changed = old ^ new
+        while changed:
+            low = changed & -changed
+            self._counts[kind][ids[low.bit_length() - 1]] += 1 if new & low else -1
+            changed ^= low
+
+    def _store(self, token, old, new):
+        if old == new:
+            return
+        self._summaries[token] = new
+        old_points, old_achievements, old_tasks = old[:3] if old is not None else (None, 0, 0)
+        if old_points != new[0]:
+            if old is not None:
+                self._levels[calculate_level(old_points, self._thresholds)] -= 1
+            self._levels[calculate_level(new[0], self._thresholds)] += 1
+        self._count_bits("achievements", old_achievements, new[1])
+        self._count_bits("completed_tasks", old_tasks, new[2])
+
+    def _mark_active(self, token, ts):
+        if not ts:
+            return
+        day = ts[:10]
+        tokens = self._active.get(day)
+        if tokens is None:
+            cutoff = datetime.fromtimestamp(time.time() - self.active_days * 86400).date().isoformat()
+            if day <= cutoff:
+                return
+            for old_day in [d for d in self._active if d <= cutoff]:
+                del self._active[old_day]
+            tokens = self._active[day] = set()
+        tokens.add(token)
+
+    def _apply_user(self, token, user):
+        old = self._summaries.get(token)
+        seq = user.get("event_seq", 0)
+        if old is not None and seq < old[3]:
+            return
+        self._store(token, old, (
+            user.get("points", 0),
+            self._mask("achievements", user.get("achievements", [])),
+            self._mask("completed_tasks", user.get("completed_tasks", [])),
+            seq
+        ))
+        self._mark_active(token, user.get("last_active"))
+
+    def _apply_event(self, event):
+        token = event["token"]
+        old = self._summaries.get(token)
+        if old is not None and event["seq"] <= old[3]:
+            return
+        points, achievements, tasks, _ = old if old is not None else (0, 0, 0, 0)
+        kind = event["type"]
+        if kind in ("points", "achievement", "task"):
+            points += event["amount"]
+        if kind == "achievement":
+            achievements |= self._mask("achievements", [event["id"]])
+        elif kind == "task":
+            tasks |= self._mask("completed_tasks", [event["id"]])
+        self._store(token, old, (points, achievements, tasks, event["seq"]))
+        self._mark_active(token, event["ts"])
+
+    def on_user_change(self, token, before, after):
+        """Storage listener folding a user write into the counters."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((token, after, None))
+            self._apply_user(token, after)
+
+    def on_foreign_event(self, event):
+        """Event log listener folding other workers' events into the counters."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((event["token"], None, event))
+            self._apply_event(event)
+
+    def _totals(self):
+        return {
+            "users": len(self._summaries),
+            **{kind: +self._counts[kind] for kind in self.KINDS},
+            "levels": +self._levels,
+        }
+
+    def rebuild(self, users):
+        """Recount everything from (token, user) pairs; return the drift found.
+
+        The drift maps each aggregate the incremental counters got wrong to
+        its counted and actual values. The first build reports none.
+        """
+        with self._lock:
+            self._journal = []
+        fresh = PopulationStats(self.active_days, self.rebuild_interval)
+        fresh._thresholds = level_thresholds()
+        for token, user in users:
+            fresh._apply_user(token, user)
+        
+        with self._lock:
+            journal, self._journal = self._journal, None
+            for token, user, event in journal:
+                if user is not None:
+                    fresh._apply_user(token, user)
+                else:
+                    fresh._apply_event(event)
+            
+            drift = {}
+            if self.last_rebuild is not None:
+                counted, actual = self._totals(), fresh._totals()
+                if fresh._thresholds is not self._thresholds:
+                    del counted["levels"], actual["levels"]
+                drift = {
+                    name: {"counted": counted[name], "actual": actual[name]}
+                    for name in counted if counted[name] != actual[name]
+                }
+            
+            # Days before the last write of each user are only known live
+            for day, tokens in self._active.items():
+                fresh._active.setdefault(day, set()).update(tokens)
+            self._summaries = fresh._summaries
+            self._counts, self._levels = fresh._counts, fresh._levels
+            self._thresholds = fresh._thresholds
+            self._active = fresh._active
+            self.last_rebuild = {
+                "at": datetime.now().isoformat(),
+                "users": len(self._summaries),
+                "drift": drift
+            }
+        
+        if drift:
+            print(f"Analytics counters drifted: {sorted(drift)}")
+            metrics.inc('fody_analytics_drift_total', amount=len(drift))
+        return drift
+
+    def _relevel(self, thresholds):
+        """Rebuild the level histogram for a new level curve in one batch."""
+        levels = recompute_levels([summary[0] for summary in self._summaries.values()], thresholds)["levels"]
+        if numpy is not None:
+            values, counts = numpy.unique(levels, return_counts=True)
+            self._levels = Counter(dict(zip(values.tolist(), counts.tolist())))
+        else:
+            self._levels = Counter(levels)
+        self._thresholds = thresholds
+
+    def snapshot(self):
+        """Return (users, achievement counts, task counts, level histogram, active users by day)."""
+        thresholds = level_thresholds()
+        with self._lock:
+            if thresholds is not self._thresholds:
+                self._relevel(thresholds)
+            return (
+                len(self._summaries),
+                dict(+self._counts["achievements"]),
+                dict(+self._counts["completed_tasks"]),
+                dict(sorted((+self._levels).items())),
+                {day: len(tokens) for day, tokens in sorted(self._active.items())}
+            )
+
+    def _run(self):
+        while not self._stopped.wait(self.rebuild_interval):
+            try:
+                self.rebuild(storage.iter_users())
+            except (sqlite3.Error, OSError) as e:
+                print(f"Analytics rebuild failed: {e}")
+
+
+LEADERBOARD_WINDOWS = ("week", "month", "period")
+
+
+def window_bounds(kind, when):
+    """Return (key, start, end) of the leaderboard window of kind containing when.
+
+    Keys sort chronologically: 2026-W42, 2026-10, 2026-P4.
+    """
+    day = datetime(when.year, when.month, when.day)
+    if kind == "week":
+        iso = day.isocalendar()
+        start = day - timedelta(days=day.weekday())
+        return f"{iso[0]}-W{iso[1]:02d}", start, start + timedelta(days=7)
+    months = 1 if kind == "month" else PROJECT_PERIOD_MONTHS
+    index = (when.month - 1) // months
+    start = datetime(when.year, index * months + 1, 1)
+    end_month = index * months + months
+    end = datetime(when.year + end_month // 12, end_month % 12 + 1, 1)
+    key = f"{when.year}-{when.month:02d}" if kind == "month" else f"{when.year}-P{index + 1}"
+    return key, start, end
+
+
+class WindowedLeaderboards:
+    """Leaderboards of the points earned in the current week, month and period.
+
+    Each window kind has a LeaderboardIndex bucket that points are added
+    to as they are awarded, so a page costs the same as the all-time
+    board. When a window ends its bucket is frozen into a snapshot file and
+    a new one starts; the last retention snapshots of each kind are kept.
+    """
+
+    def __init__(self, directory=LEADERBOARD_WINDOW_DIR, retention=LEADERBOARD_WINDOW_RETENTION):
+        self.directory = directory
+        self.retention = retention
+        # kind -> (key, start, end, LeaderboardIndex)
+        self._current = {}
+        # (kind, key) -> (key, start, end, LeaderboardIndex) of loaded snapshots
+        self._frozen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def replay_from(self, now=None):
+        """Return the timestamp the event log must be replayed from on start.
+
+        Covers the previous window of each kind too, so one that closed
+        while the server was down still gets its snapshot.
+        """
+        now = now or datetime.now()
+        return min(
+            window_bounds(kind, window_bounds(kind, now)[1] - timedelta(days=1))[1]
+            for kind in LEADERBOARD_WINDOWS
+        ).isoformat()
+
+    def start(self, events):
+        """Fill the buckets from logged events (as from EventLog.iter_since)."""
+        os.makedirs(self.directory, exist_ok=True)
+        now = datetime.now()
+        with self._lock:
+            for kind in LEADERBOARD_WINDOWS:
+                previous = window_bounds(kind, window_bounds(kind, now)[1] - timedelta(days=1))
+                self._current[kind] = (*previous, LeaderboardIndex())
+        for event in events:
+            self.on_foreign_event(event)
+        with self._lock:
+            for kind in LEADERBOARD_WINDOWS:
+                self._roll(kind, now)
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, f"{kind}-{key}.json")
+
+    def _roll(self, kind, when):
+        """Return the current bucket of kind for when, starting a new one if due.
+
+        Returns None for times in an already closed window.
+        """
+        current = self._current[kind]
+        if current[1] <= when < current[2]:
+            return current
+        if when < current[1]:
+            return None
+        self._freeze(kind, current)
+        current = self._current[kind] = (*window_bounds(kind, when), LeaderboardIndex())
+        return current
+
+    def _freeze(self, kind, bucket):
+        key, start, end, index = bucket
+        path = self._path(kind, key)
+        # Every worker closes the same window; the first snapshot stands
+        if len(index) and not os.path.exists(path):
+            save_json_fody(path, {
+                "window": kind,
+                "period": key,
+                "starts_at": start.isoformat(),
+                "ends_at": end.isoformat(),
+                "entries": index.entries()
+            })
+        snapshots = sorted(name for name in os.listdir(self.directory) if name.startswith(f"{kind}-"))
+        for name in snapshots[:-self.retention] if self.retention else snapshots:
+            os.remove(os.path.join(self.directory, name))
+
+    def add(self, token, points, achievements, when):
+        """Credit points earned at when to every window containing it."""
+        with self._lock:
+            buckets = [self._roll(kind, when) for kind in LEADERBOARD_WINDOWS]
+        for bucket in buckets:
+            if bucket is not None:
+                bucket[3].add(token, points, achievements)
+
+    def on_user_change(self, token, before, after):
+        """Storage listener crediting points earned by a local write."""
+        points = after.get("points", 0) - (before.get("points", 0) if before else 0)
+        achievements = len(after.get("achievements", [])) - (len(before.get("achievements", [])) if before else 0)
+        if points > 0 or achievements > 0:
+            self.add(token, max(points, 0), max(achievements, 0), datetime.now())
+
+    def on_foreign_event(self, event):
+        """Event log listener crediting points awarded by other workers."""
+        if event["type"] not in ("points", "achievement", "task"):
+            return
+        achievements = 1 if event["type"] == "achievement" else 0
+        self.add(event["token"], event["amount"], achievements, datetime.fromisoformat(event["ts"]))
+
+    def bucket(self, kind, period=None):
+        """Return (key, start, end, index, closed) for a window, or None.
+
+        Without period this is the current window of kind; otherwise the
+        frozen snapshot of that period, if still retained.
+        """
+        with self._lock:
+            # A clock stepping back never reopens a closed window
+            current = self._roll(kind, datetime.now()) or self._current[kind]
+            if period is None or period == current[0]:
+                return (*current, False)
+            cached = self._frozen.get((kind, period))
+            if cached is not None:
+                self._frozen.move_to_end((kind, period))
+                return (*cached, True)
+        
+        # Periods come from the query string: never let them leave the directory
+        path = self._path(kind, period)
+        if not period.replace('-', '').isalnum() or not os.path.exists(path):
+            return None
+        snapshot = load_json_fody(path)
+        if not snapshot:
+            return None
+        index = LeaderboardIndex()
+        index.load(tuple(entry) for entry in snapshot["entries"])
+        frozen = (
+            period,
+            datetime.fromisoformat(snapshot["starts_at"]),
+            datetime.fromisoformat(snapshot["ends_at"]),
+            index
+        )
+        with self._lock:
+            self._frozen[(kind, period)] = frozen
+            while len(self._frozen) > self.retention * len(LEADERBOARD_WINDOWS):
+                self._frozen.popitem(last=False)
+        return (*frozen, True)
+
+
+storage = open_storage()
+leaderboard_index = LeaderboardIndex()
+windowed_leaderboards = WindowedLeaderboards()
+population_stats = PopulationStats()
+event_log = EventLog(FODY_EVENTS_FILE)
+
+
+def get_user_data(token):
+    """Get user data by token, creating the user on first sight."""
+    user = storage.get_user(token)
+    if user is None:
+        user = storage.create_user(token, new_user_record(token))
+    return user
+
+
+def validate_level_thresholds(thresholds):
+    """Return thresholds as a list of ints, or raise ValueError."""
+    if not isinstance(thresholds, list) or not thresholds:
+        raise ValueError("thresholds must be a non-empty list")
+    thresholds = [int(value) for value in thresholds]
+    if thresholds[0] != 0:
+        raise ValueError("the first threshold must be 0")
+    if any(low >= high for low, high in zip(thresholds, thresholds[1:])):
+        raise ValueError("thresholds must strictly increase")
+    return thresholds
+
+
+_level_table = (None, DEFAULT_LEVEL_THRESHOLDS)
+
+
+def level_thresholds():
+    """Return the current level threshold table from levels.json."""
+    global _level_table
+    source = storage.load_catalog("levels")
+    if _level_table[0] is not source:
+        try:
+            thresholds = validate_level_thresholds(source.get("thresholds"))
+        except (AttributeError, TypeError, ValueError) as e:
+            print(f"Invalid level table, using the default: {e}")
+            thresholds = DEFAULT_LEVEL_THRESHOLDS
+        _level_table = (source, thresholds)
+    return _level_table[1]
+
+
+def calculate_level(points, thresholds=None):
+    """Calculate level from points."""
+    if thresholds is None:
+        thresholds = level_thresholds()
+    return max(bisect_right(thresholds, points), 1)
+
+
+def calculate_level_progress(points, thresholds=None):
+    """Calculate progress to next level (0-100)."""
+    if thresholds is None:
+        thresholds = level_thresholds()
+    level = calculate_level(points, thresholds)
+    if level >= len(thresholds):
+        return 100
+    points_for_current = thresholds[level - 1]
+    points_for_next = thresholds[level]
+    progress = ((points - points_for_current) / (points_for_next - points_for_current)) * 100
+    return min(100, max(0, progress))
+
+
+def recompute_levels(points, thresholds, previous_thresholds=None):
+    """Compute levels, progress and level deltas for many users at once.
+
+    points is a sequence with one entry per user. Returns a dict with
+    "levels", "progress" (0-100) and, when previous_thresholds is given,
+    "deltas" (new level minus the level under the previous table). Uses one
+    vectorised pass with NumPy when it is installed, arrays in and out;
+    otherwise falls back to bisect per user and returns lists.
+    """
+    if numpy is None:
+        levels = [calculate_level(value, thresholds) for value in points]
+        result = {
+            "levels": levels,
+            "progress": [calculate_level_progress(value, thresholds) for value in points],
+        }
+        if previous_thresholds is not None:
+            result["deltas"] = [
+                level - calculate_level(value, previous_thresholds)
+                for level, value in zip(levels, points)
+            ]
+        return result
+    
+    points = numpy.asarray(points, dtype=numpy.float64)
+    table = numpy.asarray(thresholds, dtype=numpy.float64)
+    levels = numpy.maximum(numpy.searchsorted(table, points, side='right'), 1)
+    # The top level has no next threshold and always shows full progress
+    upper = numpy.append(table, numpy.inf)[levels]
+    lower = table[levels - 1]
+    progress = numpy.where(
+        numpy.isinf(upper), 100.0,
+        numpy.clip((points - lower) / (upper - lower) * 100, 0, 100)
+    )
+    result = {"levels": levels, "progress": progress}
+    if previous_thresholds is not None:
+        previous = numpy.maximum(
+            numpy.searchsorted(numpy.asarray(previous_thresholds, dtype=numpy.float64), points, side='right'), 1
+        )
+        result["deltas"] = levels - previous
+    return result
+
+
+def leaderboard_entry(rank, token, points, achievements, thresholds=None):
+    """Build the public leaderboard row for a user."""
+    return {
+        "rank": rank,
+        "token": token[:8] + "...",  # Anonymize
+        "points": points,
+        "level": calculate_level(points, thresholds),
+        "achievements": achievements
+    }
+
+
+# ============================================
+# NOTIFICATION STREAMS
+# ============================================
+
+def format_sse(kind, data, event_id=None):
+    """Render one Server-Sent Events message."""
+    lines = [f"event: {kind}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append("data: " + dumps_json(data).decode('utf-8'))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """One open notification stream."""
+
+    def __init__(self, token):
+        self.token = token
+        self.pending = []
+        self.overflowed = False
+        # Seq of the last notification queued / handed to the client
+        self.queued_seq = None
+        self.delivered_seq = None
+        self.wakeup = threading.Event()
+
+
+class NotificationHub:
+    """Fans out per-user notifications to open event streams.
+
+    Notifications are derived from user writes (storage listener) and from
+    events other workers append to the log. Their SSE id is the event log
+    seq of the write, so a reconnecting client's Last-Event-ID doubles as a
+    /sync cursor: when the backlog no longer reaches back to it, the stream
+    starts with a resync event instead of replaying.
+
+    A subscriber is just a list and an Event to wake its stream, so an idle
+    connection costs one blocked wait (a greenlet under gevent workers).
+    """
+
+    def __init__(self, backlog_size=STREAM_BACKLOG_SIZE, backlog_tokens=STREAM_BACKLOG_TOKENS,
+                 buffer_size=STREAM_SUBSCRIBER_BUFFER, max_subscribers=STREAM_MAX_SUBSCRIBERS,
+                 rank_interval=STREAM_RANK_INTERVAL):
+        self.backlog_size = backlog_size
+        self.backlog_tokens = backlog_tokens
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.rank_interval = rank_interval
+        # Notifications with seq <= horizon may be missing from backlogs
+        self.horizon = 0
+        self._backlogs = OrderedDict()
+        self._subscribers = {}
+        self._ranks = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, horizon=0):
+        self.horizon = horizon
+        self._thread = threading.Thread(target=self._run, name='fody-notifications', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def subscribe(self, token, last_seq=None):
+        """Open a stream for token; return None when at capacity.
+
+        With last_seq, notifications published after it are queued first.
+        """
+        subscription = Subscription(token)
+        subscription.queued_seq = subscription.delivered_seq = last_seq
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            self._count += 1
+            if token not in self._subscribers:
+                self._subscribers[token] = set()
+                self._ranks[token] = leaderboard_index.rank(token)
+            self._subscribers[token].add(subscription)
+            if last_seq is not None:
+                backlog = self._backlogs.get(token)
+                floor = backlog[0] if backlog is not None else self.horizon
+                if last_seq < floor:
+                    subscription.pending.append(format_sse("resync", {"since": last_seq}))
+                for seq, text in (backlog[1] if backlog is not None else ()):
+                    if seq > last_seq:
+                        subscription.pending.append(text)
+                        subscription.queued_seq = seq
+                if subscription.pending:
+                    subscription.wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.token)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            self._count -= 1
+            if not subscribers:
+                del self._subscribers[subscription.token]
+                del self._ranks[subscription.token]
+
+    def next(self, subscription, timeout):
+        """Wait up to timeout for notifications; return their text or None."""
+        if not subscription.wakeup.wait(timeout):
+            return None
+        with self._lock:
+            subscription.wakeup.clear()
+            chunks = subscription.pending
+            subscription.pending = []
+            if subscription.overflowed:
+                # The client fell too far behind; have it catch up via /sync
+                subscription.overflowed = False
+                chunks = [format_sse("resync", {"since": subscription.delivered_seq})]
+            subscription.delivered_seq = subscription.queued_seq
+        return ''.join(chunks) or None
+
+    def publish(self, token, seq, notifications):
+        """Deliver [(kind, data)] notifications of the write with this seq."""
+        if not notifications:
+            return
+        # Only the last message carries the id, so a stream cut off halfway
+        # resumes at the start of the group rather than skipping its tail
+        text = ''.join(
+            format_sse(kind, data, seq if i == len(notifications) - 1 else None)
+            for i, (kind, data) in enumerate(notifications)
+        )
+        with self._lock:
+            backlog = self._backlogs.get(token)
+            if backlog is None:
+                backlog = self._backlogs[token] = [self.horizon, []]
+            self._backlogs.move_to_end(token)
+            backlog[1].append((seq, text))
+            if len(backlog[1]) > self.backlog_size:
+                backlog[0] = backlog[1].pop(0)[0]
+            while len(self._backlogs) > self.backlog_tokens:
+                _, (_, dropped) = self._backlogs.popitem(last=False)
+                self.horizon = max(self.horizon, dropped[-1][0])
+            for subscription in self._subscribers.get(token, ()):
+                self._push(subscription, text)
+                subscription.queued_seq = seq
+
+    def _push(self, subscription, text):
+        if len(subscription.pending) >= self.buffer_size:
+            subscription.overflowed = True
+        else:
+            subscription.pending.append(text)
+        subscription.wakeup.set()
+
+    def on_user_change(self, token, before, after):
+        """Storage listener turning a user write into notifications."""
+        if before is None or after.get("event_seq", 0) <= before.get("event_seq", 0):
+            return
+        notifications = []
+        all_achievements = storage.load_catalog("achievements")
+        for achievement_id in after.get("achievements", [])[len(before.get("achievements", [])):]:
+            notifications.append(("achievement_unlocked", {
+                "achievement": all_achievements.get(achievement_id, {"id": achievement_id})
+            }))
+        all_tasks = storage.load_catalog("tasks")
+        for task_id in after.get("completed_tasks", [])[len(before.get("completed_tasks", [])):]:
+            notifications.append(("task_completed", {
+                "task": all_tasks.get(task_id, {"id": task_id})
+            }))
+        notifications += self._level_up(before.get("points", 0), after.get("points", 0))
+        self.publish(token, after["event_seq"], notifications)
+
+    def on_foreign_event(self, event):
+        """Event log listener for writes made by other workers.
+
+        Must run after LeaderboardIndex.on_foreign_event, whose entry then
+        holds the points after the event.
+        """
+        if event["type"] not in ("points", "achievement", "task"):
+            return
+        notifications = []
+        if event["type"] == "achievement":
+            catalog = storage.load_catalog("achievements")
+            notifications.append(("achievement_unlocked", {
+                "achievement": catalog.get(event["id"], {"id": event["id"]})
+            }))
+        elif event["type"] == "task":
+            catalog = storage.load_catalog("tasks")
+            notifications.append(("task_completed", {
+                "task": catalog.get(event["id"], {"id": event["id"]})
+            }))
+        points = leaderboard_index.points(event["token"])
+        notifications += self._level_up(points - event["amount"], points)
+        self.publish(event["token"], event["seq"], notifications)
+
+    def _level_up(self, old_points, new_points):
+        new_level = calculate_level(new_points)
+        if new_level > calculate_level(old_points):
+            return [("level_up", {"level": new_level, "points": new_points})]
+        return []
+
+    def _run(self):
+        # Ranks move whenever anyone scores, so subscribed users' ranks are
+        # polled from the index instead of being pushed by every write
+        while not self._stopped.wait(self.rank_interval):
+            with self._lock:
+                tokens = list(self._ranks)
+            for token in tokens:
+                rank = leaderboard_index.rank(token)
+                with self._lock:
+                    if token not in self._ranks:
+                        continue
+                    previous = self._ranks[token]
+                    self._ranks[token] = rank
+                    if rank is None or rank == previous:
+                        continue
+                    text = format_sse("rank_changed", {"rank": rank, "previous": previous})
+                    for subscription in self._subscribers[token]:
+                        self._push(subscription, text)
+
+
+notification_hub = NotificationHub()
+
+
+# ============================================
+# GAMIFICATION ACTIONS
+# ============================================
+
+_info_body_cache = {}
+
+
+def gamification_info_body(mimetype=JSON_MIMETYPE):
+    """Return the /info EncodedBody and its ETag, cached per catalog version."""
+    achievements = storage.load_catalog("achievements")
+    tasks = storage.load_catalog("tasks")
+    thresholds = level_thresholds()
+    version = storage.catalog.version
+    cached = _info_body_cache.get(mimetype)
+    if cached is not None and cached[0] == version:
+        metrics.inc('fody_cache_requests_total', (("cache", "info"), ("result", "hit")))
+        return cached[1], cached[2]
+    metrics.inc('fody_cache_requests_total', (("cache", "info"), ("result", "miss")))
+    body = serialize({
+        "achievements": achievements,
+        "tasks": tasks,
+        "point_values": POINT_VALUES,
+        "level_formula": {
+            "description": "Level N needs thresholds[N - 1] points",
+            "thresholds": thresholds,
+            "example": {points: level for level, points in enumerate(thresholds[:5], 1)}
+        }
+    }, mimetype)
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    body = EncodedBody(body, mimetype)
+    _info_body_cache[mimetype] = (version, body, etag)
+    return body, etag
+
+
+class RenderedBodyCache:
+    """Size-bounded LRU of rendered response bodies.
+
+    Entries are tagged with the versions they were rendered from, e.g.
+    (user version, catalog version) for /status; a lookup with any other
+    versions misses, so a change invalidates without explicit eviction.
+    """
+
+    def __init__(self, name, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hit = (("cache", name), ("result", "hit"))
+        self._miss = (("cache", name), ("result", "miss"))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != versions:
+                metrics.inc('fody_cache_requests_total', self._miss)
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc('fody_cache_requests_total', self._hit)
+        return entry[1]
+
+    def put(self, key, versions, body):
+        with self._lock:
+            self._entries[key] = (versions, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+status_cache = RenderedBodyCache('status', STATUS_CACHE_SIZE)
+leaderboard_cache = RenderedBodyCache('leaderboard', LEADERBOARD_CACHE_SIZE)
+
+
+def status_etag(versions, mimetype=JSON_MIMETYPE):
+    """ETag for a user's status at the given (user, catalog) versions."""
+    if mimetype == MSGPACK_MIMETYPE:
+        return f"{versions[0]}-{versions[1]}-msgpack"
+    return f"{versions[0]}-{versions[1]}"
+
+
+# Catalogs a status body is rendered from; any of them changing must
+# change its ETag
+STATUS_CATALOGS = ("achievements", "tasks", "levels")
+
+
+def render_user_status(token, mimetype=JSON_MIMETYPE):
+    """Return the status EncodedBody and its versions, cached."""
+    all_achievements = storage.load_catalog("achievements")
+    all_tasks = storage.load_catalog("tasks")
+    thresholds = level_thresholds()
+    catalog_version = storage.catalog.version
+    version = storage.get_version(token)
+    if version is not None:
+        body = status_cache.get((token, mimetype), (version, catalog_version))
+        if body is not None:
+            return body, (version, catalog_version)
+    
+    user = get_user_data(token)
+    versions = (user.get("version", 0), catalog_version)
+    with metrics.timer('fody_render_seconds', (("body", "status"),)):
+        body = EncodedBody(serialize(build_user_status(token, user, all_achievements, all_tasks, thresholds), mimetype), mimetype)
+    status_cache.put((token, mimetype), versions, body)
+    return body, versions
+
+
+def build_user_status(token, user=None, all_achievements=None, all_tasks=None, thresholds=None):
+    """Build the status payload returned for a user."""
+    if user is None:
+        user = get_user_data(token)
+    
+    # Calculate level
+    if thresholds is None:
+        thresholds = level_thresholds()
+    points = user.get("points", 0)
+    level = calculate_level(points, thresholds)
+    level_progress = calculate_level_progress(points, thresholds)
+    
+    # Get next level info (the top level has none)
+    points_for_next_level = thresholds[min(level, len(thresholds) - 1)]
+    points_needed = max(0, points_for_next_level - points)
+    
+    # Get unlocked achievements
+    unlocked_ids = set(user.get("achievements", []))
+    if all_achievements is None:
+        all_achievements = storage.load_catalog("achievements")
+    unlocked_achievements = [
+        {**ach, "unlocked_at": user.get("achievement_unlocks", {}).get(ach_id, None)}
+        for ach_id, ach in all_achievements.items()
+        if ach_id in unlocked_ids
+    ]
+    
+    # Get completed tasks
+    completed_task_ids = set(user.get("completed_tasks", []))
+    if all_tasks is None:
+        all_tasks = storage.load_catalog("tasks")
+    completed_tasks = [
+        {**task, "completed_at": user.get("task_completions", {}).get(task_id, None)}
+        for task_id, task in all_tasks.items()
+        if task_id in completed_task_ids
+    ]
+    
+    return {
+        "token": token,
+        "points": points,
+        "level": level,
+        "level_progress": round(level_progress, 1),
+        "points_to_next_level": points_needed,
+        "next_level_points": points_for_next_level,
+        "achievements": {
+            "unlocked": len(unlocked_achievements),
+            "total": len(all_achievements),
+            "list": unlocked_achievements
+        },
+        "tasks": {
+            "completed": len(completed_tasks),
+            "total": len(all_tasks),
+            "list": completed_tasks
+        },
+        "stats": {
+            "total_uploads": user.get("total_uploads", 0),
+            "total_notes": user.get("total_notes", 0)
+        },
+        "settings": user.get("settings", {"gamification_enabled": True}),
+        "created_at": user.get("created_at"),
+        "last_active": user.get("last_active")
+    }
+
+
+ACHIEVEMENT_RULE_KEYS = {"actions", "counter", "at_least", "hours", "weekdays", "within_session_seconds", "details"}
+
+
+def compile_achievement_rule(rule):
+    """Turn a declarative rule into a predicate matches(user, when, local, details).
+
+    when is the event's server time, local the same instant on the
+    client's wall clock (see client_time), details the event's details.
+
+    Raises ValueError for unknown keys, so a misspelt condition cannot
+    silently turn into an always-true rule.
+    """
+    unknown = set(rule) - ACHIEVEMENT_RULE_KEYS
+    if unknown:
+        raise ValueError(f"unknown keys {sorted(unknown)}")
+    counter = rule.get("counter")
+    at_least = rule.get("at_least", 1)
+    hours = rule.get("hours")
+    if hours is not None:
+        start, end = (int(hour) for hour in hours)
+    weekdays = frozenset(rule["weekdays"]) if rule.get("weekdays") is not None else None
+    within = rule.get("within_session_seconds")
+    expected = dict(rule["details"]).items() if rule.get("details") is not None else None
+    
+    def matches(user, when, local, details):
+        if counter is not None and user.get(counter, 0) < at_least:
+            return False
+        if hours is not None:
+            hour = local.hour
+            if not (start <= hour < end if start <= end else hour >= start or hour < end):
+                return False
+        if weekdays is not None and local.weekday() not in weekdays:
+            return False
+        if within is not None:
+            started = user.get("session_started_at")
+            if not started or (when - datetime.fromisoformat(started)).total_seconds() > within:
+                return False
+        if expected is not None and not (
+            isinstance(details, dict) and all(details.get(key) == value for key, value in expected)
+        ):
+            return False
+        return True
+    
+    return matches
+
+
+class AchievementRules:
+    """Achievement rules compiled into an index keyed by action.
+
+    A points event only evaluates the rules listing its action plus the "*"
+    rules, so its cost follows the rules it can affect rather than the size
+    of the catalog. The index is rebuilt when the rules file changes.
+    """
+
+    def __init__(self):
+        # (source rules, {action: [(achievement_id, matches, state_only)]}),
+        # swapped as a whole so readers never see a half-built index
+        self._compiled = (None, {})
+        self._lock = threading.Lock()
+
+    def index(self):
+        """Return the compiled index for the current rules file."""
+        rules = storage.load_catalog("achievement_rules")
+        compiled = self._compiled
+        if compiled[0] is rules:
+            return compiled[1]
+        with self._lock:
+            if self._compiled[0] is not rules:
+                index = {}
+                for achievement_id, rule in rules.items():
+                    try:
+                        matches = compile_achievement_rule(rule)
+                    except (TypeError, ValueError) as e:
+                        print(f"Skipping achievement rule {achievement_id}: {e}")
+                        continue
+                    # Pure counter rules depend only on the user's current
+                    # totals, so a backfill can check them without history
+                    state_only = "counter" in rule and not (
+                        {"hours", "weekdays", "within_session_seconds", "details"} & set(rule)
+                    )
+                    for action in rule.get("actions", ["*"]):
+                        index.setdefault(action, []).append((achievement_id, matches, state_only))
+                self._compiled = (rules, index)
+            return self._compiled[1]
+
+    def for_action(self, action):
+        """Return the (achievement_id, matches, state_only) rules an action can affect."""
+        index = self.index()
+        return index.get(action, []) + index.get("*", [])
+
+
+achievement_rules = AchievementRules()
+
+
+def client_time(when, utc_offset):
+    """Return the server-local time when on a client clock utc_offset minutes east of UTC.
+
+    Without an offset the server's clock stands in for the client's.
+    """
+    if utc_offset is None:
+        return when
+    return (when.astimezone(timezone.utc) + timedelta(minutes=utc_offset)).replace(tzinfo=None)
+
+
+def earned_achievements(user, candidates, when, catalog, utc_offset=None, details=None):
+    """Return ids of catalog achievements user newly meets among candidates."""
+    unlocked = set(user.get("achievements", []))
+    local = client_time(when, utc_offset)
+    return [
+        achievement_id for achievement_id, matches, _ in candidates
+        if achievement_id in catalog and achievement_id not in unlocked
+        and matches(user, when, local, details)
+    ]
+
+
+def valid_token(token):
+    """Tokens are client-generated strings of at least 8 characters."""
+    return isinstance(token, str) and len(token) >= 8
+
+
+def points_error(points, action, details, utc_offset=None):
+    """Return why a points award is invalid, or None."""
+    if isinstance(points, bool) or not isinstance(points, (int, float)) or not points > 0:
+        return "Points must be positive"
+    if points > MAX_POINTS_PER_AWARD:
+        return f"At most {MAX_POINTS_PER_AWARD} points per award"
+    if not isinstance(action, str):
+        return "Action must be a string"
+    if details is not None and not isinstance(details, dict):
+        return "Details must be an object"
+    if utc_offset is not None and (
+        isinstance(utc_offset, bool) or not isinstance(utc_offset, int) or abs(utc_offset) > MAX_UTC_OFFSET
+    ):
+        return f"utc_offset must be whole minutes within ±{MAX_UTC_OFFSET}"
+    return None
+
+
+def event_error(event, default_token):
+    """Return why a batch event cannot be applied, or None."""
+    if not isinstance(event, dict):
+        return "Invalid event"
+    if not valid_token(event.get('token', default_token)):
+        return "Invalid token"
+    kind = event.get('type')
+    if kind == 'points':
+        return points_error(event.get('points', 0), event.get('action', 'general'), event.get('details', {}),
+                            event.get('utc_offset'))
+    if kind == 'achievement':
+        return None if _valid_id(event.get('achievement_id')) else "Achievement ID required"
+    if kind == 'task':
+        return None if _valid_id(event.get('task_id')) else "Task ID required"
+    return "Unknown event type"
+
+
+def _valid_id(item_id):
+    return isinstance(item_id, str) and item_id != ''
+
+
+def award_points(token, points, action='general', details=None, utc_offset=None):
+    """Add points to user; return (response body, status code).
+    
+    utc_offset (minutes east of UTC) places the event on the client's
+    clock for hour and weekday achievement rules.
+    """
+    if not valid_token(token):
+        return {"error": "Invalid token"}, 400
+    
+    error = points_error(points, action, details, utc_offset)
+    if error:
+        return {"error": error}, 400
+    
+    details = details if details is not None else {}
+    all_achievements = storage.load_catalog("achievements")
+    candidates = achievement_rules.for_action(action)
+    
+    def apply(user):
+        old_points = user.get("points", 0)
+        event = {
+            "type": "points",
+            "action": action,
+            "amount": points,
+            "details": details
+        }
+        if utc_offset is not None:
+            # Kept so a backfill replays the rules on the same clock
+            event["utc_offset"] = utc_offset
+        update_data, logged = record_events(token, user, [event])
+        
+        # Unlock rule-based achievements in the same mutation
+        when = datetime.fromisoformat(logged[0]["ts"])
+        earned = earned_achievements({**user, **update_data}, candidates, when, all_achievements,
+                                     utc_offset, details)
+        if earned:
+            unlock_data, _ = record_events(token, {**user, **update_data}, [
+                {"type": "achievement", "id": achievement_id,
+                 "amount": all_achievements[achievement_id].get("points", 0)}
+                for achievement_id in earned
+            ])
+            update_data.update(unlock_data)
+        return update_data, (old_points, earned)
+    
+    user, (old_points, earned) = storage.mutate_user(token, apply)
+    new_points = user["points"]
+    
+    # Check for level up
+    old_level = calculate_level(old_points)
+    new_level = calculate_level(new_points)
+    level_up = new_level > old_level
+    
+    unlocked = [all_achievements[achievement_id] for achievement_id in earned]
+    message = f"+{points} bodů" + (f" 🎉 LEVEL {new_level}!" if level_up else "")
+    for achievement in unlocked:
+        message += f" 🏆 {achievement['icon']} {achievement['name']}"
+    
+    return {
+        "success": True,
+        "points_added": points,
+        "total_points": new_points,
+        "level": new_level,
+        "level_up": level_up,
+        "achievements_unlocked": unlocked,
+        "message": message
+    }, 200
+
+
+def award_achievement(token, achievement_id):
+    """Unlock an achievement for user; return (response body, status code)."""
+    if not valid_token(token):
+        return {"error": "Invalid token"}, 400
+    
+    if not _valid_id(achievement_id):
+        return {"error": "Achievement ID required"}, 400
+    
+    # Get achievement info
+    all_achievements = storage.load_catalog("achievements")
+    if achievement_id not in all_achievements:
+        return {"error": "Achievement not found"}, 404
+    
+    achievement = all_achievements[achievement_id]
+    points_reward = achievement.get("points", 0)
+    
+    # Repeats are common (clients resend) and need no write lock
+    if storage.has_achievement(token, achievement_id):
+        return {
+            "success": False,
+            "message": "Achievement already unlocked"
+        }, 200
+    
+    def apply(user):
+        # Checked again under the mutation lock in case of a concurrent award
+        if achievement_id in user.get("achievements", []):
+            return None, False
+        
+        # Unlock achievement
+        update_data, _ = record_events(token, user, [{
+            "type": "achievement",
+            "id": achievement_id,
+            "amount": points_reward
+        }])
+        return update_data, True
+    
+    _, unlocked = storage.mutate_user(token, apply)
+    if not unlocked:
+        return {
+            "success": False,
+            "message": "Achievement already unlocked"
+        }, 200
+    
+    return {
+        "success": True,
+        "achievement": achievement,
+        "points_earned": points_reward,
+        "message": f"🏆 {achievement['icon']} {achievement['name']} - +{points_reward} bodů!"
+    }, 200
+
+
+def award_task(token, task_id):
+    """Mark a task as completed; return (response body, status code)."""
+    if not valid_token(token):
+        return {"error": "Invalid token"}, 400
+    
+    if not _valid_id(task_id):
+        return {"error": "Task ID required"}, 400
+    
+    # Get task info
+    all_tasks = storage.load_catalog("tasks")
+    if task_id not in all_tasks:
+        return {"error": "Task not found"}, 404
+    
+    task = all_tasks[task_id]
+    points_reward = task.get("points", 0)
+    
+    if storage.has_completed(token, task_id):
+        return {
+            "success": False,
+            "message": "Task already completed"
+        }, 200
+    
+    def apply(user):
+        if task_id in user.get("completed_tasks", []):
+            return None, False
+        
+        # Complete task
+        update_data, _ = record_events(token, user, [{
+            "type": "task",
+            "id": task_id,
+            "amount": points_reward
+        }])
+        return update_data, True
+    
+    _, completed = storage.mutate_user(token, apply)
+    if not completed:
+        return {
+            "success": False,
+            "message": "Task already completed"
+        }, 200
+    
+    return {
+        "success": True,
+        "task": task,
+        "points_earned": points_reward,
+        "message": f"✅ {task['icon']} {task['name']} - +{points_reward} bodů!"
+    }, 200
+
+
+# ============================================
+# API ENDPOINTS
+# ============================================
+
+def idempotency_token():
+    """Token an Idempotency-Key is scoped to: the one in the request body."""
+    data = request.get_json(silent=True)
+    token = data.get('token') if isinstance(data, dict) else None
+    return token if isinstance(token, str) else ''
+
+
+def request_fingerprint():
+    """Hash of the route and body a stored response answers."""
+    return hashlib.sha256(request.path.encode('utf-8') + b'\0' + request.get_data()).hexdigest()
+
+
+def idempotent(view):
+    """Answer a repeated Idempotency-Key with the stored response.
+    
+    Keys are scoped to the token in the request body. The storage lock is
+    held only to look the key up and reserve it, and later to store the
+    response; the view itself runs outside it, so idempotent writes do not
+    serialise behind each other. A duplicate arriving while the key is
+    reserved gets 409 and should retry later; a replay does no other
+    storage work. A key reused on another route or with another body gets
+    422 rather than the first request's response.
+    
+    Server errors (5xx, or an exception from the view) are not stored:
+    the reservation is dropped and the client may retry with the same key.
+    That is safe because a failed request rolls back its storage
+    transaction, so it has applied nothing.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key too long"}), 400
+        
+        token = idempotency_token()
+        fingerprint = request_fingerprint()
+        with storage.transaction():
+            stored = storage.get_idempotent(token, key)
+            if stored is None:
+                storage.put_idempotent(token, key, fingerprint, IDEMPOTENCY_PENDING, '', b'',
+                                       IDEMPOTENCY_PENDING_TTL)
+        if stored is not None:
+            stored_fingerprint, status, mimetype, body = stored
+            if stored_fingerprint and stored_fingerprint != fingerprint:
+                return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+            if status == IDEMPOTENCY_PENDING:
+                response = jsonify({"error": "A request with this Idempotency-Key is in progress"})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            response = Response(body, status=status, mimetype=mimetype)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            storage.delete_idempotent(token, key)
+            raise
+        if response.status_code < 500:
+            storage.put_idempotent(token, key, fingerprint, response.status_code, response.mimetype,
+                                   response.get_data())
+        else:
+            storage.delete_idempotent(token, key)
+        return response
+    
+    wrapper.idempotent = True
+    return wrapper
+
+
+@bp.route('/api/gamification/info', methods=['GET'])
+def get_gamification_info():
+    """Get gamification information - achievements, tasks, point values.
+    
+    The body only changes with the catalog, so it is serialised once per
+    catalog version and clients revalidate with If-None-Match.
+    """
+    body, etag = gamification_info_body(response_mimetype())
+    return body.response(etag).make_conditional(request)
+
+
+@bp.route('/api/gamification/status/<token>', methods=['GET'])
+def get_user_status(token):
+    """Get user's gamification status.
+    
+    Unchanged users are answered from the rendered-body cache, or with 304
+    when the client's ETag still matches, without loading the record.
+    """
+    if not valid_token(token):
+        return jsonify({"error": "Invalid token"}), 400
+    
+    mimetype = response_mimetype()
+    version = storage.get_version(token)
+    if version is not None:
+        etag = status_etag((version, storage.catalog.check(STATUS_CATALOGS)), mimetype)
+        encoding = response_encoding()
+        # Large bodies are tagged per Content-Encoding (see EncodedBody)
+        for tag in (etag, f"{etag}-{encoding}") if encoding else (etag,):
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+                response.set_etag(tag)
+                return response
+    
+    body, versions = render_user_status(token, mimetype)
+    return body.response(status_etag(versions, mimetype))
+
+
+@bp.route('/api/gamification/points', methods=['POST'])
+@idempotent
+def add_points():
+    """Add points to user."""
+    data = request.json
+    body, status = award_points(
+        data.get('token'),
+        data.get('points', 0),
+        data.get('action', 'general'),
+        data.get('details', {}),
+        data.get('utc_offset')
+    )
+    return jsonify(body), status
+
+
+@bp.route('/api/gamification/achievement', methods=['POST'])
+@idempotent
+def unlock_achievement():
+    """Unlock an achievement for user."""
+    data = request.json
+    body, status = award_achievement(data.get('token'), data.get('achievement_id'))
+    return jsonify(body), status
+
+
+@bp.route('/api/gamification/task', methods=['POST'])
+@idempotent
+def complete_task():
+    """Mark a task as completed."""
+    data = request.json
+    body, status = award_task(data.get('token'), data.get('task_id'))
+    return jsonify(body), status
+
+
+@bp.route('/api/gamification/events', methods=['POST'])
+@idempotent
+def apply_events():
+    """Apply an ordered batch of point, achievement and task events.
+    
+    Lets a client replay its offline queue in one round trip. Every event
+    is checked first; if any is malformed nothing is applied and the
+    response lists them. The events are then applied in a single storage
+    transaction, which rolls back as a whole if applying fails; each gets
+    its own result and every token touched gets its final status.
+    """
+    data = request.json or {}
+    events = data.get('events')
+    default_token = data.get('token')
+    
+    if not isinstance(events, list):
+        return jsonify({"error": "Events list required"}), 400
+    
+    if len(events) > MAX_BATCH_EVENTS:
+        return jsonify({"error": f"At most {MAX_BATCH_EVENTS} events per batch"}), 413
+    
+    invalid = []
+    for i, event in enumerate(events):
+        error = event_error(event, default_token)
+        if error:
+            invalid.append({"index": i, "error": error})
+    if invalid:
+        return jsonify({"error": "Invalid events", "invalid": invalid}), 400
+    
+    results = []
+    tokens = []
+    with storage.transaction():
+        for event in events:
+            token = event.get('token', default_token)
+            kind = event.get('type')
+            if kind == 'points':
+                body, status = award_points(
+                    token,
+                    event.get('points', 0),
+                    event.get('action', 'general'),
+                    event.get('details', {}),
+                    event.get('utc_offset')
+                )
+            elif kind == 'achievement':
+                body, status = award_achievement(token, event.get('achievement_id'))
+            else:
+                body, status = award_task(token, event.get('task_id'))
+            
+            if status == 200 and token not in tokens:
+                tokens.append(token)
+            results.append({"status": status, **body})
+    
+    return jsonify({
+        "success": True,
+        "results": results,
+        "status": {token: build_user_status(token) for token in tokens}
+    }), 200
+
+
+@bp.route('/api/gamification/sync', methods=['POST'])
+@idempotent
+def full_sync():
+    """Synchronise client state with the server.
+    
+    With "since" (the cursor returned by the previous sync) the response
+    only carries what changed for this user after that cursor, read from
+    the user's events in the log. Without it, or when the cursor predates
+    compacted history, the full status is returned as before.
+    """
+    data = request.json
+    token = data.get('token')
     client_data = data.get('data', {})
+    since = data.get('since')
     
-    if not token or len(token) < 8:
+    if not valid_token(token):
         return jsonify({"error": "Invalid token"}), 400
     
-    user = get_user_data(token)
-    
-    # Merge local data with server data
-    # Server data takes precedence for persistent state
-    
-    # Process achievements to unlock
-    client_achievements = client_data.get("achievements", [])
-    server_achievements = user.get("achievements", [])
-    all_achievements = load_json_fody(FODY_ACHIEVEMENTS_FILE)
-    
-    # Unlock any new achievements
-    new_achievements = []
-    for ach_id in client_achievements:
-        if ach_id not in server_achievements and ach_id in all_achievements:
-            server_achievements.append(ach_id)
-            new_achievements.append({
-                **all_achievements[ach_id],
-                "unlocked_at": datetime.now().isoformat()
-            })
+    if since is not None and (not isinstance(since, int) or since < 0):
+        return jsonify({"error": "since must be a non-negative integer"}), 400
     
-    # Process completed tasks
-    client_tasks = client_data.get("completed_tasks", [])
-    server_tasks = user.get("completed_tasks", [])
-    all_tasks = load_json_fody(FODY_TASKS_FILE)
-    
-    new_tasks = []
-    for task_id in client_tasks:
-        if task_id not in server_tasks and task_id in all_tasks:
-            server_tasks.append(task_id)
-            new_tasks.append({
-                **all_tasks[task_id],
-                "completed_at": datetime.now().isoformat()
-            })
+    all_achievements = storage.load_catalog("achievements")
+    all_tasks = storage.load_catalog("tasks")
     
-    # Calculate total points to award
-    points_to_add = 0
-    for ach in new_achievements:
-        points_to_add += ach.get("points", 0)
-    for task in new_tasks:
-        points_to_add += task.get("points", 0)
-    
-    # Update server data
-    update_data = {
-        "achievements": server_achievements,
-        "completed_tasks": server_tasks,
-        "points": user.get("points", 0) + points_to_add,
-        "settings": client_data.get("settings", user.get("settings", {}))
-    }
+    def apply(user):
+        # Merge local data with server data
+        # Server data takes precedence for persistent state
+        events = []
+        
+        # Unlock any new achievements
+        server_achievements = set(user.get("achievements", []))
+        for ach_id in dict.fromkeys(client_data.get("achievements", [])):
+            if ach_id not in server_achievements and ach_id in all_achievements:
+                events.append({
+                    "type": "achievement",
+                    "id": ach_id,
+                    "amount": all_achievements[ach_id].get("points", 0)
+                })
+        
+        # Process completed tasks
+        server_tasks = set(user.get("completed_tasks", []))
+        for task_id in dict.fromkeys(client_data.get("completed_tasks", [])):
+            if task_id not in server_tasks and task_id in all_tasks:
+                events.append({
+                    "type": "task",
+                    "id": task_id,
+                    "amount": all_tasks[task_id].get("points", 0)
+                })
+        
+        # Client settings are merged key by key over the server's
+        client_settings = client_data.get("settings")
+        if isinstance(client_settings, dict):
+            settings = {**user.get("settings", {}), **client_settings}
+            if settings != user.get("settings", {}):
+                events.append({"type": "settings", "settings": settings})
+        
+        update_data, logged = record_events(token, user, events)
+        
+        new_achievements = [
+            {**all_achievements[event["id"]], "unlocked_at": event["ts"]}
+            for event in logged if event["type"] == "achievement"
+        ]
+        new_tasks = [
+            {**all_tasks[event["id"]], "completed_at": event["ts"]}
+            for event in logged if event["type"] == "task"
+        ]
+        
+        # Calculate total points awarded
+        points_to_add = sum(event.get("amount", 0) for event in logged)
+        return update_data, (new_achievements, new_tasks, points_to_add)
     
-    update_user_data(token, update_data)
+    user, (new_achievements, new_tasks, points_to_add) = storage.mutate_user(token, apply)
     
-    # Return full status
-    return jsonify({
+    response = {
         "success": True,
         "new_achievements": new_achievements,
         "new_tasks": new_tasks,
         "points_earned": points_to_add,
-        "status": get_user_status(token)[0].get_json()
-    }), 200
+        "cursor": user.get("event_seq", 0)
+    }
+    
+    if since is None or since < event_log.horizon:
+        # Return full status
+        response["full"] = True
+        response["status"] = build_user_status(token, user, all_achievements, all_tasks)
+    else:
+        response["full"] = False
+        response["changes"] = summarize_events(event_log.history(token, since_seq=since))
+        response["points"] = user.get("points", 0)
+        response["level"] = calculate_level(user.get("points", 0))
+    
+    return jsonify(response), 200
+
+
+def summarize_events(events):
+    """Collapse a user's logged events into the delta a sync client needs."""
+    changes = {"achievements": [], "tasks": [], "points_earned": 0}
+    for event in events:
+        changes["points_earned"] += event.get("amount", 0)
+        if event["type"] == "achievement":
+            changes["achievements"].append({"id": event["id"], "unlocked_at": event["ts"]})
+        elif event["type"] == "task":
+            changes["tasks"].append({"id": event["id"], "completed_at": event["ts"]})
+        elif event["type"] == "settings":
+            changes["settings"] = event["settings"]
+    return changes
 
 
-@app.route('/api/gamification/leaderboard', methods=['GET'])
+@bp.route('/api/gamification/leaderboard', methods=['GET'])
 def get_leaderboard():
-    """Get points leaderboard."""
-    users = load_json_fody(FODY_USERS_FILE)
-    
-    # Sort by points
-    leaderboard = []
-    for token, user_data in users.items():
-        points = user_data.get("points", 0)
-        level = calculate_level(points)
-        achievements = len(user_data.get("achievements", []))
-        
-        leaderboard.append({
-            "token": token[:8] + "...",  # Anonymize
-            "points": points,
-            "level": level,
-            "achievements": achievements
-        })
+    """Get points leaderboard page (top 100 by default).
+    
+    window=week|month|period ranks the points earned in the current window
+    instead of all-time points; add period=<key> (e.g. 2026-W41) for a
+    closed window's frozen standings.
+    """
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    window = request.args.get('window', 'all')
+    mimetype = response_mimetype()
+    
+    if window == 'all':
+        index, extra = leaderboard_index, {}
+    elif window in LEADERBOARD_WINDOWS:
+        bucket = windowed_leaderboards.bucket(window, request.args.get('period'))
+        if bucket is None:
+            return jsonify({"error": "Unknown period"}), 404
+        period, start, end, index, closed = bucket
+        extra = {
+            "window": window,
+            "period": period,
+            "starts_at": start.isoformat(),
+            "ends_at": end.isoformat(),
+            "closed": closed
+        }
+    else:
+        return jsonify({"error": f"window must be all or one of {', '.join(LEADERBOARD_WINDOWS)}"}), 400
+    
+    # Rendered (and compressed) once per leaderboard or level curve change
+    key = (offset, limit, mimetype, window, extra.get("period"), extra.get("closed"))
+    thresholds = level_thresholds()
+    version = (index.version, storage.catalog.version)
+    body = leaderboard_cache.get(key, version)
+    if body is None:
+        with metrics.timer('fody_render_seconds', (("body", "leaderboard"),)):
+            rows = index.page(offset, limit)
+            leaderboard = [
+                leaderboard_entry(rank, token, points, achievements, thresholds)
+                for rank, token, points, achievements in rows
+            ]
+            if index is not leaderboard_index:
+                # Window boards rank window points but show the overall level
+                for entry, (_, token, _, _) in zip(leaderboard, rows):
+                    entry["level"] = calculate_level(leaderboard_index.points(token), thresholds)
+            body = EncodedBody(serialize({
+                "leaderboard": leaderboard,
+                "offset": offset,
+                "limit": limit,
+                "total_users": len(index),
+                **extra
+            }, mimetype), mimetype)
+        leaderboard_cache.put(key, version, body)
+    
+    return body.response()
+
+
+@bp.route('/api/gamification/rank/<token>', methods=['GET'])
+def get_user_rank(token):
+    """Get user's leaderboard rank with the entries around it."""
+    if not valid_token(token):
+        return jsonify({"error": "Invalid token"}), 400
+    
+    rank = leaderboard_index.rank(token)
+    if rank is None:
+        return jsonify({"error": "User not found"}), 404
+    
+    around = min(max(request.args.get('around', 5, type=int), 0), 50)
+    start = max(rank - 1 - around, 0)
+    thresholds = level_thresholds()
+    neighbours = [
+        leaderboard_entry(*entry, thresholds)
+        for entry in leaderboard_index.page(start, rank - start + around)
+    ]
     
-    # Sort and take top 100
-    leaderboard.sort(key=lambda x: x["points"], reverse=True)
-    leaderboard = leaderboard[:100]
+    return jsonify({
+        "rank": rank,
+        "total_users": len(leaderboard_index),
+        "neighbours": neighbours
+    }), 200
+
+
+@bp.route('/api/gamification/history/<token>', methods=['GET'])
+def get_user_history(token):
+    """Get user's points/achievement/task history from the event log."""
+    if not valid_token(token):
+        return jsonify({"error": "Invalid token"}), 400
+    
+    since = request.args.get('since', 0, type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    
+    events = event_log.history(token, since_seq=since, limit=limit)
+    for event in events:
+        del event["token"]
+    
+    return jsonify({
+        "token": token,
+        "events": events,
+        "next_since": events[-1]["seq"] if events else since
+    }), 200
+
+
+@bp.route('/api/gamification/analytics', methods=['GET'])
+def get_analytics():
+    """Population aggregates: unlock and completion rates, levels, daily actives.
+    
+    Served from counters kept up to date on every write, never from a scan
+    of all users.
+    """
+    users, unlocks, completions, levels, active = population_stats.snapshot()
     
-    # Add ranks
-    for i, entry in enumerate(leaderboard):
-        entry["rank"] = i + 1
+    def rate(count):
+        return round(count / users, 4) if users else 0
     
     return jsonify({
-        "leaderboard": leaderboard,
-        "total_users": len(users)
+        "total_users": users,
+        "achievements": {
+            achievement_id: {"unlocked": unlocks.get(achievement_id, 0), "rate": rate(unlocks.get(achievement_id, 0))}
+            for achievement_id in storage.load_catalog("achievements")
+        },
+        "tasks": {
+            task_id: {"completed": completions.get(task_id, 0), "rate": rate(completions.get(task_id, 0))}
+            for task_id in storage.load_catalog("tasks")
+        },
+        "levels": levels,
+        "active_users": active,
+        "last_verification": population_stats.last_rebuild
     }), 200
 
 
-@app.route('/api/gamification/settings', methods=['POST'])
+@bp.route('/api/gamification/stream/<token>', methods=['GET'])
+def stream_notifications(token):
+    """Stream level-up, achievement, task and rank notifications (SSE).
+    
+    Event types: level_up, achievement_unlocked, task_completed,
+    rank_changed and resync. A reconnecting client sends Last-Event-ID
+    (EventSource does so itself) or ?last_event_id= to receive what it
+    missed; resync means that is no longer available and the client should
+    call /sync with "since" set to the given value.
+    """
+    if not valid_token(token):
+        return jsonify({"error": "Invalid token"}), 400
+    
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_seq = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID must be an integer"}), 400
+    
+    subscription = notification_hub.subscribe(token, last_seq)
+    if subscription is None:
+        response = jsonify({'error': 'Too many open streams, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    def generate():
+        try:
+            yield f"retry: {int(STREAM_HEARTBEAT_INTERVAL * 1000)}\n\n"
+            while True:
+                chunk = notification_hub.next(subscription, STREAM_HEARTBEAT_INTERVAL)
+                # A comment line keeps proxies from closing an idle stream
+                yield chunk if chunk is not None else ': heartbeat\n\n'
+        finally:
+            notification_hub.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.route('/api/gamification/settings', methods=['POST'])
+@idempotent
 def update_settings():
     """Update user settings."""
     data = request.json
     token = data.get('token')
     settings = data.get('settings', {})
     
-    if not token or len(token) < 8:
+    if not valid_token(token):
         return jsonify({"error": "Invalid token"}), 400
     
-    user = get_user_data(token)
-    current_settings = user.get("settings", {})
-    
-    # Merge settings
-    current_settings.update(settings)
+    def apply(user):
+        current_settings = user.get("settings", {})
+        
+        # Merge settings
+        current_settings.update(settings)
+        update_data, _ = record_events(token, user, [{"type": "settings", "settings": current_settings}])
+        return update_data, current_settings
     
-    update_user_data(token, {"settings": current_settings})
+    _, current_settings = storage.mutate_user(token, apply)
     
     return jsonify({
         "success": True,
@@ -666,41 +3832,464 @@ def update_settings():
     }), 200
 
 
-@app.route('/api/gamification/initialize', methods=['POST'])
+@bp.route('/api/gamification/initialize', methods=['POST'])
+@idempotent
 def initialize_user():
     """Initialize user with token (called on first app launch)."""
     data = request.json
     token = data.get('token')
     device_info = data.get('device_info', {})
     
-    if not token or len(token) < 8:
+    if not valid_token(token):
         return jsonify({"error": "Invalid token"}), 400
     
-    user = get_user_data(token)
+    all_achievements = storage.load_catalog("achievements")
     
-    # If new user, add first login achievement
-    if user.get("created_at") == user.get("last_active"):
-        all_achievements = load_json(ACHIEVEMENTS_FILE)
-        if "first_login" in all_achievements and "first_login" not in user.get("achievements", []):
-            achievements = user.get("achievements", []) + ["first_login"]
-            update_user_data(token, {
-                "achievements": achievements,
-                "achievement_unlocks_first_login": datetime.now().isoformat(),
-                "points": user.get("points", 0) + all_achievements["first_login"]["points"]
-            })
+    def apply(user):
+        # If new user, add first login achievement
+        if user.get("created_at") != user.get("last_active"):
+            return None, None
+        if "first_login" not in all_achievements or "first_login" in user.get("achievements", []):
+            return None, None
+        update_data, _ = record_events(token, user, [{
+            "type": "achievement",
+            "id": "first_login",
+            "amount": all_achievements["first_login"]["points"]
+        }])
+        return update_data, None
+    
+    storage.mutate_user(token, apply)
     
     return jsonify({
         "success": True,
         "message": "User initialized",
-        "status": get_user_status(token)[0].get_json()
+        "status": build_user_status(token)
     }), 200
 
 
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.inc('fody_http_requests_total', (
+            ("route", route), ("method", request.method), ("status", response.status_code)
+        ))
+        metrics.observe('fody_http_request_seconds', (("route", route),), time.perf_counter() - started)
+    return response
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request, storage, cache and queue metrics in Prometheus format."""
+    counters, _ = metrics.snapshot()
+    hit_ratios = []
+    for cache in ("catalog", "info", "status", "leaderboard"):
+        hits = counters.get(('fody_cache_requests_total', (("cache", cache), ("result", "hit"))), 0)
+        misses = counters.get(('fody_cache_requests_total', (("cache", cache), ("result", "miss"))), 0)
+        if hits + misses:
+            hit_ratios.append(((("cache", cache),), hits / (hits + misses)))
+    
+    gauges = [
+        ('fody_users', 'Users in storage', [((), storage.count_users())]),
+        ('fody_users_dirty', 'Users waiting for the write-behind flush',
+         [((), len(storage.dirty))] if isinstance(storage, JsonStorage) else []),
+        ('fody_event_log_seq', 'Highest event seq seen', [((), event_log.seq)]),
+        ('fody_event_log_size_bytes', 'Size of the event log file', [((), event_log._size)]),
+        ('fody_event_log_pending_fsync', 'Appended events not yet fsynced', [((), event_log._pending)]),
+        ('fody_usage_records', 'Usage records counted in rollups', [((), usage_rollups.records)]),
+        ('fody_usage_segment_bytes', 'Bytes of usage segments counted in rollups',
+         [((), usage_rollups.segment_bytes)]),
+        ('fody_usage_queue_depth', 'Usage records queued for the writer', [((), usage_ingestor.queue.qsize())]),
+        ('fody_usage_dropped_records', 'Usage records refused or dropped since start',
+         [((), usage_ingestor.dropped)]),
+        ('fody_stream_subscribers', 'Open notification streams', [((), notification_hub._count)]),
+        ('fody_in_flight_requests', 'Requests being served, as seen by load shedding',
+         [((), load_shedder.in_flight)]),
+        ('fody_cache_entries', 'Entries held by each response cache', [
+            ((("cache", "status"),), len(status_cache)),
+            ((("cache", "leaderboard"),), len(leaderboard_cache)),
+        ]),
+        ('fody_cache_hit_ratio', 'Share of cache lookups served from the cache', hit_ratios),
+    ]
+    return Response(format_prometheus(metrics, gauges), mimetype='text/plain; version=0.0.4')
+
+
+@bp.after_request
+def compress_response(response):
+    """Compress large plain responses; cached bodies arrive pre-encoded."""
+    if response.direct_passthrough or response.is_streamed or \
+            response.status_code != 200 or 'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+            (response.content_length or 0) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is not None:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
 # ============================================
 # STATS ENDPOINTS (existing)
 # ============================================
 
-@app.route('/upload_usage_data', methods=['POST'])
+def usage_record_time(record):
+    """Return the ISO time a usage record is filed under, if any."""
+    # Records from the legacy usage_stats.json only carry the client time
+    return record.get("received_at") or record.get("timestamp")
+
+
+def usage_segment_start(path):
+    """Return the ISO time a segment was opened, parsed from its name."""
+    stamp = os.path.basename(path)[len('usage-'):-len('.ndjson')].split('-')[0]
+    return datetime.strptime(stamp, '%Y%m%dT%H%M%S%f').isoformat()
+
+
+def usage_segment_writer(path):
+    """Return the pid of the process that wrote a segment ('' if unknown)."""
+    _, _, pid = os.path.basename(path)[len('usage-'):-len('.ndjson')].partition('-')
+    return pid
+
+
+class UsageRollups:
+    """Hourly and daily usage counters maintained as records are written.
+
+    Each bucket counts records, events per type and records per app
+    version. Rollups are built by tailing every segment, including those of
+    other worker processes; positions remembers the last byte included per
+    segment so a restart only has to fold in what was written after the
+    last save. records and segment_bytes are running totals of what has
+    been counted, kept for /metrics so a scrape reads two ints.
+    """
+
+    GRANULARITIES = {"hour": 13, "day": 10}
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.buckets = {granularity: {} for granularity in self.GRANULARITIES}
+        self.positions = {}
+        self.records = 0
+        self.segment_bytes = 0
+        self._lock = threading.Lock()
+
+    def load(self, segments=()):
+        """Load saved rollups; return False if there were none.
+
+        segments lists the existing segment paths, used to convert rollups
+        saved with a single position before segments were per worker.
+        """
+        if not os.path.exists(self.filepath):
+            return False
+        data = load_json_fody(self.filepath)
+        self.buckets.update(data.get("buckets", {}))
+        self.positions = data.get("positions", {})
+        if data.get("position"):
+            name, offset = data["position"]
+            for path in segments:
+                if os.path.basename(path) < name:
+                    self.positions[os.path.basename(path)] = os.path.getsize(path)
+            self.positions[name] = offset
+        self.records = sum(bucket["records"] for bucket in self.buckets["day"].values())
+        self.segment_bytes = sum(self.positions.values())
+        return True
+
+    def save(self):
+        with self._lock:
+            data = loads_json(dumps_json({"buckets": self.buckets, "positions": self.positions}))
+        save_json_fody(self.filepath, data)
+
+    def tail(self, segments):
+        """Count records appended to segments since they were last read."""
+        names = {os.path.basename(path) for path in segments}
+        with self._lock:
+            # Segments removed from disk no longer count towards the bytes
+            for name in [name for name in self.positions if name not in names]:
+                self.segment_bytes -= self.positions.pop(name)
+        for path in segments:
+            name = os.path.basename(path)
+            batch = []
+            end = None
+            try:
+                for end, record in _read_segment(path, self.positions.get(name, 0)):
+                    batch.append(record)
+            except FileNotFoundError:
+                continue
+            if batch:
+                self.add(batch, (name, end))
+
+    def add(self, records, position=None):
+        """Count records into their buckets and advance position (name, offset)."""
+        with self._lock:
+            for record in records:
+                if not isinstance(record, dict):
+                    continue
+                ts = usage_record_time(record)
+                if not isinstance(ts, str):
+                    continue
+                device = record.get("device")
+                version = str(device.get("appVersion") or "unknown") if isinstance(device, dict) else "unknown"
+                events = record.get("events")
+                event_types = [
+                    str(event.get("type", "unknown"))
+                    for event in (events if isinstance(events, list) else [])
+                    if isinstance(event, dict)
+                ]
+                self.records += 1
+                for granularity, width in self.GRANULARITIES.items():
+                    bucket = self.buckets[granularity].setdefault(
+                        ts[:width], {"records": 0, "events": {}, "app_versions": {}}
+                    )
+                    bucket["records"] += 1
+                    bucket["app_versions"][version] = bucket["app_versions"].get(version, 0) + 1
+                    for event_type in event_types:
+                        bucket["events"][event_type] = bucket["events"].get(event_type, 0) + 1
+            if position is not None:
+                self.segment_bytes += position[1] - self.positions.get(position[0], 0)
+                self.positions[position[0]] = position[1]
+
+    def query(self, granularity, start=None, end=None):
+        """Return [{bucket, ...counters}] within [start, end], oldest first."""
+        width = self.GRANULARITIES[granularity]
+        with self._lock:
+            buckets = self.buckets[granularity]
+            keys = sorted(
+                key for key in buckets
+                if (start is None or key >= start[:width]) and (end is None or key <= end[:width])
+            )
+            return loads_json(dumps_json([{"bucket": key, **buckets[key]} for key in keys]))
+
+
+class UsageIngestor:
+    """Bounded queue in front of append-only usage segment files.
+
+    Uploads cost one queue put; the writer thread drains the queue in
+    batches and appends each record as one JSON line, so ingestion never
+    re-reads earlier records and concurrent uploads cannot overwrite each
+    other. Segment names carry the writer's pid so worker processes never
+    share a file.
+    """
+
+    def __init__(self, directory, rollups, maxsize=USAGE_QUEUE_SIZE, batch_size=USAGE_BATCH_SIZE,
+                 segment_max_bytes=USAGE_SEGMENT_MAX_BYTES,
+                 segment_max_age=USAGE_SEGMENT_MAX_AGE, policy=USAGE_QUEUE_POLICY,
+                 block_timeout=USAGE_QUEUE_BLOCK_TIMEOUT):
+        if policy not in ('reject', 'block', 'drop_oldest'):
+            raise ValueError(f"Unknown usage queue policy: {policy}")
+        self.directory = directory
+        self.rollups = rollups
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._segment = None
+        self._segment_name = None
+        self._segment_size = 0
+        self._segment_opened = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._catch_up_rollups()
+        self._thread = threading.Thread(target=self._run, name='fody-usage-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        """Queue a record for writing; return False if it was refused."""
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            if self.policy != 'drop_oldest':
+                self.dropped += 1
+                return False
+        # drop_oldest: make room by discarding the head of the queue
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return True
+            except queue.Full:
+                continue
+
+    def segments(self):
+        """Return segment paths in write order."""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.ndjson'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _catch_up_rollups(self):
+        """Fold records written after the last rollups save into them."""
+        if not self.rollups.load(self.segments()) and os.path.exists(USAGE_STATS_FILE):
+            legacy = load_json_fody(USAGE_STATS_FILE)
+            if isinstance(legacy, list):
+                self.rollups.add(legacy)
+        self.rollups.tail(self.segments())
+
+    def close(self):
+        """Stop the writer after draining everything already queued."""
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _open_segment(self, batch):
+        # Named after the earliest record so a segment never holds records
+        # older than its name, which range queries rely on
+        opened = min(
+            (record["received_at"] for record in batch if isinstance(record.get("received_at"), str)),
+            default=datetime.now().isoformat()
+        )
+        opened = datetime.fromisoformat(opened)
+        self._segment_name = f"usage-{opened.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}.ndjson"
+        self._segment = open(os.path.join(self.directory, self._segment_name), 'ab')
+        self._segment_size = 0
+        self._segment_opened = time.monotonic()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _write_batch(self, batch):
+        if self._segment is None:
+            self._open_segment(batch)
+        lines = b''.join(dumps_json(record) + b'\n' for record in batch)
+        self._segment.write(lines)
+        self._segment.flush()
+        self._segment_size += len(lines)
+        if self._segment_size >= self.segment_max_bytes:
+            self._close_segment()
+
+    def _run(self):
+        last_save = time.monotonic()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if self._segment is not None and \
+                        time.monotonic() - self._segment_opened >= self.segment_max_age:
+                    self._close_segment()
+                if batch:
+                    self._write_batch(batch)
+            except (IOError, OSError) as e:
+                print(f"Failed to write usage data: {e}")
+            try:
+                # Picks up this batch as well as other workers' records
+                self.rollups.tail(self.segments())
+                if not batch and self._stopped.is_set():
+                    self._close_segment()
+                    self.rollups.save()
+                    return
+                if time.monotonic() - last_save >= USAGE_ROLLUPS_SAVE_INTERVAL:
+                    last_save = time.monotonic()
+                    self.rollups.save()
+            except (IOError, OSError) as e:
+                print(f"Failed to save usage rollups: {e}")
+                if self._stopped.is_set():
+                    return
+
+
+def _read_segment(path, offset=0):
+    """Yield (offset after record, record) for complete lines of a segment."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Line still being written by the writer thread
+                break
+            offset += len(line)
+            yield offset, loads_json(line)
+
+
+def iter_usage_records(start=None, end=None, cursor=None):
+    """Yield (cursor, record) for stored usage records in time order.
+
+    start and end are inclusive ISO bounds. Segments are named after the
+    time they were opened and one writer's segments never overlap, so only
+    segments that can hold records in range are opened. The yielded cursor
+    points just past the record and can be passed back to resume. With
+    several workers, records are ordered by segment, and paging through
+    live data can miss records still being appended to another worker's
+    open segment; bound exports with a to in the past.
+    """
+    cursor_source, _, cursor_offset = (cursor or '').partition(':')
+    filtered = start is not None or end is not None
+
+    def in_range(record):
+        ts = usage_record_time(record) if isinstance(record, dict) else None
+        if ts is None:
+            return not filtered
+        return (start is None or ts >= start) and (end is None or ts <= end)
+
+    segments = usage_ingestor.segments()
+    starts = [usage_segment_start(path) for path in segments]
+    # Start of the same writer's next segment, where this one stops
+    next_starts = [None] * len(segments)
+    following = {}
+    for i in range(len(segments) - 1, -1, -1):
+        writer = usage_segment_writer(segments[i])
+        next_starts[i] = following.get(writer)
+        following[writer] = starts[i]
+    
+    # Records from before segmented storage
+    if cursor_source in ('', 'legacy') and os.path.exists(USAGE_STATS_FILE) and \
+            (start is None or not starts or start < starts[0]):
+        legacy = load_json_fody(USAGE_STATS_FILE)
+        if isinstance(legacy, list):
+            for i in range(int(cursor_offset or 0), len(legacy)):
+                if in_range(legacy[i]):
+                    yield f"legacy:{i + 1}", legacy[i]
+    
+    for i, path in enumerate(segments):
+        name = os.path.basename(path)
+        if cursor_source not in ('', 'legacy') and name < cursor_source:
+            continue
+        if end is not None and starts[i] > end:
+            break
+        if start is not None and next_starts[i] is not None and next_starts[i] <= start:
+            continue
+        offset = int(cursor_offset) if name == cursor_source else 0
+        for position, record in _read_segment(path, offset):
+            if in_range(record):
+                yield f"{name}:{position}", record
+
+
+def _iso_arg(name):
+    """Read an ISO datetime query argument, normalised for comparison."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None).isoformat()
+
+
+usage_rollups = UsageRollups(USAGE_ROLLUPS_FILE)
+usage_ingestor = UsageIngestor(USAGE_DIR, usage_rollups)
+
+
+@bp.route('/upload_usage_data', methods=['POST'])
 def upload_usage_data():
     """Receive usage data (existing endpoint)."""
     try:
@@ -708,44 +4297,667 @@ def upload_usage_data():
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        # Ensure directory exists
-        os.makedirs(DATA_DIR, exist_ok=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Usage data must be a JSON object'}), 400
         
-        # Load existing stats
-        stats_file = os.path.join(DATA_DIR, 'usage_stats.json')
-        ensure_file(stats_file, [])
-        
-        stats = load_json(stats_file)
-        stats.append(data)
-        save_json(stats_file, stats)
+        if not usage_ingestor.submit({**data, 'received_at': datetime.now().isoformat()}):
+            response = jsonify({'error': 'Server busy, try again later'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
         
         return jsonify({'message': 'Data uploaded successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/get_fody_stats', methods=['GET'])
+@bp.route('/get_fody_stats', methods=['GET'])
 def get_fody_stats():
-    """Get usage stats (existing endpoint)."""
+    """Stream usage records as NDJSON (existing endpoint).
+    
+    Query parameters: from/to (ISO datetimes, inclusive), limit (default
+    1000) and cursor. When more records match than limit, the last line is
+    {"next_cursor": ...} to pass back as cursor for the next page.
+    """
     try:
-        stats_file = os.path.join(DATA_DIR, 'usage_stats.json')
-        ensure_file(stats_file, [])
-        stats = load_json(stats_file)
-        return jsonify(stats), 200
+        start = _iso_arg('from')
+        end = _iso_arg('to')
+    except ValueError:
+        return jsonify({'error': 'from/to must be ISO datetimes'}), 400
+    cursor = request.args.get('cursor')
+    limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+    
+    def generate():
+        count = 0
+        last_cursor = cursor
+        for position, record in iter_usage_records(start, end, cursor):
+            if count == limit:
+                yield dumps_json({"next_cursor": last_cursor}) + b'\n'
+                return
+            yield dumps_json(record) + b'\n'
+            last_cursor = position
+            count += 1
+    
+    try:
+        body = generate()
+        encoding = response_encoding()
+        if encoding is not None:
+            body = compress_stream(body, encoding)
+        response = Response(stream_with_context(body), mimetype='application/x-ndjson')
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@bp.route('/get_fody_stats/rollups', methods=['GET'])
+def get_fody_stats_rollups():
+    """Get hourly or daily usage rollups without touching raw records."""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in UsageRollups.GRANULARITIES:
+        return jsonify({'error': 'granularity must be hour or day'}), 400
+    try:
+        start = _iso_arg('from')
+        end = _iso_arg('to')
+    except ValueError:
+        return jsonify({'error': 'from/to must be ISO datetimes'}), 400
+    
+    return jsonify({
+        'granularity': granularity,
+        'buckets': usage_rollups.query(granularity, start, end)
+    }), 200
+
+
+# ============================================
+# RATE LIMITING
+# ============================================
+
+class RateLimiter:
+    """Token buckets for many clients at one float per client.
+
+    Uses GCRA: each key stores only the time its bucket will be full again,
+    which behaves exactly like a bucket of `requests` tokens refilled over
+    `seconds`. A key whose bucket is full again carries no information, so
+    a sweep once per window drops idle keys without changing any answer.
+    """
+
+    def __init__(self, requests, seconds, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.interval = seconds / requests
+        self.burst = float(seconds)
+        self.max_keys = max_keys
+        self._full_at = {}
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def acquire(self, key, cost=1, now=None):
+        """Take cost tokens for key; return 0 if allowed, else seconds to wait."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now >= self._next_sweep or len(self._full_at) >= self.max_keys:
+                self._sweep(now)
+            full_at = max(self._full_at.get(key, now), now) + cost * self.interval
+            wait = full_at - now - self.burst
+            if wait > 0:
+                return wait
+            self._full_at[key] = full_at
+            return 0
+
+    def _sweep(self, now):
+        self._full_at = {key: full_at for key, full_at in self._full_at.items() if full_at > now}
+        # Still full of active clients: forget the oldest rather than grow
+        excess = len(self._full_at) - self.max_keys + 1
+        if excess > 0:
+            for key in list(itertools.islice(self._full_at, excess)):
+                del self._full_at[key]
+        self._next_sweep = now + self.burst
+
+
+class LoadShedder:
+    """Counts requests in flight and refuses new ones past a threshold."""
+
+    def __init__(self, max_in_flight=SHED_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Admit a request; return False if it should be shed."""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+rate_limiters = {
+    route: {scope: RateLimiter(*limit) for scope, limit in limits.items()}
+    for route, limits in RATE_LIMITS.items()
+}
+load_shedder = LoadShedder()
+
+# Long-lived streams would pin the in-flight count; monitoring and admin
+# calls must keep working while the server sheds load
+SHED_EXEMPT_PREFIXES = ('/metrics', '/admin/', '/api/gamification/stream/')
+
+
+def too_many_requests(route, message, retry_after, reason):
+    metrics.inc('fody_rate_limited_total', (("route", route), ("reason", reason)))
+    response = jsonify({"error": message})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, 429
+
+
+@bp.before_app_request
+def limit_request():
+    route = request.url_rule.rule if request.url_rule is not None else None
+    if route is None or route.startswith(SHED_EXEMPT_PREFIXES):
+        return None
+    
+    if not load_shedder.enter():
+        return too_many_requests(route, "Server busy, try again later", SHED_RETRY_AFTER, "in_flight")
+    g.in_flight = True
+    
+    limiters = rate_limiters.get(route)
+    if not limiters:
+        return None
+    # A retry of a request that already went through (or is still running)
+    # is only answered from its stored entry, so it must not be refused
+    # for the original
+    key = request.headers.get('Idempotency-Key')
+    view = current_app.view_functions.get(request.endpoint)
+    if key and getattr(view, 'idempotent', False):
+        stored = storage.get_idempotent(idempotency_token(), key)
+        if stored is not None and stored[0] == request_fingerprint():
+            return None
+    if usage_ingestor.queue.qsize() >= SHED_MAX_QUEUE_DEPTH:
+        return too_many_requests(route, "Server busy, try again later", SHED_RETRY_AFTER, "queue_depth")
+    
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    # A batch costs one token per event it carries
+    events = data.get('events')
+    cost = max(len(events), 1) if isinstance(events, list) else 1
+    # remote_addr is the client's address once ProxyFix has applied
+    # TRUSTED_PROXIES hops of X-Forwarded-For
+    keys = {"token": data.get('token'), "ip": request.remote_addr}
+    for scope, limiter in limiters.items():
+        key = keys.get(scope)
+        if not isinstance(key, str):
+            continue
+        wait = limiter.acquire(key, cost)
+        if wait:
+            return too_many_requests(route, "Too many requests", wait, scope)
+    return None
+
+
+@bp.teardown_app_request
+def release_request(exc):
+    if g.pop('in_flight', False):
+        load_shedder.leave()
+
+
+# ============================================
+# PROFILING
+# ============================================
+
+def frame_stack(frame):
+    """Collapsed-stack form of a frame: 'outer;...;inner' function names."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfiler:
+    """Profiles a sample of live requests on demand.
+
+    Disabled by default; then each request costs one attribute check. When
+    enabled, every Nth request (optionally only for one route) is profiled
+    either by a stack sampler, which writes a per-request collapsed-stack
+    file and adds to an aggregate flamegraph tools can read, or by cProfile,
+    which writes a per-request .prof file for pstats/snakeviz. cProfile
+    profiles one request at a time, as newer Pythons allow only one active
+    profiler. Capturing stops by itself after max_profiles requests, and no
+    file is written once the directory holds max_files profiles.
+    """
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, directory, max_files=PROFILE_MAX_FILES, max_bytes=PROFILE_MAX_BYTES,
+                 sample_interval=PROFILE_SAMPLE_INTERVAL, max_stacks=PROFILE_MAX_STACKS):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.sample_interval = sample_interval
+        self.max_stacks = max_stacks
+        self.enabled = False
+        self.mode = 'sample'
+        self.every = 1
+        self.route = None
+        self.max_profiles = max_files
+        self.captured = 0
+        self.aggregate = Counter()
+        self._counter = itertools.count()
+        # thread id -> Counter of collapsed stacks for requests being sampled
+        self._sampling = {}
+        self._cprofile_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def configure(self, enabled, mode='sample', every=1, route=None, max_profiles=None):
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {', '.join(self.MODES)}")
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        with self._lock:
+            self.mode = mode
+            self.every = every
+            self.route = route
+            self.max_profiles = min(max_profiles or self.max_files, self.max_files)
+            self.captured = 0
+            self._counter = itertools.count()
+            if enabled:
+                self.aggregate = Counter()
+            self.enabled = enabled
+            if enabled and mode == 'sample' and (self._sampler is None or not self._sampler.is_alive()):
+                self._sampler = threading.Thread(target=self._sample, name='fody-profiler', daemon=True)
+                self._sampler.start()
+
+    def state(self):
+        return {
+            "enabled": self.enabled,
+            "mode": self.mode,
+            "every": self.every,
+            "route": self.route,
+            "max_profiles": self.max_profiles,
+            "captured": self.captured,
+            "profiles": sorted(os.listdir(self.directory)) if os.path.isdir(self.directory) else [],
+        }
+
+    def start(self, route):
+        """Begin profiling the current request if it is sampled; return a handle."""
+        if self.route is not None and route != self.route:
+            return None
+        if next(self._counter) % self.every:
+            return None
+        if self.mode == 'cprofile':
+            if not self._cprofile_lock.acquire(blocking=False):
+                return None
+            profile = cProfile.Profile()
+            profile.enable()
+            return ('cprofile', profile, time.perf_counter())
+        stacks = Counter()
+        self._sampling[threading.get_ident()] = stacks
+        return ('sample', stacks, time.perf_counter())
+
+    def stop(self, handle, route):
+        """Finish profiling a request and write its profile file."""
+        kind, data, started = handle
+        elapsed_ms = int((time.perf_counter() - started) * 1000)
+        if kind == 'cprofile':
+            data.disable()
+            self._cprofile_lock.release()
+        else:
+            self._sampling.pop(threading.get_ident(), None)
+        with self._lock:
+            if not self.enabled or self.captured >= self.max_profiles:
+                return
+            self.captured += 1
+            if self.captured >= self.max_profiles:
+                self.enabled = False
+            if kind == 'sample':
+                for stack, count in data.items():
+                    if stack in self.aggregate or len(self.aggregate) < self.max_stacks:
+                        self.aggregate[stack] += count
+                    else:
+                        self.aggregate['[other]'] += count
+        os.makedirs(self.directory, exist_ok=True)
+        if len(os.listdir(self.directory)) >= self.max_files:
+            return
+        slug = route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{slug}-{elapsed_ms}ms"
+        if kind == 'cprofile':
+            path = os.path.join(self.directory, name + '.prof')
+            data.dump_stats(path)
+            if os.path.getsize(path) > self.max_bytes:
+                os.remove(path)
+            return
+        # Most frequent stacks first, cut off at the size cap
+        with open(os.path.join(self.directory, name + '.folded'), 'w', encoding='utf-8') as f:
+            written = 0
+            for stack, count in data.most_common():
+                line = f"{stack} {count}\n"
+                written += len(line.encode('utf-8'))
+                if written > self.max_bytes:
+                    break
+                f.write(line)
+
+    def collapsed(self):
+        """Aggregated collapsed stacks of all sampled requests."""
+        with self._lock:
+            return ''.join(f"{stack} {count}\n" for stack, count in self.aggregate.most_common())
+
+    def _sample(self):
+        while self.enabled and self.mode == 'sample':
+            time.sleep(self.sample_interval)
+            if not self._sampling:
+                continue
+            frames = sys._current_frames()
+            for ident, stacks in list(self._sampling.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[frame_stack(frame)] += 1
+
+
+request_profiler = RequestProfiler(PROFILE_DIR)
+
+
+@bp.before_app_request
+def start_request_profile():
+    if not request_profiler.enabled:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else None
+    if route is not None and not route.startswith('/admin/'):
+        handle = request_profiler.start(route)
+        if handle is not None:
+            g.profile = (handle, route)
+
+
+@bp.teardown_app_request
+def stop_request_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.stop(*profile)
+
+
+def admin_required():
+    """Return an error response unless the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin API disabled; set FODY_ADMIN_TOKEN"}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({"error": "Invalid admin token"}), 403
+    return None
+
+
+@bp.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    """Show or change the request profiler configuration.
+    
+    POST body: {"enabled": bool, "mode": "sample"|"cprofile", "every": N
+    (profile 1 in N requests), "route": "/api/gamification/sync" (optional,
+    as in the route table), "max_profiles": N}.
+    """
+    error = admin_required()
+    if error is not None:
+        return error
+    
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            request_profiler.configure(
+                bool(data.get('enabled', True)),
+                data.get('mode', 'sample'),
+                int(data.get('every', 1)),
+                data.get('route'),
+                int(data['max_profiles']) if data.get('max_profiles') is not None else None
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+    
+    return jsonify(request_profiler.state()), 200
+
+
+@bp.route('/admin/profiler/collapsed', methods=['GET'])
+def admin_profiler_collapsed():
+    """Aggregated collapsed stacks, e.g. for flamegraph.pl or speedscope."""
+    error = admin_required()
+    if error is not None:
+        return error
+    return Response(request_profiler.collapsed(), mimetype='text/plain')
+
+
+@bp.route('/admin/profiler/profiles/<name>', methods=['GET'])
+def admin_profiler_profile(name):
+    """Download one captured profile file."""
+    error = admin_required()
+    if error is not None:
+        return error
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+
+
+# ============================================
+# ACHIEVEMENT BACKFILL
+# ============================================
+
+def backfill_achievements(dry_run=False):
+    """Unlock rule-based achievements that existing users already qualify for.
+
+    Pure counter rules are checked against each user's current totals; the
+    other rules are replayed over the user's logged points events, so they
+    only see history the event log still keeps. Returns the number of users
+    scanned and the unlocks per achievement.
+    """
+    all_achievements = storage.load_catalog("achievements")
+    index = achievement_rules.index()
+    rules = [rule for entries in index.values() for rule in entries]
+    state_rules = [rule for rule in rules if rule[2]]
+    replay = any(not rule[2] for rule in rules)
+    now = datetime.now()
+    
+    # Evaluate first and write afterwards, so no storage cursor is held
+    # open while users are mutated
+    pending = []
+    scanned = 0
+    for token, user in storage.iter_users():
+        scanned += 1
+        earned = earned_achievements(user, state_rules, now, all_achievements)
+        if replay:
+            state = dict(user, session_started_at=None)
+            for event in event_log.history(token):
+                if event["type"] != "points":
+                    continue
+                if event.get("action") == "app_open":
+                    state["session_started_at"] = event["ts"]
+                state["achievements"] = user.get("achievements", []) + earned
+                candidates = [
+                    rule for rule in achievement_rules.for_action(event.get("action")) if not rule[2]
+                ]
+                when = datetime.fromisoformat(event["ts"])
+                earned += earned_achievements(state, candidates, when, all_achievements,
+                                              event.get("utc_offset"), event.get("details"))
+        if earned:
+            pending.append((token, earned))
+    
+    unlocked = Counter()
+    updated = 0
+    for token, earned in pending:
+        if dry_run:
+            unlocked.update(earned)
+            updated += 1
+            continue
+        
+        def apply(user, earned=earned):
+            have = user.get("achievements", [])
+            missing = [achievement_id for achievement_id in earned if achievement_id not in have]
+            if not missing:
+                return None, []
+            update_data, _ = record_events(token, user, [
+                {"type": "achievement", "id": achievement_id,
+                 "amount": all_achievements[achievement_id].get("points", 0)}
+                for achievement_id in missing
+            ])
+            return update_data, missing
+        
+        _, missing = storage.mutate_user(token, apply)
+        unlocked.update(missing)
+        updated += bool(missing)
+    
+    return {"users_scanned": scanned, "users_updated": updated,
+            "unlocked": dict(unlocked), "dry_run": dry_run}
+
+
+@bp.route('/admin/achievements/backfill', methods=['POST'])
+def admin_backfill_achievements():
+    """Re-evaluate achievement rules for every existing user.
+    
+    POST body: {"dry_run": bool}. Runs synchronously over all users, so it
+    is meant for maintenance windows after a rules change.
+    """
+    error = admin_required()
+    if error is not None:
+        return error
+    data = request.json or {}
+    return jsonify(backfill_achievements(bool(data.get('dry_run', False)))), 200
+
+
+# ============================================
+# LEVEL CURVE MIGRATION
+# ============================================
+
+def level_migration_report(thresholds, previous_thresholds=None):
+    """Summarise how many users change level if thresholds replaces the curve.
+
+    Recomputes every user's level under both tables in one batch pass.
+    """
+    if previous_thresholds is None:
+        previous_thresholds = level_thresholds()
+    points = [user.get("points", 0) for _, user in storage.iter_users()]
+    result = recompute_levels(points, thresholds, previous_thresholds)
+    deltas = result["deltas"]
+    
+    if numpy is not None:
+        values, counts = numpy.unique(deltas, return_counts=True)
+        by_delta = dict(zip(values.tolist(), counts.tolist()))
+        levels, counts = numpy.unique(result["levels"], return_counts=True)
+        distribution = dict(zip(levels.tolist(), counts.tolist()))
+    else:
+        by_delta = dict(Counter(deltas))
+        distribution = dict(Counter(result["levels"]))
+    
+    return {
+        "users": len(points),
+        "moved_up": sum(count for delta, count in by_delta.items() if delta > 0),
+        "moved_down": sum(count for delta, count in by_delta.items() if delta < 0),
+        "unchanged": by_delta.get(0, 0),
+        "by_delta": dict(sorted(by_delta.items())),
+        "levels": dict(sorted(distribution.items())),
+        "top_level": {"current": len(previous_thresholds), "new": len(thresholds)},
+    }
+
+
+@bp.route('/admin/levels', methods=['GET', 'POST'])
+def admin_levels():
+    """Show the level curve, or preview and apply a new one.
+    
+    POST body: {"thresholds": [0, 100, ...], "dry_run": bool}. Answers with
+    a migration report of the users changing level; unless dry_run is set
+    the new table is then written to levels.json.
+    """
+    error = admin_required()
+    if error is not None:
+        return error
+    
+    if request.method == 'GET':
+        return jsonify({"thresholds": level_thresholds()}), 200
+    
+    data = request.json or {}
+    try:
+        thresholds = validate_level_thresholds(data.get('thresholds'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    dry_run = bool(data.get('dry_run', False))
+    report = level_migration_report(thresholds)
+    if not dry_run:
+        save_json_fody(FODY_LEVELS_FILE, {"thresholds": thresholds}, pretty=True)
+    return jsonify({**report, "dry_run": dry_run}), 200
+
+
+# ============================================
+# APP FACTORY
+# ============================================
+
+_services_started = False
+_services_lock = threading.Lock()
+
+
+def start_services():
+    """Open storage and start the background workers, once per process."""
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        _services_started = True
+        
+        storage.start()
+        atexit.register(storage.close)
+        
+        leaderboard_index.rebuild(storage.iter_users())
+        storage.listeners.append(leaderboard_index.on_user_change)
+        
+        replay_events(event_log.start(replay_after=storage.durable_seq()))
+        event_log.foreign_listeners.append(leaderboard_index.on_foreign_event)
+        atexit.register(event_log.close)
+        
+        windowed_leaderboards.start(event_log.iter_since(windowed_leaderboards.replay_from()))
+        storage.listeners.append(windowed_leaderboards.on_user_change)
+        event_log.foreign_listeners.append(windowed_leaderboards.on_foreign_event)
+        
+        population_stats.rebuild(storage.iter_users())
+        storage.listeners.append(population_stats.on_user_change)
+        event_log.foreign_listeners.append(population_stats.on_foreign_event)
+        population_stats.start()
+        atexit.register(population_stats.close)
+        
+        notification_hub.start(horizon=event_log.seq)
+        storage.listeners.append(notification_hub.on_user_change)
+        event_log.foreign_listeners.append(notification_hub.on_foreign_event)
+        atexit.register(notification_hub.close)
+        
+        usage_ingestor.start()
+        atexit.register(usage_ingestor.close)
+
+
+def create_app():
+    """Create the Flask app. This is the entry point for WSGI servers.
+    
+    Every worker process starts its own services. Running several workers
+    needs the sqlite backend: its transactions serialise mutations across
+    processes, while the event log and usage segments use file locks and
+    per-worker files. Do not preload the app before forking (gunicorn
+    --preload), as threads and database handles do not survive a fork.
+    """
+    app = Flask(__name__)
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+    app.json = FodyJSONProvider(app)
+    CORS(app)
+    app.register_blueprint(bp)
+    start_services()
+    return app
+
+
 # ============================================
 # MAIN
 # ============================================
 
 if __name__ == '__main__':
     # Initialize data files
-    ensure_file(ACHIEVEMENTS_FILE, DEFAULT_ACHIEVEMENTS)
-    ensure_file(TASKS_FILE, DEFAULT_TASKS)
-    ensure_file(USERS_FILE)
-    ensure_file(SETTINGS_FILE)
+    ensure_file(FODY_ACHIEVEMENTS_FILE, DEFAULT_ACHIEVEMENTS)
+    ensure_file(FODY_TASKS_FILE, DEFAULT_TASKS)
+    ensure_file(FODY_ACHIEVEMENT_RULES_FILE, DEFAULT_ACHIEVEMENT_RULES)
+    ensure_file(FODY_LEVELS_FILE, {"thresholds": DEFAULT_LEVEL_THRESHOLDS})
+    ensure_file(FODY_SETTINGS_FILE)
     
     print("=" * 60)
     print("Fody App Gamification Server")
@@ -756,14 +4968,26 @@ if __name__ == '__main__':
     print("  POST /api/gamification/points         - Add points")
     print("  POST /api/gamification/achievement    - Unlock achievement")
     print("  POST /api/gamification/task           - Complete task")
+    print("  POST /api/gamification/events         - Apply event batch")
     print("  POST /api/gamification/sync           - Full sync")
-    print("  GET  /api/gamification/leaderboard    - Get leaderboard")
+    print("  GET  /api/gamification/leaderboard    - Get leaderboard (all-time or window)")
+    print("  GET  /api/gamification/rank/<token>   - Get user rank")
+    print("  GET  /api/gamification/history/<token> - Get user history")
+    print("  GET  /api/gamification/stream/<token> - Notification stream (SSE)")
+    print("  GET  /api/gamification/analytics      - Population analytics")
     print("  POST /api/gamification/settings       - Update settings")
     print("  POST /api/gamification/initialize      - Initialize user")
+    print("  GET  /metrics                         - Prometheus metrics")
+    print("  GET  /admin/profiler                  - Request profiler (admin)")
+    print("  POST /admin/achievements/backfill     - Backfill rule-based achievements (admin)")
+    print("  POST /admin/levels                    - Preview/apply a level curve (admin)")
     print("\nExisting endpoints:")
     print("  POST /upload_usage_data               - Upload usage data")
-    print("  GET  /get_fody_stats                  - Get usage stats")
+    print("  GET  /get_fody_stats                  - Get usage stats (NDJSON)")
+    print("  GET  /get_fody_stats/rollups          - Get hourly/daily usage rollups")
     print("\n" + "=" * 60)
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # The reloader would start a second process competing for the data files
+    app = create_app()
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
 
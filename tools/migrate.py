@@ -0,0 +1,585 @@
+"""
+Streaming migration of a legacy users.json and usage_stats.json
+
+Older servers stored every points award, achievement unlock and task
+completion as its own flattened key in the user record (points_history_<iso>,
+achievement_unlocks_<id>, task_completions_<id>), so users.json grew with each
+user's whole history and loading it took several times its size in memory.
+This tool reads the file one user at a time, folds those keys into the
+achievement_unlocks and task_completions fields and into events.log, and
+writes a compact store for the json or sqlite backend. usage_stats.json is
+streamed into a usage segment the same way.
+
+Usage:
+    python tools/migrate.py [--data-dir DIR] [--backend json|sqlite]
+    python tools/migrate.py --no-swap
+
+Run it in the server's working directory (or pass --data-dir) with the server
+stopped. Progress and the memory high-water mark are printed to stderr. Work
+is checkpointed in fody_gamification_data.migrated/migrate.state.json; after
+an interruption, running the same command again resumes where it stopped.
+When done, the old fody_gamification_data is kept as
+fody_gamification_data.legacy and the new store takes its place (unless
+--no-swap is given).
+"""
+
+import argparse
+import heapq
+import os
+import re
+import resource
+import shutil
+import sys
+import time
+from operator import itemgetter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Legacy usage records go to a segment sorting before every real one
+LEGACY_USAGE_SEGMENT = 'usage-00010101T000000000000-legacy.ndjson'
+
+PHASES = ('users', 'events', 'store', 'usage', 'swap', 'done')
+
+
+def peak_rss():
+    """Memory high-water mark of this process in bytes."""
+    # KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# ============================================
+# STREAMING PARSER
+# ============================================
+
+_SPECIAL = re.compile(rb'["\\{}\[\]]')
+_SCALAR_END = re.compile(rb'[\s,}\]]')
+_SEPARATORS = b' \t\r\n,'
+
+
+class MemberReader:
+    """Iterate over the members of a top-level JSON object or array.
+
+    Only the current member is held in memory: the bytes after it are
+    scanned (by regex, so mostly in C) for quotes, escapes and brackets to
+    find where its value ends, and that slice alone is decoded. Yields
+    (key, value, offset) - key is None in an array, offset is the file
+    position just past the value and can be passed back to resume with the
+    next member.
+    """
+
+    def __init__(self, f, loads, offset=0, chunk_size=1 << 20):
+        self.f = f
+        self.loads = loads
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        # File offset of buf[0]
+        self.base = 0
+        self.pos = 0
+        opener = self._next_byte()
+        if opener not in (b'{', b'['):
+            raise ValueError("expected a JSON object or array")
+        self.is_object = opener == b'{'
+        self.pos += 1
+        if offset:
+            f.seek(offset)
+            self.buf, self.base, self.pos = bytearray(), offset, 0
+
+    def _more(self):
+        data = self.f.read(self.chunk_size)
+        self.buf += data
+        return bool(data)
+
+    def _next_byte(self):
+        """Skip whitespace and commas; return the next byte (b'' at the end of the file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _SEPARATORS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return bytes(self.buf[self.pos:self.pos + 1])
+            if not self._more():
+                return b''
+
+    def _scan(self, pos, depth, in_string):
+        """Return the index just past the string or container being scanned."""
+        buf = self.buf
+        while True:
+            match = _SPECIAL.search(buf, pos)
+            if match is None:
+                # pos may already point past an escaped byte still to come
+                pos = max(pos, len(buf))
+                if not self._more():
+                    raise ValueError(f"unexpected end of file at byte {self.base + len(buf)}")
+                continue
+            char = buf[match.start()]
+            pos = match.end()
+            if char == 0x5c:
+                pos += 1
+            elif in_string:
+                if char == 0x22:
+                    in_string = False
+                    if depth == 0:
+                        return pos
+            elif char == 0x22:
+                in_string = True
+            elif char in b'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+
+    def _value_end(self, start):
+        first = self.buf[start]
+        if first == 0x22:
+            return self._scan(start + 1, 0, True)
+        if first in b'{[':
+            return self._scan(start + 1, 1, False)
+        pos = start
+        while True:
+            match = _SCALAR_END.search(self.buf, pos)
+            if match is not None:
+                return match.start()
+            pos = len(self.buf)
+            if not self._more():
+                return pos
+
+    def __iter__(self):
+        while True:
+            if self.pos >= self.chunk_size:
+                # Drop members already handed out
+                del self.buf[:self.pos]
+                self.base += self.pos
+                self.pos = 0
+            char = self._next_byte()
+            if char in (b'}', b']'):
+                return
+            if not char:
+                raise ValueError("unexpected end of file")
+            key = None
+            if self.is_object:
+                end = self._scan(self.pos + 1, 0, True)
+                key = self.loads(self.buf[self.pos:end])
+                self.pos = end
+                if self._next_byte() != b':':
+                    raise ValueError(f"expected ':' at byte {self.base + self.pos}")
+                self.pos += 1
+                self._next_byte()
+            end = self._value_end(self.pos)
+            value = self.loads(self.buf[self.pos:end])
+            self.pos = end
+            yield key, value, self.base + end
+
+
+# ============================================
+# FOLDING
+# ============================================
+
+def fold_user(endpoints, token, user, achievements, tasks):
+    """Return (record, events) for one stored user.
+
+    The flattened history keys become events (without seq) and entries of
+    achievement_unlocks / task_completions; everything else is kept. Users
+    already in the current format come back unchanged with no events.
+    """
+    record = {}
+    unlocks = dict(user.get("achievement_unlocks") or {})
+    completions = dict(user.get("task_completions") or {})
+    events = []
+    for key, value in user.items():
+        if key.startswith('points_history_'):
+            if isinstance(value, dict):
+                events.append({
+                    "ts": key[len('points_history_'):], "token": token, "type": "points",
+                    "action": value.get("action", "general"), "amount": value.get("amount", 0),
+                    "details": value.get("details") or {},
+                })
+        elif key.startswith('achievement_unlocks_'):
+            achievement_id = key[len('achievement_unlocks_'):]
+            if achievement_id not in unlocks and isinstance(value, str):
+                unlocks[achievement_id] = value
+                events.append({
+                    "ts": value, "token": token, "type": "achievement", "id": achievement_id,
+                    "amount": achievements.get(achievement_id, {}).get("points", 0),
+                })
+        elif key.startswith('task_completions_'):
+            task_id = key[len('task_completions_'):]
+            if task_id not in completions and isinstance(value, str):
+                completions[task_id] = value
+                events.append({
+                    "ts": value, "token": token, "type": "task", "id": task_id,
+                    "amount": tasks.get(task_id, {}).get("points", 0),
+                })
+        else:
+            record[key] = value
+    if len(record) == len(user):
+        return user, []
+
+    record = {**endpoints.new_user_record(token), **record}
+    unlocked = list(record["achievements"])
+    unlocked += [achievement_id for achievement_id in unlocks if achievement_id not in unlocked]
+    completed = list(record["completed_tasks"])
+    completed += [task_id for task_id in completions if task_id not in completed]
+    record.update({
+        "achievements": unlocked,
+        "achievement_unlocks": unlocks,
+        "completed_tasks": completed,
+        "task_completions": completions,
+    })
+    return record, events
+
+
+# ============================================
+# MIGRATION
+# ============================================
+
+class Progress:
+    """Rate-limited progress lines on stderr."""
+
+    def __init__(self, label, total_bytes, interval=5.0):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.started = self.last = time.monotonic()
+        self.start_position = None
+
+    def update(self, position, force=False, **counts):
+        now = time.monotonic()
+        if self.start_position is None:
+            self.start_position = position
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        rate = (position - self.start_position) / max(now - self.started, 1e-9) / 2 ** 20
+        done = position / self.total_bytes * 100 if self.total_bytes else 100.0
+        details = ''.join(f", {name} {value}" for name, value in counts.items())
+        print(f"{self.label}: {done:5.1f}% of {self.total_bytes / 2 ** 20:.1f} MiB{details}, "
+              f"{rate:.1f} MiB/s, peak RSS {peak_rss() / 2 ** 20:.1f} MiB", file=sys.stderr)
+
+
+class Migration:
+    """The phases of one migration and the checkpoint they share."""
+
+    def __init__(self, endpoints, backend, output=None, swap=True, checkpoint_users=10000,
+                 run_events=200000, chunk_size=1 << 20):
+        self.endpoints = endpoints
+        self.backend = backend
+        self.swap_in = swap
+        self.source = endpoints.FODY_DATA_DIR
+        self.output = output or endpoints.FODY_DATA_DIR + '.migrated'
+        self.checkpoint_users = checkpoint_users
+        self.run_events = run_events
+        self.chunk_size = chunk_size
+        self.state_path = os.path.join(self.output, 'migrate.state.json')
+        self.users_part = os.path.join(self.output, 'users.ndjson.part')
+        self.state = None
+
+    def run_path(self, index):
+        return os.path.join(self.output, f'events.run{index:05d}')
+
+    def save_state(self, **changes):
+        self.state.update(changes)
+        self.endpoints.save_json_fody(self.state_path, self.state)
+
+    def run(self):
+        os.makedirs(self.output, exist_ok=True)
+        if os.path.exists(self.state_path):
+            self.state = self.endpoints.load_json_fody(self.state_path)
+            if self.state.get("backend", self.backend) != self.backend:
+                raise SystemExit(f"{self.output} holds a {self.state['backend']} migration; "
+                                 "resume it with the same --backend or remove it")
+            print(f"Resuming at phase {self.state['phase']}", file=sys.stderr)
+        else:
+            self.state = {"phase": "users", "backend": self.backend}
+        steps = {
+            "users": self.migrate_users, "events": self.merge_events, "store": self.write_store,
+            "usage": self.migrate_usage, "swap": self.swap,
+        }
+        while self.state["phase"] != "done":
+            phase = self.state["phase"]
+            steps[phase]()
+            self.save_state(phase=PHASES[PHASES.index(phase) + 1])
+        if self.swap_in:
+            # The finished state would otherwise sit in the live data dir
+            os.remove(self.state_path)
+        print(f"Migrated {self.state.get('users', 0)} users and {self.state.get('events_total', 0)} events, "
+              f"{self.state.get('usage_records', 0)} usage records; peak RSS {peak_rss() / 2 ** 20:.1f} MiB",
+              file=sys.stderr)
+
+    def migrate_users(self):
+        """Fold users.json into compact records and sorted runs of events."""
+        source = self.endpoints.FODY_USERS_FILE
+        if not os.path.exists(source):
+            return
+        storage = self.endpoints.storage
+        achievements, tasks = storage.load_catalog('achievements'), storage.load_catalog('tasks')
+        runs = self.state.setdefault("runs", 0)
+        for name in os.listdir(self.output):
+            # Runs written after the last checkpoint are redone
+            if name.startswith('events.run') and name[len('events.run'):].isdigit() and \
+                    int(name[len('events.run'):]) >= runs:
+                os.remove(os.path.join(self.output, name))
+
+        users = self.state.setdefault("users", 0)
+        events_count = self.state.setdefault("events", 0)
+        progress = Progress('users', os.path.getsize(source))
+        with open(source, 'rb') as f, open(self.users_part, 'a+b') as part:
+            part.truncate(self.state.get("part_size", 0))
+            reader = MemberReader(f, self.endpoints.loads_json, self.state.get("input_offset", 0),
+                                  self.chunk_size)
+            pending = []
+            pending_users = 0
+            offset = self.state.get("input_offset", 0)
+            for token, user, offset in reader:
+                record, events = fold_user(self.endpoints, token, user, achievements, tasks)
+                part.write(self.endpoints.dumps_json([token, record]) + b'\n')
+                pending.extend((event["ts"], self.endpoints.dumps_json(event)) for event in events)
+                pending_users += 1
+                if pending_users >= self.checkpoint_users or len(pending) >= self.run_events:
+                    runs = self._checkpoint_users(part, pending, runs, offset, users + pending_users,
+                                                  events_count + len(pending))
+                    users += pending_users
+                    events_count += len(pending)
+                    pending = []
+                    pending_users = 0
+                progress.update(offset, users=users + pending_users, events=events_count + len(pending))
+            self._checkpoint_users(part, pending, runs, offset, users + pending_users,
+                                   events_count + len(pending))
+            progress.update(offset, force=True, users=self.state["users"], events=self.state["events"])
+
+    def _checkpoint_users(self, part, events, runs, offset, users, events_count):
+        if events:
+            events.sort(key=itemgetter(0))
+            path = self.run_path(runs)
+            with open(path + '.tmp', 'wb') as run:
+                run.writelines(line + b'\n' for _, line in events)
+                run.flush()
+                os.fsync(run.fileno())
+            os.replace(path + '.tmp', path)
+            runs += 1
+        part.flush()
+        os.fsync(part.fileno())
+        self.save_state(input_offset=offset, part_size=part.tell(), runs=runs,
+                        users=users, events=events_count)
+        return runs
+
+    def merge_events(self):
+        """Merge the runs and any existing events.log into one log in time order.
+
+        seq is reassigned from 1 so it follows time order, which history
+        queries and the windowed leaderboards rely on.
+        """
+        loads, dumps = self.endpoints.loads_json, self.endpoints.dumps_json
+        paths = [self.run_path(i) for i in range(self.state.get("runs", 0))]
+        if os.path.exists(self.endpoints.FODY_EVENTS_FILE):
+            paths.append(self.endpoints.FODY_EVENTS_FILE)
+        files = [open(path, 'rb') for path in paths]
+        target = os.path.join(self.output, 'events.log')
+        progress = Progress('events', sum(os.path.getsize(path) for path in paths))
+        seq = 0
+        consumed = [0]
+
+        def read(f):
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                consumed[0] += len(line)
+                yield loads(line)
+
+        try:
+            with open(target + '.tmp', 'wb') as log:
+                for event in heapq.merge(*map(read, files), key=itemgetter("ts")):
+                    seq += 1
+                    # Keep seq as the first key; runs hold events without one
+                    event = {"seq": seq, **event}
+                    log.write(dumps(event) + b'\n')
+                    progress.update(consumed[0], events=seq)
+                log.flush()
+                os.fsync(log.fileno())
+            os.replace(target + '.tmp', target)
+        finally:
+            for f in files:
+                f.close()
+        progress.update(consumed[0], force=True, events=seq)
+        # Only drop the runs once the merged log is recorded as complete
+        self.save_state(phase='store', events_total=seq)
+        for path in paths[:self.state.get("runs", 0)]:
+            os.remove(path)
+
+    def write_store(self):
+        """Write the compact records to the new users.json or fody.db.
+
+        Every record gets the last seq of the new log, so the server does
+        not replay history that is already folded in.
+        """
+        if not os.path.exists(self.users_part):
+            return
+        loads = self.endpoints.loads_json
+        seq = self.state.get("events_total", 0)
+        offset = self.state.get("store_offset", 0)
+        written = self.state.get("store_users", 0)
+        progress = Progress('store', os.path.getsize(self.users_part))
+        if self.backend == 'sqlite':
+            storage = self.endpoints.SqliteStorage(os.path.join(self.output, 'fody.db'))
+            storage.start()
+            target = None
+        else:
+            target = os.path.join(self.output, 'users.json')
+            out = open(target + '.part', 'a+b')
+            out.truncate(self.state.get("store_out_size", 0))
+            if not written:
+                out.write(b'{')
+        try:
+            with open(self.users_part, 'rb') as part:
+                part.seek(offset)
+                batch = []
+                for line in part:
+                    offset += len(line)
+                    token, record = loads(line)
+                    record["event_seq"] = seq
+                    batch.append((token, record))
+                    if len(batch) >= self.checkpoint_users:
+                        written = self._write_batch(storage if target is None else out, batch, written, offset)
+                        batch = []
+                    progress.update(offset, users=written + len(batch))
+                written = self._write_batch(storage if target is None else out, batch, written, offset)
+            if target is not None:
+                out.write(b'}')
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if target is None:
+                storage.close()
+            else:
+                out.close()
+        if target is not None:
+            os.replace(target + '.part', target)
+        progress.update(offset, force=True, users=written)
+        os.remove(self.users_part)
+
+    def _write_batch(self, out, batch, written, offset):
+        dumps = self.endpoints.dumps_json
+        if isinstance(out, self.endpoints.SqliteStorage):
+            with out.transaction():
+                for token, record in batch:
+                    out.create_user(token, record)
+            self.save_state(store_offset=offset, store_users=written + len(batch))
+        else:
+            for i, (token, record) in enumerate(batch):
+                out.write((b',' if written or i else b'') + dumps(token) + b':' + dumps(record))
+            out.flush()
+            os.fsync(out.fileno())
+            self.save_state(store_offset=offset, store_users=written + len(batch), store_out_size=out.tell())
+        return written + len(batch)
+
+    def migrate_usage(self):
+        """Stream usage_stats.json into a usage segment and retire the file."""
+        endpoints = self.endpoints
+        source = endpoints.USAGE_STATS_FILE
+        segment = os.path.join(endpoints.USAGE_DIR, LEGACY_USAGE_SEGMENT)
+        if os.path.exists(source):
+            self._stream_usage(source, segment)
+        if os.path.exists(segment + '.part'):
+            os.replace(segment + '.part', segment)
+
+    def _stream_usage(self, source, segment):
+        endpoints = self.endpoints
+        os.makedirs(endpoints.USAGE_DIR, exist_ok=True)
+        records = self.state.get("usage_records", 0)
+        progress = Progress('usage', os.path.getsize(source))
+        # Segments only count once they end in .ndjson
+        with open(source, 'rb') as f, open(segment + '.part', 'a+b') as out:
+            out.truncate(self.state.get("usage_out_size", 0))
+            offset = self.state.get("usage_offset", 0)
+            for _, record, offset in MemberReader(f, endpoints.loads_json, offset, self.chunk_size):
+                out.write(endpoints.dumps_json(record) + b'\n')
+                records += 1
+                if records % self.checkpoint_users == 0:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    self.save_state(usage_offset=offset, usage_out_size=out.tell(), usage_records=records)
+                progress.update(offset, records=records)
+            out.flush()
+            os.fsync(out.fileno())
+            size = out.tell()
+        self.save_state(usage_offset=offset, usage_out_size=size, usage_records=records)
+        progress.update(offset, force=True, records=records)
+
+        # Saved rollups already count the legacy records; without them the
+        # server counts the segment on its next start
+        rollups = endpoints.UsageRollups(endpoints.USAGE_ROLLUPS_FILE)
+        if rollups.load():
+            rollups.positions[LEGACY_USAGE_SEGMENT] = size
+            rollups.save()
+        os.replace(source, source + '.migrated')
+
+    def swap(self):
+        """Carry over catalogs and settings, then put the new store in place."""
+        skip = {'users.json', 'users.json.lock', 'fody.db', 'fody.db-wal', 'fody.db-shm', 'events.log'}
+        if os.path.isdir(self.source) and os.path.abspath(self.source) != os.path.abspath(self.output):
+            for name in os.listdir(self.source):
+                path = os.path.join(self.source, name)
+                target = os.path.join(self.output, name)
+                if name in skip or name.endswith('.tmp') or os.path.exists(target):
+                    continue
+                if os.path.isdir(path):
+                    shutil.copytree(path, target)
+                else:
+                    shutil.copy2(path, target)
+        if not self.swap_in:
+            print(f"New store written to {self.output}; move it to {self.source} to use it",
+                  file=sys.stderr)
+            return
+        legacy = self.source + '.legacy'
+        if os.path.exists(self.source):
+            os.replace(self.source, legacy)
+        os.replace(self.output, self.source)
+        self.state_path = os.path.join(self.source, 'migrate.state.json')
+        print(f"New store in place; the old one is kept as {legacy}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default='.', help="the server's working directory")
+    parser.add_argument('--backend', default='json', choices=['json', 'sqlite'],
+                        help='storage backend to write the new store for')
+    parser.add_argument('--output', help='where to build the new store '
+                                         '(default: fody_gamification_data.migrated)')
+    parser.add_argument('--no-swap', action='store_true',
+                        help='leave the new store in --output instead of moving it into place')
+    parser.add_argument('--checkpoint-users', type=int, default=10000,
+                        help='users (or usage records) between checkpoints')
+    parser.add_argument('--run-events', type=int, default=200000,
+                        help='events sorted in memory before a run is written')
+    parser.add_argument('--chunk-size', type=int, default=1 << 20, help='bytes read at a time')
+    args = parser.parse_args()
+
+    os.chdir(args.data_dir)
+    sys.path.insert(0, REPO_DIR)
+    import endpoints
+
+    lock = None
+    if fcntl is not None and os.path.exists(endpoints.FODY_USERS_FILE):
+        # The same lock a json-backend server holds while it runs
+        lock = open(endpoints.FODY_USERS_FILE + '.lock', 'w')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise SystemExit(f"{endpoints.FODY_USERS_FILE} is in use; stop the server first")
+
+    migration = Migration(endpoints, args.backend, args.output, not args.no_swap,
+                          args.checkpoint_users, args.run_events, args.chunk_size)
+    try:
+        migration.run()
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+if __name__ == '__main__':
+    main()